@@ -33,7 +33,7 @@ setup(
         'Topic :: Scientific/Engineering :: Chemistry'
     ],
     install_requires=[
-        'noodles[numpy]', 'pyyaml==5.1', 'schema'],
+        'noodles[numpy]', 'numpy', 'pyyaml==5.1', 'schema'],
     tests_require=[
         'pytest',
         'pytest-cov',
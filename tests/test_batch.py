@@ -0,0 +1,136 @@
+import os
+from pathlib import Path
+from xtp_job_control.workflows.run_workflow import run_molecules_batch
+
+# The tests run in their temporary folder, where the workflow database is written
+METHANE = Path("tests/DFT_GWBSE/dftgwbse_CH4/methane.xyz").absolute()
+VOTCASHARE = Path("tests/test_files/votca").absolute()
+
+FAKE_XTP_TOOLS = """#!/bin/sh
+echo "$PWD" >> {}
+for x in dftgwbse.out.xml system_dft.orb system.orb; do
+  echo "$PWD" > $x
+done
+"""
+
+
+def create_fake_xtp_tools(tmp_path: Path, monkeypatch) -> Path:
+    """Create a fake xtp_tools executable that writes the dftgwbse output.
+
+    Returns the file where the calls are recorded.
+    """
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    calls = tmp_path / "calls.txt"
+    fake = bin_dir / "xtp_tools"
+    fake.write_text(FAKE_XTP_TOOLS.format(calls))
+    fake.chmod(0o755)
+    monkeypatch.setenv("PATH", "{}:{}".format(bin_dir, os.environ["PATH"]))
+    monkeypatch.chdir(tmp_path)
+
+    return calls
+
+
+def create_molecules(folder: Path, names: list) -> None:
+    """Write a copy of methane for each name."""
+    folder.mkdir(exist_ok=True)
+    xyz = METHANE.read_text()
+    for name in names:
+        (folder / "{}.xyz".format(name)).write_text(xyz)
+
+
+def create_options(tmp_path: Path, molecules: Path) -> dict:
+    return {
+        'workflow': 'dftgwbse', 'workdir': tmp_path.as_posix(), 'molecule': molecules,
+        'path_votcashare': VOTCASHARE, 'package': 'xtpdft',
+        'mode': 'energy', 'functional': 'XC_HYB_GGA_XC_PBEH', 'executable': 'xtp',
+        'max_workers': 2,
+        'votca_calculators_options': {'threads': 1, 'dftgwbse': {}}}
+
+
+def test_molecules_batch(tmp_path, monkeypatch):
+    """Check that several molecules are computed in a single workflow."""
+    create_fake_xtp_tools(tmp_path, monkeypatch)
+    molecules = tmp_path / "molecules"
+    create_molecules(molecules, ["a", "b", "c"])
+
+    options = create_options(tmp_path, molecules)
+    run_molecules_batch(options, sorted(molecules.glob("*.xyz")))
+
+    scratch_dirs = set()
+    for name in ("a", "b", "c"):
+        out = tmp_path / name / "dftgwbse.out.xml"
+        assert (tmp_path / name / "dftgwbse.log").exists()
+        scratch = Path(out.read_text().strip()).parent
+        scratch_dirs.add(scratch)
+        # Each calculation uses its own molecule
+        dftgwbse = (scratch / "OPTIONFILES" / "dftgwbse.xml").read_text()
+        assert "{}.xyz".format(name) in dftgwbse
+    # Every molecule runs in its own scratch folder
+    assert len(scratch_dirs) == 3
+
+
+def test_molecules_batch_resume(tmp_path, monkeypatch):
+    """Check that the molecules do not share the scratch folder to resume."""
+    create_fake_xtp_tools(tmp_path, monkeypatch)
+    molecules = tmp_path / "molecules"
+    create_molecules(molecules, ["a", "b"])
+    resume = tmp_path / "xtp_previous"
+    resume.mkdir()
+
+    options = create_options(tmp_path, molecules)
+    options['resume'] = resume
+    run_molecules_batch(options, sorted(molecules.glob("*.xyz")))
+
+    scratch_dirs = {Path((tmp_path / name / "dftgwbse.out.xml").read_text().strip()).parent
+                    for name in ("a", "b")}
+    assert len(scratch_dirs) == 2
+    assert resume not in scratch_dirs
+    assert not any(resume.iterdir())
+
+
+def test_skip_computed_molecules(tmp_path, monkeypatch):
+    """Check that only the new or modified molecules are computed again."""
+    calls = create_fake_xtp_tools(tmp_path, monkeypatch)
+    molecules = tmp_path / "molecules"
+    create_molecules(molecules, ["a", "b"])
+    run_molecules_batch(
+        create_options(tmp_path, molecules), sorted(molecules.glob("*.xyz")))
+    assert len(calls.read_text().splitlines()) == 2
+
+    # Add a new molecule
+    create_molecules(molecules, ["c"])
+    run_molecules_batch(
+        create_options(tmp_path, molecules), sorted(molecules.glob("*.xyz")))
+    assert len(calls.read_text().splitlines()) == 3
+
+    # Changing the functional invalidates all the results
+    options = create_options(tmp_path, molecules)
+    options['functional'] = 'XC_GGA_XC_PBE'
+    run_molecules_batch(options, sorted(molecules.glob("*.xyz")))
+    assert len(calls.read_text().splitlines()) == 6
+
+
+def test_failed_molecule(tmp_path, monkeypatch):
+    """Check that a failed molecule does not stop the others."""
+    calls = create_fake_xtp_tools(tmp_path, monkeypatch)
+    fake = tmp_path / "bin" / "xtp_tools"
+    # Fail for the molecule b
+    fake.write_text(FAKE_XTP_TOOLS.format(calls).replace(
+        'for x', 'grep -q "/b.xyz" "$6" && exit 1\nfor x'))
+    molecules = tmp_path / "molecules"
+    create_molecules(molecules, ["a", "b", "c"])
+    run_molecules_batch(
+        create_options(tmp_path, molecules), sorted(molecules.glob("*.xyz")))
+
+    for name in ("a", "c"):
+        assert (tmp_path / name / "dftgwbse.out.xml").exists()
+        assert (tmp_path / name / "dftgwbse.fingerprint").exists()
+    assert (tmp_path / "b" / "dftgwbse.log").exists()
+    assert not (tmp_path / "b" / "dftgwbse.fingerprint").exists()
+    assert len(calls.read_text().splitlines()) == 3
+
+    # Only the failed molecule is computed again
+    run_molecules_batch(
+        create_options(tmp_path, molecules), sorted(molecules.glob("*.xyz")))
+    assert len(calls.read_text().splitlines()) == 4
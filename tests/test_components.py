@@ -1,26 +1,32 @@
 from pathlib import Path
 from xtp_job_control.input import validate_input
+from xtp_job_control.resources import ResourcePool
 from xtp_job_control.results import Results
 from xtp_job_control.runner import run
-from xtp_job_control.xml_editor import read_available_jobs
-from xtp_job_control.workflows.workflow_components import create_xml_job_file
+from xtp_job_control.state_snapshot import snapshot_prefix
+from xtp_job_control.xml_editor import edit_xml_options, read_available_jobs
+from xtp_job_control.workflows.workflow_components import (
+    compute_chunk_size, compute_max_workers, create_xml_job_file, job_command, pipeline_jobs,
+    read_jobs_into_state, run_cached_command, run_parallel_jobs, split_calculations,
+    split_chunk_output)
 from xtp_job_control.workflows.xtp_workflow import (
-    initial_config, recursively_create_path, to_posix)
+    initial_config, read_input, recursively_create_path, to_posix)
 from noodles import gather_dict
 import os
 import pytest
+import shutil
 import sys
 import tempfile
 
 
-def test_results():
+def test_results(tmp_path):
     """
     Test the results object
     """
     d = {"foo": 1}
     rs = Results(d)
 
-    output = run(gather_dict(**rs.state))
+    output = run(gather_dict(**rs.state), cache=(tmp_path / 'cache.db').as_posix())
 
     assert output["foo"] == 1
 
@@ -44,4 +50,229 @@ def test_posix():
     d = to_posix({x.name: x for x in xs})
 
     assert all(isinstance(x, str) for x in to_posix(xs))
-    assert all(os.path.exists(x) for x in d.values())
\ No newline at end of file
+    assert all(os.path.exists(x) for x in d.values())
+
+
+def test_max_workers():
+    """Check the number of concurrent jobs."""
+    assert compute_max_workers(3, 4) == 3
+    assert compute_max_workers(None, os.cpu_count() * 2) == 1
+
+
+def test_run_parallel_jobs(tmp_path, monkeypatch):
+    """Check that the split jobs are run and their results collected."""
+    create_fake_xtp(tmp_path, monkeypatch)
+    dict_jobs = {}
+    for idx in ("1", "2", "3"):
+        workdir = tmp_path / "job_{}".format(idx)
+        workdir.mkdir()
+        dict_jobs[idx] = {'workdir': workdir, 'eqm': workdir / 'eqm.xml'}
+
+    dict_input = {
+        'name': 'eqm', 'state': tmp_path / 'state.sql', 'scratch_dir': tmp_path,
+        'max_workers': 2, 'threads': 1, 'cmd_options': "-s 0 -j run",
+        'expected_output': {'tab': 'job.tab'}}
+
+    rs = run(run_parallel_jobs(dict_jobs, dict_input), 'serial')
+
+    for idx in ("1", "2", "3"):
+        assert rs[idx]['job_workdir'] == dict_jobs[idx]['workdir']
+        assert Path(rs[idx]['tab']).exists()
+
+
+def test_chunked_jobs(tmp_path):
+    """Check that the jobs are grouped in chunks sharing a job file."""
+    option_file = tmp_path / "eqm.xml"
+    option_file.write_text("<options><eqm></eqm></options>")
+    # The index of the job file is written next to it
+    path_jobs = shutil.copy("tests/test_files/eqm.jobs", tmp_path.as_posix())
+    input_dict = {'name': 'eqm', 'eqm': option_file, 'scratch_dir': tmp_path,
+                  'eqm_jobs': path_jobs, 'chunk_size': 4}
+
+    results = split_calculations(input_dict, 'eqm_jobs')
+
+    assert results['1']['workdir'] == results['4']['workdir']
+    assert results['4']['workdir'] != results['5']['workdir']
+    assert len(read_available_jobs(results['1']['job'])) == 4
+    assert (results['1']['workdir'] / 'eqm.xml').read_text() == option_file.read_text()
+    assert compute_chunk_size(1000, 'auto', 10) == 25
+
+    workdir = results['1']['workdir']
+    output = {'tab': (workdir / 'job.tab').as_posix(),
+              'mps': [(workdir / 'MP_FILES/frame_0/n/Methane_{}_n.mps'.format(i)).as_posix()
+                      for i in (2, 3)]}
+    rs = split_chunk_output(output, ['1', '2', '3', '4'], results)
+
+    assert rs['1']['tab'] == rs['4']['tab']
+    assert rs['1']['mps'] == []
+    assert rs['3']['mps'] == [output['mps'][1]]
+
+
+def create_fake_xtp(tmp_path: Path, monkeypatch) -> None:
+    """Create a fake xtp_parallel executable that writes a job.tab file."""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    fake = bin_dir / "xtp_parallel"
+    fake.write_text('#!/bin/sh\necho "$@" > job.tab\n')
+    fake.chmod(0o755)
+    monkeypatch.setenv("PATH", "{}:{}".format(bin_dir, os.environ["PATH"]))
+
+
+def test_lazy_optionfiles(tmp_path):
+    """Check that the option files are only copied when they are edited."""
+    template = Path("tests/test_files/votca/xtp/xml/neighborlist.xml")
+    content = template.read_text()
+    options = {'workdir': tmp_path.as_posix(), 'path_votcashare': Path("tests/test_files/votca")}
+    path_optionfiles = initial_config(options)['path_optionfiles']
+
+    assert (path_optionfiles / "neighborlist.xml").is_symlink()
+
+    edit_xml_options({"neighborlist": {"constant": 0.6}}, path_optionfiles)
+
+    assert not (path_optionfiles / "neighborlist.xml").is_symlink()
+    assert template.read_text() == content
+
+
+FAKE_PIPELINE_XTP = """#!/bin/sh
+echo "$@" > job.tab
+if [ "$2" = "eqm" ]; then
+  id=$(basename "$PWD" | sed 's/job_//')
+  if [ "$id" = "3" ]; then sleep 1; fi
+  mkdir -p OR_FILES/molecules/frame_0
+  echo $id > OR_FILES/molecules/frame_0/molecule_$id.orb
+fi
+date +%s.%N > finished.txt
+"""
+
+
+def write_jobs_file(path: Path, segments: list) -> None:
+    """Write a job file with a job for each tuple of segments."""
+    jobs = ""
+    for i, ids in enumerate(segments, start=1):
+        inp = "".join('<segment id="{}" type="Methane">{}</segment>'.format(x, x) for x in ids)
+        jobs += "<job><id>{}</id><tag/><input>{}</input><status>AVAILABLE</status></job>".format(
+            i, inp)
+    path.write_text("<jobs>{}</jobs>".format(jobs))
+
+
+def test_pipeline_jobs(tmp_path, monkeypatch):
+    """Check that the iqm jobs only wait for the eqm jobs of their segments."""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    fake = bin_dir / "xtp_parallel"
+    fake.write_text(FAKE_PIPELINE_XTP)
+    fake.chmod(0o755)
+    monkeypatch.setenv("PATH", "{}:{}".format(bin_dir, os.environ["PATH"]))
+    # Enough cores to run all the jobs concurrently
+    monkeypatch.setattr("xtp_job_control.resources._POOL", ResourcePool(cores=4))
+
+    dicts = {}
+    for name, segments in (('eqm', [(1,), (2,), (3,)]), ('iqm', [(1, 2), (2, 3)])):
+        write_jobs_file(tmp_path / "{}.jobs".format(name), segments)
+        option_file = tmp_path / "{}.xml".format(name)
+        option_file.write_text("<options><{0}></{0}></options>".format(name))
+        dicts[name] = {
+            'name': name, name: option_file, 'scratch_dir': tmp_path,
+            '{}_jobs'.format(name): tmp_path / "{}.jobs".format(name),
+            'state': tmp_path / 'state.sql', 'threads': 1, 'cmd_options': "-s 0 -j run",
+            'expected_output': {'tab': 'job.tab'}}
+    dicts['eqm']['expected_output']['molecule_orb'] = 'OR_FILES/molecules/frame_0/*.orb'
+
+    jobs = {}
+    for name in ('eqm', 'iqm'):
+        jobs[name] = dict(split_calculations(dicts[name], '{}_jobs'.format(name)))
+        for job in jobs[name].values():
+            job[name] = job['workdir'] / '{}.xml'.format(name)
+    eqm_jobs, iqm_jobs = jobs['eqm'], jobs['iqm']
+    jobs = pipeline_jobs(eqm_jobs, dicts['eqm'], iqm_jobs, dicts['iqm'], ['molecule_orb'])
+    # The results of the iqm jobs are read into the state as in `run_eqm_iqm`
+    wf = gather_dict(
+        eqm=jobs['eqm'], iqm=read_jobs_into_state(jobs['iqm'], read_input(dicts['iqm'])))
+    rs = run(wf, n_processes=4, cache=(tmp_path / 'cache.db').as_posix())
+
+    def finished(results, idx):
+        return float((Path(results[idx]['job_workdir']) / 'finished.txt').read_text())
+
+    # The first pair does not need the slow eqm job of segment 3
+    assert finished(rs['iqm'], '1') < finished(rs['eqm'], '3')
+    assert finished(rs['iqm'], '2') > finished(rs['eqm'], '3')
+    assert (tmp_path / "OR_FILES/molecules/frame_0/molecule_3.orb").exists()
+    assert rs['eqm']['3']['molecule_orb'] == [
+        tmp_path / "OR_FILES/molecules/frame_0/molecule_3.orb"]
+    assert rs['iqm']['state'] == tmp_path / 'state.sql'
+    assert "-e iqm" in (tmp_path / "job.tab").read_text()
+    assert "-j read" in (tmp_path / "job.tab").read_text()
+    # The state is written once all the eqm jobs have finished
+    assert (tmp_path / "job.tab").stat().st_mtime > finished(rs['eqm'], '3')
+
+
+def test_state_snapshot(tmp_path, monkeypatch):
+    """Check that the jobs read a copy of the state and the results are read at once."""
+    create_fake_xtp(tmp_path, monkeypatch)
+    state = tmp_path / "state.sql"
+    state.write_bytes(b"state")
+    iqm_dir = tmp_path / "iqm"
+    iqm_dir.mkdir()
+    write_jobs_file(iqm_dir / "iqm.jobs", [(1, 2), (2, 3)])
+
+    dict_input = {
+        'name': 'iqm', 'state': state, 'iqm': iqm_dir / 'iqm.xml',
+        'iqm_jobs': iqm_dir / 'iqm.jobs', 'scratch_dir': tmp_path, 'threads': 1,
+        'cmd_options': "-s 0 -j run", 'expected_output': {'tab': 'job.tab'},
+        'state_snapshot': (tmp_path / "shm").as_posix()}
+    # Snapshot of an older version of the state
+    (tmp_path / "shm").mkdir()
+    stale = tmp_path / "shm" / "{}old.sql".format(snapshot_prefix(state))
+    stale.write_bytes(b"old")
+    jobs = {}
+    for i in (1, 2):
+        workdir = tmp_path / "job_{}".format(i)
+        workdir.mkdir()
+        write_jobs_file(workdir / "job.xml", [(i, i + 1)])
+        jobs[str(i)] = {'workdir': workdir, 'job': workdir / 'job.xml',
+                        'iqm': workdir / 'iqm.xml'}
+        output = run_cached_command(
+            job_command(jobs[str(i)], dict_input), workdir, dict_input['expected_output'])
+        assert Path(output['tab']).exists()
+
+    snapshots = list((tmp_path / "shm").iterdir())
+    assert len(snapshots) == 1 and snapshots[0].read_bytes() == b"state"
+    assert snapshots[0].as_posix() in (tmp_path / "job_1" / "job.tab").read_text()
+
+    dict_read = dict(dict_input, cmd_options="-j read", expected_output=None)
+    rs = run(read_jobs_into_state(jobs, dict_read), 'serial')
+
+    assert rs['state'] == state
+    assert "-f {} -o {} -j read".format(state, dict_input['iqm']) in (
+        iqm_dir / "job.tab").read_text()
+    # The snapshot is removed once the results are read
+    assert list((tmp_path / "shm").iterdir()) == []
+
+
+def test_resume_merge(tmp_path, monkeypatch):
+    """Check that the results of the finished chunks survive a resume and a merge."""
+    create_fake_xtp(tmp_path, monkeypatch)
+    iqm_dir = tmp_path / "iqm"
+    iqm_dir.mkdir()
+    path_jobs = iqm_dir / "iqm.jobs"
+    write_jobs_file(path_jobs, [(1, 2), (2, 3)])
+    option_file = iqm_dir / "iqm.xml"
+    option_file.write_text("<options><iqm></iqm></options>")
+    input_dict = {'name': 'iqm', 'iqm': option_file, 'iqm_jobs': path_jobs,
+                  'scratch_dir': tmp_path, 'state': tmp_path / "state.sql",
+                  'cmd_options': "-j read", 'expected_output': None}
+
+    jobs = split_calculations(input_dict, 'iqm_jobs')
+    # The first chunk finished before the workflow was killed
+    finished = jobs['1']['job']
+    finished.write_text(finished.read_text().replace(
+        "<status>AVAILABLE</status>", "<output>J=1</output><status>COMPLETE</status>"))
+
+    jobs = split_calculations(input_dict, 'iqm_jobs')
+    assert "<output>J=1</output>" in jobs['1']['job'].read_text()
+
+    for _ in range(2):
+        run(read_jobs_into_state(dict(jobs), input_dict), 'serial')
+        merged = path_jobs.read_text()
+        assert merged.count("<output>J=1</output>") == 1
+        assert merged.count("<status>AVAILABLE</status>") == 1
@@ -0,0 +1,25 @@
+from pathlib import Path
+from xtp_job_control.content_store import ContentStore
+
+
+def test_content_store(tmp_path):
+    """Check that the inputs are stored once and linked to the scratch folders."""
+    store = ContentStore(tmp_path / "store")
+    src = Path("tests/Methane/MP_FILES")
+
+    first = store.stage(src, tmp_path / "scratch_1" / "MP_FILES")
+    second = store.stage(src, tmp_path / "scratch_2" / "MP_FILES")
+
+    names = sorted(x.name for x in src.iterdir())
+    assert sorted(x.name for x in first.iterdir()) == names
+    for name in names:
+        assert (first / name).stat().st_ino == (second / name).stat().st_ino
+
+    # Mutable inputs are not shared
+    state = Path("tests/KMC/state.sql")
+    copy = store.stage(state, tmp_path / "scratch_1" / "state.sql", mutable=True)
+    assert copy.read_bytes() == state.read_bytes()
+    assert copy.stat().st_ino != store.put(state).stat().st_ino
+
+    # the hashes are reused by a new store
+    assert ContentStore(tmp_path / "store").hashes == store.hashes
@@ -0,0 +1,67 @@
+import os
+from pathlib import Path
+from xtp_job_control.cost_model import (AtomCountCost, RuntimeHistory, UniformCost,
+                                        order_chunks, register_cost_model)
+from xtp_job_control.runner import run
+from xtp_job_control.workflows.workflow_components import run_parallel_jobs
+
+path_state = Path("tests/KMC/state.sql")
+
+
+def test_atom_count_cost():
+    """Check that the jobs with more atoms go first."""
+    model = AtomCountCost(path_state)
+    assert model.job_cost('eqm', [1]) == 5 ** 3
+    assert model.job_cost('iqm', [1, 2]) == 10 ** 3
+
+    dict_jobs = {'1': {'segments': [1]}, '2': {'segments': [2]}, '3': {'segments': [1, 2]}}
+    chunks = [['1'], ['2'], ['3']]
+    assert order_chunks(chunks, dict_jobs, {'name': 'iqm'}, model)[0] == ['3']
+    assert order_chunks(chunks, dict_jobs, {'name': 'iqm'}, UniformCost()) == chunks
+
+
+def test_runtime_history(tmp_path):
+    """Check that the recorded runtimes are used as estimates."""
+    path = tmp_path / "runtimes.jsonl"
+    history = RuntimeHistory(path, UniformCost())
+    history.record('eqm', [[1], [2]], 10)
+    history.record('eqm', [[3]], 0.1)
+
+    history = RuntimeHistory(path, UniformCost())
+    assert history.job_cost('eqm', [1]) == 5
+    # Estimated with the fallback, rescaled to the recorded runtimes
+    assert history.job_cost('eqm', [3]) == 5
+    assert history.job_cost('iqm', [1, 2]) == 5
+
+
+def test_largest_first(tmp_path, monkeypatch):
+    """Check that the chunks are started in order of decreasing cost."""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    order = tmp_path / "order.txt"
+    fake = bin_dir / "xtp_parallel"
+    fake.write_text('#!/bin/sh\nbasename "$PWD" >> {}\necho "$@" > job.tab\n'.format(order))
+    fake.chmod(0o755)
+    monkeypatch.setenv("PATH", "{}:{}".format(bin_dir, os.environ["PATH"]))
+
+    class SegmentCost:
+        def job_cost(self, name, segments):
+            return sum(segments)
+
+    register_cost_model('segments', lambda dict_input: SegmentCost())
+
+    dict_jobs = {}
+    for idx in ("1", "2", "3", "4"):
+        workdir = tmp_path / "job_{}".format(idx)
+        workdir.mkdir()
+        dict_jobs[idx] = {'workdir': workdir, 'eqm': workdir / 'eqm.xml',
+                          'segments': [int(idx) % 3]}
+
+    dict_input = {
+        'name': 'eqm', 'state': tmp_path / 'state.sql', 'scratch_dir': tmp_path,
+        'max_workers': 1, 'threads': 1, 'cmd_options': "-s 0 -j run",
+        'expected_output': {'tab': 'job.tab'}, 'cost_model': 'segments'}
+
+    run(run_parallel_jobs(dict_jobs, dict_input), 'serial')
+
+    assert order.read_text().split() == ["job_2", "job_1", "job_4", "job_3"]
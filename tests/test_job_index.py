@@ -0,0 +1,43 @@
+from pathlib import Path
+from xtp_job_control.job_index import JobIndex
+from xtp_job_control.selection import select_jobs
+from xtp_job_control.xml_editor import edit_xml_job_file, iter_jobs
+import shutil
+
+
+def test_job_index(tmp_path):
+    """Check that the status of the jobs is patched in place."""
+    path = Path(shutil.copy("tests/test_files/eqm.jobs", tmp_path.as_posix()))
+    size = path.stat().st_size
+
+    edit_xml_job_file(path.as_posix(), [3, 10])
+    index = JobIndex.load(path)
+    assert index.ids("AVAILABLE") == [3, 10]
+    assert path.stat().st_size == size
+
+    # Back to the original status
+    edit_xml_job_file(path.as_posix(), None)
+    statuses = [job.findtext('status') for job in iter_jobs(path.as_posix())]
+    assert statuses == ["AVAILABLE"] * 1000
+
+    # the index is reused and it is consistent with the file
+    assert JobIndex.load(path).entries == JobIndex.build(path).entries
+    assert index.extract(42).find('input/segment').get('id') == "42"
+    assert index.segments(7) == [(7, "Methane")]
+
+
+def test_job_selection():
+    """Check the job selection expressions."""
+    index = JobIndex.build("tests/test_files/eqm.jobs")
+
+    assert select_jobs(index, None) is None
+    assert select_jobs(index, [1, 2]) == {1, 2}
+    assert select_jobs(index, "1-10:3,20") == {1, 4, 7, 10, 20}
+    assert select_jobs(index, "995-:2") == {995, 997, 999}
+    assert select_jobs(index, {'every': 250, 'offset': 1}) == {2, 252, 502, 752}
+    assert select_jobs(index, {'segment_ids': "5-7", 'segment_type': "Methane"}) == {5, 6, 7}
+    assert select_jobs(index, {'segment_type': ["Ethane"]}) == set()
+    assert select_jobs(index, {'ids': "1-100", 'input_regex': r'id="1\d"'}) == set(range(10, 20))
+
+    sample = select_jobs(index, {'sample': 10, 'seed': 42})
+    assert len(sample) == 10 and sample == select_jobs(index, {'sample': 10, 'seed': 42})
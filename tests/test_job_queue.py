@@ -0,0 +1,119 @@
+import threading
+import time
+from pathlib import Path
+from xtp_job_control.job_queue import JobQueue, open_pilot_queue
+from xtp_job_control.workflows import workflow_components
+from xtp_job_control.workflows.workflow_components import dispatch_command, run_local_chunks
+
+
+def test_job_queue(tmp_path):
+    """Check that every job is claimed by a single worker."""
+    queue = JobQueue(tmp_path / "jobs.sqlite")
+    ids = [queue.enqueue("echo {}".format(i), tmp_path) for i in range(20)]
+    assert queue.enqueue("echo 0", tmp_path) == ids[0]
+
+    claimed = []
+
+    def claim(worker):
+        job = queue.claim(worker)
+        while job is not None:
+            claimed.append(job['id'])
+            queue.complete(job['id'], {'out': job['cmd']})
+            job = queue.claim(worker)
+
+    threads = [threading.Thread(target=claim, args=(str(i),)) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert sorted(claimed) == ids
+    assert queue.counts() == {'done': 20}
+    assert queue.wait(ids[3]) == {'out': "echo 3"}
+
+
+def test_expired_lease(tmp_path):
+    """Check that the jobs of a dead worker are queued again."""
+    path_queue = tmp_path / "jobs.sqlite"
+    queue = JobQueue(path_queue, lease=0.5)
+    job_id = queue.enqueue("echo 1", tmp_path)
+    assert queue.claim("dead")['id'] == job_id
+    assert queue.claim("alive") is None
+
+    # The lease is renewed by the heartbeat
+    time.sleep(0.3)
+    assert queue.heartbeat(job_id, "dead")
+    time.sleep(0.3)
+    assert queue.claim("alive") is None
+
+    time.sleep(0.6)
+    job = queue.claim("alive")
+    assert job['id'] == job_id
+    assert not queue.heartbeat(job_id, "dead")
+
+    # Reopening the queue of a resumed workflow releases the expired jobs
+    time.sleep(0.6)
+    JobQueue(path_queue, lease=0.5).reopen()
+    assert queue.counts() == {'pending': 1}
+
+
+def test_pilot_workers(tmp_path):
+    """Check that the commands are run by the local pilot workers."""
+    path_queue = open_pilot_queue(tmp_path / "jobs.sqlite", 2)
+    outputs = {}
+
+    def submit(i):
+        workdir = tmp_path / "job_{}".format(i)
+        workdir.mkdir()
+        outputs[i] = dispatch_command(
+            "echo $PPID > worker.txt", workdir, {'pid': 'worker.txt'}, queue=path_queue)
+
+    threads = [threading.Thread(target=submit, args=(i,)) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    JobQueue(path_queue).close()
+
+    queue = JobQueue(path_queue)
+    assert queue.counts() == {'done': 4}
+    with queue.connect() as conn:
+        workers = {name.split(':')[1].split('/')[0] for name, in conn.execute(
+            "SELECT worker FROM jobs")}
+    for i in range(4):
+        assert Path(outputs[i]['pid']).read_text().strip() in workers
+    assert len(workers) <= 2
+
+
+def test_queued_chunks(tmp_path, monkeypatch):
+    """Check that all the chunks are queued up front and waited for without a pool."""
+    monkeypatch.setattr(workflow_components, 'ThreadPoolExecutor', None)
+    path_queue = tmp_path / "jobs.sqlite"
+    queue = JobQueue(path_queue)
+    dict_jobs = {}
+    for idx in ("1", "2", "3"):
+        workdir = tmp_path / "job_{}".format(idx)
+        workdir.mkdir()
+        dict_jobs[idx] = {'workdir': workdir, 'eqm': workdir / 'eqm.xml'}
+    dict_input = {
+        'name': 'eqm', 'state': tmp_path / 'state.sql', 'queue': path_queue,
+        'cmd_options': "-s 0 -j run", 'expected_output': {'tab': 'job.tab'}}
+
+    def fake_worker():
+        # The jobs are only run once all of them are queued
+        deadline = time.monotonic() + 10
+        while queue.counts().get('pending', 0) < 3 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        job = queue.claim("fake")
+        while job is not None:
+            queue.complete(job['id'], {'tab': (job['workdir'] / 'job.tab').as_posix()})
+            job = queue.claim("fake")
+
+    worker = threading.Thread(target=fake_worker)
+    worker.start()
+    finished = dict((ids[0], output) for ids, output in run_local_chunks(
+        [["1"], ["2"], ["3"]], dict_jobs, dict_input))
+    worker.join()
+
+    assert queue.counts() == {'done': 3}
+    assert finished['2'] == {'tab': (tmp_path / "job_2" / "job.tab").as_posix()}
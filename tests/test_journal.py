@@ -0,0 +1,48 @@
+from pathlib import Path
+import pytest
+from xtp_job_control.journal import Journal
+from xtp_job_control.results import Options
+from xtp_job_control.runner import run
+from xtp_job_control.workflows.workflow_components import call_xtp_cmd
+from xtp_job_control.workflows.xtp_workflow import initial_config
+
+
+def test_journal(tmp_path):
+    """Check that finished commands are not run again."""
+    journal = tmp_path / "journal.jsonl"
+    cmd = "date +%s%N >> out.txt"
+    for _ in range(2):
+        job = call_xtp_cmd(
+            cmd, tmp_path, expected_output={"out": "out.txt"}, journal=journal)
+        rs = run(job, 'serial')
+
+    with open(rs["out"], 'r') as f:
+        assert len(f.readlines()) == 1
+
+    assert Journal(journal).lookup(cmd, tmp_path) == rs
+
+
+def test_resume_config(tmp_path):
+    """Check that a resumed workflow reuses the scratch folder."""
+    molecule = Path("tests/DFT_GWBSE/dftgwbse_CH4/methane.xyz")
+    options = {'workdir': tmp_path.as_posix(), 'molecule': molecule,
+               'path_votcashare': Path("tests/test_files/votca")}
+    first = initial_config(Options(options.copy()))
+
+    resumed = initial_config(Options(options, resume=first['scratch_dir']))
+
+    assert resumed['scratch_dir'] == first['scratch_dir']
+    assert resumed['molecule'] == first['molecule']
+    assert resumed['journal'] == first['scratch_dir'] / 'journal.jsonl'
+
+
+def test_batch_needs_scratch_root(tmp_path):
+    """Check that the batch jobs are not run in the local temporary folder."""
+    options = {'workdir': tmp_path.as_posix(), 'path_votcashare': Path("tests/test_files/votca"),
+               'batch': {'scheduler': 'slurm'}}
+    with pytest.raises(RuntimeError):
+        initial_config(Options(options.copy()))
+
+    config = initial_config(Options(options, scratch_root=tmp_path.as_posix()))
+
+    assert config['scratch_dir'].parent == tmp_path
@@ -0,0 +1,105 @@
+import numpy as np
+import pytest
+import shutil
+import sqlite3
+from pathlib import Path
+from xtp_job_control.job_index import JobIndex
+from xtp_job_control.pair_screening import pair_metrics, screen_pairs
+from xtp_job_control.selection import select_jobs
+from xtp_job_control.state_reader import StateReader
+from xtp_job_control.workflows.workflow_components import screen_iqm_jobs
+from xtp_job_control.runner import run
+from .test_components import write_jobs_file
+
+path_state = Path("tests/KMC/state.sql")
+
+
+def test_pair_metrics():
+    """Compare the vectorised distances with a loop over the pairs."""
+    with StateReader(path_state) as state:
+        segments, pairs, atoms = state.segments(), state.pairs(), state.atoms()
+    metrics = pair_metrics(segments, pairs, atoms)
+
+    for k in (0, 100, 2932):
+        seg1, seg2 = pairs['seg1'][k], pairs['seg2'][k]
+        xs = atoms['pos'][atoms['seg'] == seg1]
+        shift = segments['pos'][seg1 - 1] + pairs['dr'][k] - segments['pos'][seg2 - 1]
+        ys = atoms['pos'][atoms['seg'] == seg2] + shift
+        distances = np.linalg.norm(xs[:, None] - ys[None], axis=-1)
+        assert np.isclose(metrics['min_distance'][k], distances.min())
+        assert np.isclose(metrics['overlap'][k], np.exp(-20 * distances).sum())
+    assert np.all(metrics['min_distance'] <= pairs['distance'] + 1e-8)
+
+
+def test_screen_pairs():
+    """Check the thresholds and the top-k pairs per segment."""
+    close = screen_pairs(path_state, {'max_distance': 0.25})
+    assert 0 < len(close) < 2933
+
+    best = screen_pairs(path_state, {'top_k': 1})
+    counts = {}
+    for pair in best:
+        for s in pair:
+            counts[s] = counts.get(s, 0) + 1
+    # Every segment keeps its best pair, which may also be the best of the other segment
+    assert len(counts) == 1000
+
+    both = screen_pairs(path_state, {'max_distance': 0.25, 'top_k': 1})
+    assert set(both) <= set(close)
+
+
+def test_screen_iqm_jobs(tmp_path):
+    """Check that only the screened pairs are selected from the iqm jobs."""
+    path_jobs = tmp_path / "iqm.jobs"
+    with StateReader(path_state) as state:
+        pairs = state.pairs()
+    write_jobs_file(path_jobs, list(zip(pairs['seg1'][:50], pairs['seg2'][:50])))
+
+    settings = {'max_distance': 0.25}
+    expression = run(screen_iqm_jobs("1-40", path_state, settings), 'serial')
+    kept = {frozenset(x) for x in screen_pairs(path_state, settings)}
+    expected = {i + 1 for i in range(40)
+                if frozenset((pairs['seg1'][i], pairs['seg2'][i])) in kept}
+
+    assert select_jobs(JobIndex.load(path_jobs), expression) == expected
+
+
+def two_frames_state(tmp_path: Path) -> Path:
+    """Copy of the state with a second frame whose atoms are further apart."""
+    path = tmp_path / "state.sql"
+    shutil.copy(path_state.as_posix(), path.as_posix())
+    with sqlite3.connect(path.as_posix()) as conn:
+        for table in ("frames", "segments", "atoms", "pairs"):
+            columns = [x[1] for x in conn.execute("PRAGMA table_info({})".format(table))
+                       if x[1] != '_id']
+            frame_column = 'id' if table == 'frames' else 'frame'
+            values = ['1' if x == frame_column else x for x in columns]
+            if table == 'atoms':
+                values = ["{} * 1.5".format(x) if x.startswith('pos') else x for x in values]
+            conn.execute("INSERT INTO {0} ({1}) SELECT {2} FROM {0} WHERE {3} = 0".format(
+                table, ", ".join(columns), ", ".join(values), frame_column))
+
+    return path
+
+
+def test_two_frames(tmp_path):
+    """Check that the pairs are matched with the segments and atoms of their frame."""
+    path = two_frames_state(tmp_path)
+    with StateReader(path) as state:
+        segments, pairs, atoms = state.segments(), state.pairs(), state.atoms()
+    metrics = pair_metrics(segments, pairs, atoms)
+
+    for frame in (0, 1):
+        with StateReader(path, frame) as state:
+            expected = pair_metrics(state.segments(), state.pairs(), state.atoms())
+        selected = pairs['frame'] == frame
+        assert np.allclose(metrics['min_distance'][selected], expected['min_distance'])
+    assert not np.allclose(metrics['min_distance'][pairs['frame'] == 0],
+                           metrics['min_distance'][pairs['frame'] == 1])
+
+    with pytest.raises(RuntimeError):
+        screen_pairs(path, {'max_distance': 0.25})
+    assert screen_pairs(path, {'max_distance': 0.25, 'frame': 0}) == screen_pairs(
+        path_state, {'max_distance': 0.25})
+    assert len(screen_pairs(path, {'max_distance': 0.25, 'frame': 1})) < len(
+        screen_pairs(path, {'max_distance': 0.25, 'frame': 0}))
@@ -0,0 +1,100 @@
+import os
+import threading
+import time
+from xtp_job_control.process_control import cancel_process, run_process
+from xtp_job_control.resources import ResourcePool
+from xtp_job_control.runner import run
+from xtp_job_control.workflows.workflow_components import run_parallel_jobs
+
+# Stand-in for xtp_parallel that hangs in the workdir of the 4th job, it needs
+# the OR_FILES folder and marks the jobs of the job_file of the options
+FAKE_SLOW_XTP = """#!/bin/sh
+case "$PWD" in
+  *job_4) sleep 60;;
+esac
+while [ "$1" != "-o" ]; do shift; done
+job_file=$(sed -n 's:.*<job_file>\\(.*\\)</job_file>.*:\\1:p' "$2")
+test -f OR_FILES/molecules || exit 1
+echo "COMPLETE $(basename "$PWD")" > "$job_file"
+echo "$@" > job.tab
+"""
+
+
+def is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    # Reaped zombies are not reported, check the state of the process
+    with open("/proc/{}/stat".format(pid)) as f:
+        return f.read().split()[2] != 'Z'
+
+
+def test_timeout(tmp_path):
+    """Check that the whole process group is stopped after the timeout."""
+    start = time.monotonic()
+    code = run_process("sleep 60 & echo $! > child.pid; wait", tmp_path, timeout=1,
+                       kill_signal='INT', kill_grace=1)
+
+    assert code != 0
+    assert time.monotonic() - start < 10
+    time.sleep(0.2)
+    assert not is_running(int((tmp_path / "child.pid").read_text()))
+
+
+def test_cancel_process(tmp_path):
+    """Check that a command can be stopped from another thread."""
+    timer = threading.Timer(0.5, cancel_process, args=(tmp_path,))
+    timer.start()
+    start = time.monotonic()
+    code = run_process("sleep 60", tmp_path, kill_grace=1)
+
+    assert code != 0
+    assert time.monotonic() - start < 10
+    assert not cancel_process(tmp_path)
+
+
+def test_speculative_copy(tmp_path, monkeypatch):
+    """Check that a copy of a hanging chunk replaces it."""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    fake = bin_dir / "xtp_parallel"
+    fake.write_text(FAKE_SLOW_XTP)
+    fake.chmod(0o755)
+    monkeypatch.setenv("PATH", "{}:{}".format(bin_dir, os.environ["PATH"]))
+    monkeypatch.setattr(
+        "xtp_job_control.workflows.workflow_components.SPECULATION_INTERVAL", 0.1)
+    # Enough cores to run the copy next to the hanging chunk
+    monkeypatch.setattr("xtp_job_control.resources._POOL", ResourcePool(cores=4))
+
+    (tmp_path / "OR_FILES").mkdir()
+    (tmp_path / "OR_FILES" / "molecules").touch()
+    dict_jobs = {}
+    for idx in ("1", "2", "3", "4"):
+        workdir = tmp_path / "job_{}".format(idx)
+        workdir.mkdir()
+        (workdir / "eqm.xml").write_text(
+            "<options><eqm><job_file>{}</job_file></eqm></options>".format(workdir / "job.xml"))
+        (workdir / "job.xml").write_text("AVAILABLE")
+        os.symlink(tmp_path / "OR_FILES", workdir / "OR_FILES")
+        dict_jobs[idx] = {'workdir': workdir, 'eqm': workdir / 'eqm.xml'}
+
+    dict_input = {
+        'name': 'eqm', 'state': tmp_path / 'state.sql', 'scratch_dir': tmp_path,
+        'max_workers': 2, 'threads': 1, 'cmd_options': "-s 0 -j run",
+        'expected_output': {'tab': 'job.tab'}, 'speculation': 2}
+
+    start = time.monotonic()
+    rs = run(run_parallel_jobs(dict_jobs, dict_input), 'serial')
+
+    assert time.monotonic() - start < 30
+    assert rs['4']['tab'] == (tmp_path / "job_4" / "job.tab").as_posix()
+    # The output of the copy is moved to the workdir of the chunk
+    assert "job_4_speculative/eqm.xml" in (tmp_path / "job_4" / "job.tab").read_text()
+    assert not (tmp_path / "job_4_speculative").exists()
+    # The copy updates its own job file, which points back to the workdir of the chunk
+    workdir = tmp_path / "job_4"
+    assert (workdir / "job.xml").read_text().strip() == "COMPLETE job_4_speculative"
+    assert "<job_file>{}</job_file>".format(workdir / "job.xml") in (
+        workdir / "eqm.xml").read_text()
+    assert os.readlink(workdir / "OR_FILES") == (tmp_path / "OR_FILES").as_posix()
@@ -0,0 +1,47 @@
+import os
+import threading
+import time
+from xtp_job_control.resources import (ResourcePool, configure_resource_pool,
+                                       task_resources)
+from xtp_job_control.workflows.workflow_components import run_command
+
+
+def test_resource_pool():
+    """Check that the commands do not exceed the capacity of the node."""
+    pool = ResourcePool(cores=4, memory=1000)
+    running = []
+    peak = {'cores': 0, 'memory': 0}
+    lock = threading.Lock()
+
+    def task(cores, memory):
+        with pool.acquire(task_resources(cores, memory)) as allocation:
+            with lock:
+                running.append(allocation)
+                peak['cores'] = max(peak['cores'], sum(x['cores'] for x in running))
+                peak['memory'] = max(peak['memory'], sum(x['memory'] for x in running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(allocation)
+
+    requests = [(3, 100), (2, 100), (1, 100), (1, 800), (8, 100)]
+    threads = [threading.Thread(target=task, args=r) for r in requests]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert peak['cores'] <= 4
+    assert peak['memory'] <= 1000
+    assert pool.free_cores == 4 and pool.free_memory == 1000
+
+
+def test_command_environment(tmp_path):
+    """Check that the commands run with the allocated cores."""
+    cpus = sorted(os.sched_getaffinity(0))
+    configure_resource_pool(cores=len(cpus))
+    cmd = ('echo $OMP_NUM_THREADS > omp.txt; '
+           'python -c "import os; print(len(os.sched_getaffinity(0)))" > cpus.txt')
+    run_command(cmd, tmp_path, resources=task_resources(1))
+
+    assert (tmp_path / "omp.txt").read_text().strip() == "1"
+    assert (tmp_path / "cpus.txt").read_text().strip() == "1"
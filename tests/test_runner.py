@@ -1,5 +1,6 @@
 from xtp_job_control.runner import run
-from xtp_job_control.workflows.workflow_components import (call_xtp_cmd, create_promise_command)
+from xtp_job_control.workflows.workflow_components import (
+    call_xtp_cmd, command_log_name, create_promise_command, read_tail, run_command)
 
 
 def test_runner(tmp_path):
@@ -19,3 +20,24 @@ def test_runner(tmp_path):
             xs = f.read()
 
         assert len(xs) == 50
+
+
+def test_command_logs(tmp_path):
+    """Check that the output of a command is streamed to its log files."""
+    run_command("echo hello && echo oops >&2", tmp_path)
+
+    assert (tmp_path / "echo.stdout").read_text() == "hello\n"
+    assert read_tail(tmp_path / "echo.stderr", size=3) == "ps\n"
+    assert command_log_name("xtp_parallel -e eqm -o eqm.xml") == "xtp_parallel_eqm"
+
+
+def test_stage_out(tmp_path):
+    """Check that the output is copied to the persistent folder."""
+    scratch_dir = tmp_path / "scratch"
+    stage_out = {'scratch_dir': scratch_dir, 'destination': tmp_path / "workdir"}
+    job = call_xtp_cmd("echo 42 > out.txt", scratch_dir / "job",
+                       expected_output={"out": "out.txt"}, stage_out=stage_out)
+    scratch_dir.mkdir()
+    run(job, 'serial')
+
+    assert (tmp_path / "workdir" / "job" / "out.txt").read_text() == "42\n"
@@ -0,0 +1,106 @@
+import os
+import pytest
+from pathlib import Path
+from xtp_job_control.batch import BatchScheduler
+from xtp_job_control.runner import run
+from xtp_job_control.workflows.workflow_components import run_parallel_jobs
+
+# Stand-in for sbatch running the scripts in the background
+FAKE_SBATCH = """#!/bin/sh
+script=$2
+id=$$
+last=$(sed -n 's/^#SBATCH --array=0-\\([0-9]*\\)$/\\1/p' "$script")
+if [ -z "$last" ]; then
+  bash "$script" > /dev/null 2>&1 &
+  echo $! > {jobs}/$id
+else
+  for i in $(seq 0 $last); do
+    SLURM_ARRAY_TASK_ID=$i bash "$script" > /dev/null 2>&1 &
+    echo $! >> {jobs}/$id
+  done
+fi
+echo $id
+"""
+
+# Stand-in for squeue reporting the jobs with a running process
+FAKE_SQUEUE = """#!/bin/sh
+for pid in $(cat {jobs}/$3); do
+  if kill -0 $pid 2> /dev/null; then
+    echo "$3 RUNNING"
+    exit 0
+  fi
+done
+"""
+
+
+def create_fake_scheduler(tmp_path: Path, monkeypatch) -> None:
+    """Create the sbatch, squeue and scancel shims."""
+    bin_dir = tmp_path / "bin"
+    jobs = tmp_path / "scheduler_jobs"
+    bin_dir.mkdir()
+    jobs.mkdir()
+    for name, content in (("sbatch", FAKE_SBATCH), ("squeue", FAKE_SQUEUE),
+                          ("scancel", "#!/bin/sh\n")):
+        shim = bin_dir / name
+        shim.write_text(content.format(jobs=jobs))
+        shim.chmod(0o755)
+    monkeypatch.setenv("PATH", "{}:{}".format(bin_dir, os.environ["PATH"]))
+
+
+@pytest.mark.parametrize("array", [False, True])
+def test_batch_scheduler(tmp_path, monkeypatch, array):
+    """Check that the packed commands are run through the scheduler."""
+    create_fake_scheduler(tmp_path, monkeypatch)
+    tasks = []
+    for i in range(5):
+        workdir = tmp_path / "job_{}".format(i)
+        workdir.mkdir()
+        cmd = "exit 3" if i == 4 else "echo {} > out.txt".format(i)
+        tasks.append((cmd, workdir))
+
+    settings = {'scheduler': 'slurm', 'jobs_per_allocation': 2, 'array': array,
+                'header': ["#SBATCH -t 00:10:00"], 'poll_interval': 0.1}
+    scheduler = BatchScheduler(settings, tmp_path / "batch")
+    codes = scheduler.run(tasks, 'test')
+
+    assert codes == [0, 0, 0, 0, 3]
+    for i in range(4):
+        assert (tmp_path / "job_{}".format(i) / "out.txt").read_text().strip() == str(i)
+    # Three batch jobs or a single job array
+    assert len(list((tmp_path / "scheduler_jobs").iterdir())) == (1 if array else 3)
+
+
+def test_batch_parallel_jobs(tmp_path, monkeypatch):
+    """Check that the split jobs are submitted to the batch scheduler."""
+    create_fake_scheduler(tmp_path, monkeypatch)
+    fake = tmp_path / "bin" / "xtp_parallel"
+    fake.write_text('#!/bin/sh\necho "$@" > job.tab\n')
+    fake.chmod(0o755)
+
+    dict_jobs = {}
+    for idx in ("1", "2", "3"):
+        workdir = tmp_path / "job_{}".format(idx)
+        workdir.mkdir()
+        dict_jobs[idx] = {'workdir': workdir, 'eqm': workdir / 'eqm.xml'}
+
+    dict_input = {
+        'name': 'eqm', 'state': tmp_path / 'state.sql', 'scratch_dir': tmp_path,
+        'threads': 1, 'cmd_options': "-s 0 -j run", 'expected_output': {'tab': 'job.tab'},
+        'batch': {'jobs_per_allocation': 2, 'array': True, 'poll_interval': 0.1}}
+
+    rs = run(run_parallel_jobs(dict_jobs, dict_input), 'serial')
+
+    for idx in ("1", "2", "3"):
+        assert Path(rs[idx]['tab']).exists()
+    assert (tmp_path / "batch" / "eqm.sh").exists()
+
+
+def test_poll_failure(tmp_path):
+    """Check that a failing poll command does not finish the batch jobs."""
+    def is_active(poll: str) -> bool:
+        return BatchScheduler({'poll': poll}, tmp_path / "batch").is_active("42")
+
+    assert is_active("echo 42 RUNNING")
+    assert not is_active("true")
+    assert is_active("echo 'Unable to contact slurm controller' >&2; exit 1")
+    assert not is_active("echo 'slurm_load_jobs error: Invalid job id specified' >&2; exit 1")
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+from pathlib import Path
+from xtp_job_control.state_reader import StateReader, plan_jobs
+
+path_state = Path("tests/KMC/state.sql")
+
+
+def test_state_reader():
+    """Check that the tables of the state are read into arrays."""
+    with StateReader(path_state) as state:
+        segments = state.segments()
+        pairs = state.pairs()
+        atoms = state.atoms()
+        frames = state.frames()
+        types = state.segment_types()
+
+    assert segments['pos'].shape == (1000, 3)
+    assert set(segments['name']) == {'Methane'}
+    assert pairs['dr'].shape == (2933, 3)
+    assert np.allclose(pairs['distance'], np.sqrt((pairs['dr'] ** 2).sum(axis=1)))
+    assert np.isin(pairs['seg1'], segments['id']).all()
+    assert atoms['pos'].shape == (5000, 3)
+    assert np.all(np.diff(atoms['seg']) >= 0)
+    assert frames['box'].shape == (len(frames['id']), 3, 3)
+    assert len(types['id']) > 0
+
+
+def test_select_frame():
+    """Check that the tables are read for a single frame."""
+    with StateReader(path_state) as state:
+        frames = state.frames()
+    with StateReader(path_state, frame=int(frames['id'][0])) as state:
+        selected = state.frames()
+        segments = state.segments()
+    with StateReader(path_state, frame=-1) as state:
+        assert len(state.frames()['id']) == 0
+
+    assert selected['id'].tolist() == [frames['id'][0]]
+    assert selected['box'].shape == (1, 3, 3)
+    assert len(segments['id']) == 1000
+
+
+def test_plan_jobs():
+    """Check that the jobs are counted without calling xtp."""
+    assert plan_jobs(path_state) == {'eqm': 1000, 'iqm': 2933, 'atoms': 5000}
+    assert plan_jobs(path_state, frame=-1) == {'eqm': 0, 'iqm': 0, 'atoms': 0}
+
+    with StateReader(path_state) as state:
+        with pytest.raises(RuntimeError):
+            state.count_jobs('kmc')
+
+    with pytest.raises(RuntimeError):
+        StateReader("tests/KMC/missing.sql")
@@ -0,0 +1,55 @@
+from pathlib import Path
+
+from xtp_job_control.runner import run
+from xtp_job_control.workflows.workflow_components import call_xtp_cmd, run_cached_command
+
+
+def test_task_cache(tmp_path):
+    """Check that a command with identical input is not run twice."""
+    cache_dir = tmp_path / "cache"
+    outputs = []
+    for ts in ("2020-01-01T10:00:00.1", "2020-01-02T11:00:00.2"):
+        workdir = tmp_path / "xtp_{}".format(ts) / "job"
+        workdir.mkdir(parents=True)
+        (workdir / "input.xml").write_text("<options>{}</options>".format(workdir.parent))
+
+        cmd = "cat input.xml > out.txt && date +%s%N >> out.txt"
+        job = call_xtp_cmd(
+            cmd, workdir, expected_output={"out": "out.txt"}, cache_dir=cache_dir)
+        rs = run(job, 'serial')
+        with open(rs["out"], 'r') as f:
+            outputs.append(f.read())
+
+    assert outputs[0] == outputs[1]
+
+
+def test_state_not_cached(tmp_path):
+    """Check that the commands writing the state are always run."""
+    cache_dir = tmp_path / "cache"
+    cmd = "date +%s%N >> state.sql"
+    for _ in range(2):
+        rs = run(call_xtp_cmd(
+            cmd, tmp_path, expected_output={"state": "state.sql"}, cache_dir=cache_dir), 'serial')
+
+    with open(rs["state"], 'r') as f:
+        assert len(f.readlines()) == 2
+    assert not cache_dir.exists()
+
+
+def test_snapshot_and_job_file(tmp_path):
+    """Check that the name of the state copy is not hashed and the job file is restored."""
+    cache_dir = tmp_path / "cache"
+    workdir = tmp_path / "job"
+    workdir.mkdir()
+    for snapshot in ("xtp_state_{}_{}.sql".format("0" * 16, "1" * 16),
+                     "xtp_state_{}_{}.sql".format("2" * 16, "3" * 16)):
+        (workdir / "job.xml").write_text("<jobs><job><status>AVAILABLE</status></job></jobs>")
+        cmd = "echo {} > /dev/null && sed -i s/AVAILABLE/COMPLETE/ job.xml && ".format(snapshot)
+        cmd += "date +%s%N > out.txt"
+        output = run_cached_command(
+            cmd, workdir, expected_output={"out": "out.txt"}, cache_dir=cache_dir,
+            cached_files=["job.xml"])
+        assert "COMPLETE" in (workdir / "job.xml").read_text()
+
+    assert len(list(cache_dir.iterdir())) == 1
+    assert Path(output["out"]).exists()
@@ -1,5 +1,6 @@
 from xtp_job_control.xml_editor import (
-    edit_xml_job_file, edit_xml_options, read_available_jobs)
+    OptionSet, add_absolute_path_to_options, edit_xml_job_file, edit_xml_options, iter_jobs,
+    merge_job_files, read_available_jobs)
 from pathlib import Path
 import shutil
 import xml.etree.ElementTree as ET
@@ -46,3 +47,69 @@ def test_xml_options(tmp_path):
     edit_xml_options(sections_to_edit, tmp_path)
 
     assert read_xml_val(path_file, "neighborlist/constant") == "0.6"
+
+
+def test_iter_jobs(tmp_path):
+    """Check that the jobs are streamed from the file."""
+    file_path = copy_to_tmp(Path("tests/test_files/eqm.jobs"), tmp_path)
+    edit_xml_job_file(file_path.as_posix(), [5, 7])
+
+    ids = [job.find('id').text for job in iter_jobs(file_path.as_posix(), "AVAILABLE")]
+
+    assert ids == ['5', '7']
+    assert sum(1 for _ in iter_jobs(file_path.as_posix())) == 1000
+
+
+def test_option_set(tmp_path):
+    """
+    Test that the edits of an option file are applied in memory
+    """
+    path_file = copy_to_tmp(Path("tests/test_files/neighborlist.xml"), tmp_path)
+    (tmp_path / "cutoffs.xml").write_text("<options></options>")
+
+    with OptionSet(tmp_path) as option_set:
+        option_set.edit("neighborlist", {"constant": "cutoffs.xml"})
+        option_set.edit("neighborlist", {"segments": {"cutoff": 4}})
+        option_set.add_absolute_paths("neighborlist")
+        # Nothing is written before flushing
+        assert read_xml_val(path_file, "neighborlist/constant") == "1.5"
+
+    assert read_xml_val(path_file, "neighborlist/constant") == (tmp_path / "cutoffs.xml").as_posix()
+    assert read_xml_val(path_file, "neighborlist/segments/cutoff") == "4"
+
+
+def test_absolute_paths(tmp_path):
+    """
+    Test that the option file names are replaced in several files
+    """
+    files = [tmp_path / "{}.xml".format(x) for x in ("a", "b")]
+    for path in files:
+        path.write_text("<options><x><y>c.xml</y></x></options>")
+
+    add_absolute_path_to_options([x.as_posix() for x in files], tmp_path)
+    assert read_xml_val(files[0], "x/y") == "c.xml"
+
+    # A new option file is added to the folder
+    (tmp_path / "c.xml").write_text("<options></options>")
+    add_absolute_path_to_options([x.as_posix() for x in files], tmp_path)
+
+    assert all(read_xml_val(x, "x/y") == (tmp_path / "c.xml").as_posix() for x in files)
+
+
+def test_merge_job_files(tmp_path):
+    """Check that the results of the chunks replace the jobs in the job file."""
+    file_path = copy_to_tmp(Path("tests/test_files/eqm.jobs"), tmp_path)
+    chunk = tmp_path / "job.xml"
+    chunk.write_text(
+        "<jobs>" + "".join(
+            "<job><id>{0}</id><input/><status>COMPLETE</status>"
+            "<output><energy>{0}</energy></output></job>".format(i) for i in (2, 5)) + "</jobs>")
+
+    merge_job_files(file_path.as_posix(), [chunk.as_posix()])
+
+    jobs = {int(job.find('id').text): job for job in iter_jobs(file_path)}
+    assert len(jobs) == 1000
+    assert jobs[5].find('status').text == "COMPLETE"
+    assert jobs[5].find('output/energy').text == "5"
+    assert jobs[1].find('status').text == "AVAILABLE"
+    assert len(read_available_jobs(file_path)) == 998
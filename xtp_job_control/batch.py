@@ -0,0 +1,233 @@
+"""Run groups of xtp commands through a batch scheduler (SLURM, PBS, etc.).
+
+The commands are written into batch scripts that are submitted, polled and
+cancelled using command templates, so any scheduler with a command line
+interface can be plugged in. Several short commands are packed into each
+batch job (`jobs_per_allocation`) and the batch jobs can be submitted as a
+single job array (`array`) to keep the overhead of the scheduler low.
+
+Each command writes its exit code to a marker file in its workdir, which is
+used to check which commands finished once the scheduler reports that the
+batch jobs are gone. Therefore the scratch folder must be in a filesystem
+shared by the node running the workflow and the compute nodes.
+"""
+
+__all__ = ["BatchScheduler", "SCHEDULERS"]
+
+import logging
+import re
+import subprocess
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+#: Command templates of the supported schedulers
+SCHEDULERS = {
+    'slurm': {
+        'submit': "sbatch --parsable {script}",
+        'poll': "squeue -h -j {job_id}",
+        'cancel': "scancel {job_id}",
+        'array_directive': "#SBATCH --array=0-{last}",
+        'array_index': "$SLURM_ARRAY_TASK_ID",
+        'job_id': r"(\d+)",
+        'unknown_job': r"Invalid job id",
+    },
+    'pbs': {
+        'submit': "qsub {script}",
+        'poll': "qstat {job_id}",
+        'cancel': "qdel {job_id}",
+        'array_directive': "#PBS -J 0-{last}",
+        'array_index': "$PBS_ARRAY_INDEX",
+        'job_id': r"^(\S+)",
+        'unknown_job': r"Unknown Job Id",
+    }
+}
+
+#: A command and the folder where it runs
+Task = Tuple[str, Path]
+
+
+class BatchScheduler:
+    """Submit commands to a batch scheduler and wait for them.
+
+    `settings` selects the `scheduler` (a key of `SCHEDULERS`), whose
+    templates can be overridden with the keys of the templates (`submit`,
+    `poll`, `cancel`, etc.). The other keys are:
+
+    * `jobs_per_allocation`: commands packed in each batch job.
+    * `array`: submit all the batch jobs as a job array.
+    * `header`: list of scheduler directives, e.g. ``["#SBATCH -t 01:00:00"]``.
+    * `setup`: shell lines run before the commands, e.g. ``module load votca``.
+    * `poll_interval`: seconds between the queries to the scheduler.
+    """
+
+    def __init__(self, settings: dict, script_dir: Path):
+        settings = check_batch_settings(settings)
+        templates = SCHEDULERS[settings.get('scheduler', 'slurm').lower()].copy()
+        templates.update({k: v for k, v in settings.items() if k in templates})
+        self.templates = templates
+        self.jobs_per_allocation = max(1, int(settings.get('jobs_per_allocation', 1)))
+        self.use_array = bool(settings.get('array', False))
+        self.header = list(settings.get('header', []))
+        self.setup = settings.get('setup', '')
+        self.poll_interval = float(settings.get('poll_interval', 30))
+        self.script_dir = Path(script_dir)
+        self.script_dir.mkdir(parents=True, exist_ok=True)
+
+    def run(self, tasks: List[Task], name: str = 'xtp') -> List[Optional[int]]:
+        """Run the `tasks` and return their exit codes (`None` if a task did not finish)."""
+        if not tasks:
+            return []
+
+        for _, workdir in tasks:
+            try:
+                exit_file(workdir, name).unlink()
+            except FileNotFoundError:
+                pass
+
+        groups = [tasks[i: i + self.jobs_per_allocation]
+                  for i in range(0, len(tasks), self.jobs_per_allocation)]
+        if self.use_array:
+            scripts = [self.write_script(name, groups, name)]
+        else:
+            scripts = [self.write_script(name, [group], "{}_{}".format(name, i))
+                       for i, group in enumerate(groups)]
+
+        job_ids = [self.submit(script) for script in scripts]
+        try:
+            self.wait(job_ids)
+        except BaseException:
+            self.cancel(job_ids)
+            raise
+
+        return [read_exit_code(workdir, name) for _, workdir in tasks]
+
+    def write_script(self, name: str, groups: List[List[Task]], script_name: str) -> Path:
+        """Write the batch script `script_name` running the `groups` of tasks of `name`.
+
+        A script with several groups is a job array, where each index of
+        the array runs a single group.
+        """
+        lines = ["#!/bin/bash"] + self.header
+        if self.use_array:
+            lines.append(self.templates['array_directive'].format(last=len(groups) - 1))
+        lines.append(self.setup)
+
+        if self.use_array:
+            lines.append('case "{}" in'.format(self.templates['array_index']))
+            for i, group in enumerate(groups):
+                lines.append("{})".format(i))
+                lines.extend(task_lines(group, name))
+                lines.append(";;")
+            lines.append("esac")
+        else:
+            lines.extend(task_lines(groups[0], name))
+
+        script = self.script_dir / "{}.sh".format(script_name)
+        script.write_text("\n".join(lines) + "\n")
+        script.chmod(0o755)
+
+        return script
+
+    def submit(self, script: Path) -> str:
+        """Submit `script` returning the identifier of the batch job."""
+        cmd = self.templates['submit'].format(script=script.as_posix())
+        out = self.call(cmd)
+        match = re.search(self.templates['job_id'], out.strip(), re.M)
+        if match is None:
+            raise RuntimeError("Cannot read the job id submitting {}:\n{}".format(script, out))
+        logger.info("SUBMITTED BATCH JOB {}: {}".format(match.group(1), script))
+
+        return match.group(1)
+
+    def wait(self, job_ids: List[str]) -> None:
+        """Wait until the scheduler does not report the `job_ids` anymore."""
+        pending = list(job_ids)
+        while pending:
+            time.sleep(self.poll_interval)
+            pending = [x for x in pending if self.is_active(x)]
+
+    def is_active(self, job_id: str) -> bool:
+        """Check if the batch job `job_id` is still queued or running.
+
+        The job has finished if the poll command succeeds without output, or
+        if it fails reporting that the job is unknown (`unknown_job`). Other
+        failures (e.g. the controller is not responding) are logged and the
+        job is considered active until the next poll.
+        """
+        cmd = self.templates['poll'].format(job_id=job_id)
+        p = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                           cwd=self.script_dir.as_posix())
+        if p.returncode == 0:
+            return bool(p.stdout.strip())
+        error = p.stderr.decode(errors='replace')
+        if re.search(self.templates['unknown_job'], error):
+            return False
+        logger.warning("CANNOT POLL BATCH JOB {} (exit code {}): {}".format(
+            job_id, p.returncode, error.strip()))
+        return True
+
+    def cancel(self, job_ids: List[str]) -> None:
+        """Cancel the `job_ids`."""
+        for job_id in job_ids:
+            logger.info("CANCELLING BATCH JOB {}".format(job_id))
+            subprocess.run(self.templates['cancel'].format(job_id=job_id), shell=True,
+                           cwd=self.script_dir.as_posix())
+
+    def call(self, cmd: str) -> str:
+        """Run a command of the scheduler returning its output."""
+        p = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                           cwd=self.script_dir.as_posix())
+        if p.returncode != 0:
+            raise RuntimeError("Command {} failed:\n{}".format(cmd, p.stderr.decode()))
+
+        return p.stdout.decode()
+
+
+def task_lines(tasks: List[Task], name: str) -> List[str]:
+    """Shell lines running the `tasks` one after the other.
+
+    The output of each command is appended to the log files of the command
+    in its workdir and the exit code is written to a marker file.
+    """
+    from .workflows.workflow_components import command_log_name
+
+    lines = []
+    for cmd, workdir in tasks:
+        log = command_log_name(cmd)
+        lines.append(
+            "(cd '{0}' && ( {1} ) >> {2}.stdout 2>> {2}.stderr < /dev/null; "
+            "echo $? > '{3}')".format(
+                Path(workdir).as_posix(), cmd, log, exit_file(workdir, name).as_posix()))
+
+    return lines
+
+
+def exit_file(workdir: Path, name: str) -> Path:
+    """File storing the exit code of a command run by a batch job."""
+    return Path(workdir) / ".{}.exit".format(name)
+
+
+def read_exit_code(workdir: Path, name: str) -> Optional[int]:
+    """Exit code of the command run in `workdir`, `None` if it did not finish."""
+    path = exit_file(workdir, name)
+    try:
+        return int(path.read_text().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def check_batch_settings(settings: Optional[dict]) -> Dict:
+    """Check the keys of the batch `settings`."""
+    settings = dict(settings or {})
+    known = set(SCHEDULERS['slurm']) | {
+        'scheduler', 'array', 'jobs_per_allocation', 'header', 'setup', 'poll_interval'}
+    unknown = set(settings) - known
+    if unknown:
+        raise RuntimeError("Unknown batch settings: {}".format(unknown))
+    if settings.get('scheduler', 'slurm').lower() not in SCHEDULERS:
+        raise RuntimeError("Unknown batch scheduler: {}".format(settings['scheduler']))
+
+    return settings
@@ -0,0 +1,140 @@
+"""Content addressed store for the input files copied to the scratch folders.
+
+Every input file is hashed and stored once under the root of the store.
+The files are then placed in the scratch folders using hard links, or
+reflinks (copy-on-write clones) when the file may be modified by the
+calculators, falling back to plain copies when the filesystem does not
+support them. The hash of a file is remembered using its path, size and
+modification time, therefore unchanged inputs are not read again.
+"""
+
+__all__ = ["ContentStore"]
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import stat
+import tempfile
+from pathlib import Path
+from threading import Lock
+from typing import Union
+
+logger = logging.getLogger(__name__)
+
+# ioctl request to clone a file on Linux (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+
+class ContentStore:
+    """Store of input files indexed by the hash of their content."""
+
+    def __init__(self, root: Union[str, Path]):
+        self.root = Path(root)
+        self.objects = self.root / 'objects'
+        self.objects.mkdir(parents=True, exist_ok=True)
+        self.path_hashes = self.root / 'hashes.json'
+        self.lock = Lock()
+        if self.path_hashes.exists():
+            with open(self.path_hashes, 'r') as f:
+                self.hashes = json.load(f)
+        else:
+            self.hashes = {}
+
+    def stage(self, src: Path, dst: Path, mutable: bool = False) -> Path:
+        """Place the file or folder `src` at `dst`.
+
+        The files of a `mutable` input are never hard linked, since the
+        calculators would modify the stored object.
+        """
+        src = Path(src)
+        if src.is_dir():
+            for path in src.rglob('*'):
+                if path.is_file():
+                    self.place(path, Path(dst) / path.relative_to(src), mutable)
+        else:
+            self.place(src, Path(dst), mutable)
+        self.save()
+
+        return Path(dst)
+
+    def place(self, src: Path, dst: Path, mutable: bool = False) -> None:
+        """Place the single file `src` at `dst`."""
+        obj = self.put(src)
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        if dst.exists():
+            dst.unlink()
+
+        if not mutable:
+            try:
+                os.link(obj.as_posix(), dst.as_posix())
+                return
+            except OSError:
+                pass
+
+        if not reflink(obj, dst):
+            shutil.copyfile(obj.as_posix(), dst.as_posix())
+            os.chmod(dst.as_posix(), stat.S_IMODE(os.stat(src).st_mode))
+
+    def put(self, path: Path) -> Path:
+        """Store `path` if its content is not in the store yet."""
+        digest = self.hash(path)
+        obj = self.objects / digest[:2] / digest
+        if not obj.exists():
+            obj.parent.mkdir(exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=obj.parent.as_posix())
+            os.close(fd)
+            shutil.copyfile(Path(path).as_posix(), tmp)
+            # Objects are shared by hard links, they must not be modified
+            os.chmod(tmp, 0o444)
+            os.replace(tmp, obj.as_posix())
+            logger.info("STORED INPUT: {} as {}".format(path, digest))
+
+        return obj
+
+    def hash(self, path: Path) -> str:
+        """Compute the hash of `path`, reusing the result if the file did not change."""
+        path = Path(path).absolute()
+        info = os.stat(path)
+        key = path.as_posix()
+        stamp = [info.st_size, info.st_mtime_ns]
+        with self.lock:
+            known = self.hashes.get(key)
+        if known is not None and known['stamp'] == stamp:
+            return known['hash']
+
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+
+        with self.lock:
+            self.hashes[key] = {'stamp': stamp, 'hash': digest.hexdigest()}
+        return digest.hexdigest()
+
+    def save(self) -> None:
+        """Persist the known hashes of the input files."""
+        with self.lock:
+            fd, tmp = tempfile.mkstemp(dir=self.root.as_posix())
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.hashes, f)
+            os.replace(tmp, self.path_hashes.as_posix())
+
+
+def reflink(src: Path, dst: Path) -> bool:
+    """Try to clone `src` into `dst` sharing the data blocks."""
+    try:
+        import fcntl
+    except ImportError:
+        return False
+
+    try:
+        with open(src, 'rb') as f_src, open(dst, 'wb') as f_dst:
+            fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+        os.chmod(dst.as_posix(), 0o644)
+        return True
+    except OSError:
+        if dst.exists():
+            dst.unlink()
+        return False
@@ -0,0 +1,182 @@
+"""Estimate the cost of the split jobs to run the most expensive ones first.
+
+The chunks of jobs are dispatched in order of decreasing estimated cost
+(longest processing time first), so that a large segment or pair does not
+start when the other workers are about to become idle. The `cost_model`
+option selects the estimator:
+
+* ``atoms`` (default): the number of atoms of the segments of the job, read
+  from the state, to the third power (the scaling of DFT).
+* ``history``: the runtimes recorded in the `runtime_history` file by
+  previous runs, for the same calculator and segments. The jobs without
+  records are estimated with the ``atoms`` model, rescaled to seconds.
+* ``uniform``: every job has the same cost, keeping the order of the job file.
+
+New estimators can be added with :func:`register_cost_model`.
+"""
+
+__all__ = ["AtomCountCost", "RuntimeHistory", "UniformCost", "create_cost_model",
+           "order_chunks", "register_cost_model", "runtime_recorder"]
+
+import json
+import logging
+import sqlite3
+from pathlib import Path
+from statistics import median
+from threading import Lock
+from typing import Callable, Dict, List, Optional, Sequence, Union
+
+from .state_reader import StateReader
+
+logger = logging.getLogger(__name__)
+
+# Runtimes shorter than this (e.g. results restored from the cache) are not recorded
+MIN_RECORDED_RUNTIME = 1
+
+
+class UniformCost:
+    """Every job costs the same."""
+
+    def job_cost(self, name: str, segments: Sequence[int]) -> float:
+        return 1.0
+
+
+class AtomCountCost:
+    """Cost proportional to the number of atoms of the segments to the power `exponent`."""
+
+    def __init__(self, path_state: Union[str, Path], exponent: float = 3):
+        self.exponent = exponent
+        with StateReader(path_state) as state:
+            ids, counts = state.atoms_per_segment()
+        self.atoms = dict(zip(ids.tolist(), counts.tolist()))
+
+    def job_cost(self, name: str, segments: Sequence[int]) -> float:
+        return float(sum(self.atoms.get(s, 1) for s in segments) or 1) ** self.exponent
+
+
+class RuntimeHistory:
+    """Runtimes of the jobs, appended as JSON lines to the file at `path`.
+
+    The jobs that have not been recorded are estimated using the `fallback`
+    model, rescaled with the median ratio between the recorded runtimes
+    and the estimates of the `fallback`.
+    """
+
+    def __init__(self, path: Union[str, Path], fallback: object = None):
+        self.path = Path(path)
+        self.fallback = UniformCost() if fallback is None else fallback
+        self.lock = Lock()
+        self.runtimes = {}
+        if self.path.exists():
+            with open(self.path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    key = history_key(record['name'], record['segments'])
+                    self.runtimes.setdefault(key, []).append(record['seconds'])
+        self.scale = None
+
+    def job_cost(self, name: str, segments: Sequence[int]) -> float:
+        runtimes = self.runtimes.get(history_key(name, segments))
+        if runtimes:
+            return median(runtimes)
+
+        return self.fallback_scale() * self.fallback.job_cost(name, segments)
+
+    def fallback_scale(self) -> float:
+        """Ratio between the recorded runtimes and the estimates of the fallback."""
+        if self.scale is None:
+            ratios = [median(runtimes) / self.fallback.job_cost(*parse_history_key(key))
+                      for key, runtimes in self.runtimes.items()]
+            self.scale = median(ratios) if ratios else 1.0
+
+        return self.scale
+
+    def record(self, name: str, jobs: List[Sequence[int]], seconds: float) -> None:
+        """Record the `seconds` spent running the `jobs` (segments of each job) of `name`.
+
+        The time is distributed among the jobs using the current estimates.
+        """
+        if seconds < MIN_RECORDED_RUNTIME or not jobs:
+            return
+        costs = [self.job_cost(name, segments) for segments in jobs]
+        total = sum(costs)
+        lines = [json.dumps({'name': name, 'segments': list(segments),
+                             'seconds': seconds * cost / total})
+                 for segments, cost in zip(jobs, costs)]
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write("\n".join(lines) + "\n")
+
+
+def history_key(name: str, segments: Sequence[int]) -> str:
+    return "{}:{}".format(name, ",".join(str(s) for s in segments))
+
+
+def parse_history_key(key: str) -> tuple:
+    name, segments = key.split(':')
+    return name, [int(s) for s in segments.split(',') if s]
+
+
+def atoms_model(dict_input: dict) -> object:
+    """Atom count model, or the uniform model if the state cannot be read."""
+    try:
+        return AtomCountCost(dict_input['state'])
+    except (sqlite3.Error, RuntimeError) as e:
+        logger.warning("CANNOT ESTIMATE THE COST OF THE JOBS: {}".format(e))
+        return UniformCost()
+
+
+def history_model(dict_input: dict) -> RuntimeHistory:
+    if dict_input.get('runtime_history') is None:
+        raise RuntimeError("The history cost model needs the runtime_history option")
+    return RuntimeHistory(dict_input['runtime_history'], atoms_model(dict_input))
+
+
+def uniform_model(dict_input: dict) -> UniformCost:
+    return UniformCost()
+
+
+#: Functions creating the cost models from the input of the split jobs
+COST_MODELS: Dict[str, Callable] = {
+    'atoms': atoms_model, 'history': history_model, 'uniform': uniform_model}
+
+
+def register_cost_model(name: str, factory: Callable) -> None:
+    """Make the model created by `factory(dict_input)` available as `cost_model: name`.
+
+    The model must have a ``job_cost(name, segments)`` method.
+    """
+    COST_MODELS[name] = factory
+
+
+def create_cost_model(dict_input: dict) -> object:
+    """Create the model selected by the `cost_model` of `dict_input`."""
+    name = dict_input.get('cost_model') or 'atoms'
+    if name not in COST_MODELS:
+        raise RuntimeError("Unknown cost model: {}".format(name))
+
+    return COST_MODELS[name](dict_input)
+
+
+def runtime_recorder(dict_input: dict, model: object) -> Optional[RuntimeHistory]:
+    """History where the runtimes of the jobs are recorded, if `runtime_history` is given."""
+    if dict_input.get('runtime_history') is None:
+        return None
+    elif isinstance(model, RuntimeHistory):
+        return model
+
+    return RuntimeHistory(dict_input['runtime_history'], model)
+
+
+def order_chunks(chunks: List[List[str]], dict_jobs: dict, dict_input: dict,
+                 model: object) -> List[List[str]]:
+    """Sort the `chunks` of jobs by decreasing estimated cost of the `model`."""
+    name = dict_input['name']
+
+    def chunk_cost(ids: List[str]) -> float:
+        return sum(model.job_cost(name, dict_jobs[key].get('segments', [])) for key in ids)
+
+    return sorted(chunks, key=chunk_cost, reverse=True)
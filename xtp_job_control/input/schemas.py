@@ -2,7 +2,7 @@
 __all__ = ["schema_dftgwbse", "schema_kmc"]
 
 from os.path import exists
-from schema import (And, Optional, Schema, Use)
+from schema import (And, Optional, Or, Schema, Use)
 
 
 # "options to change from default templates
@@ -71,6 +71,28 @@ schema_kmc = Schema({
 
     Optional("lifetimes_file", default="lifetimes.xml"): exists,
 
+    # Folder to cache the results of the xtp calls
+    Optional("task_cache", default=None): Or(None, str),
+
+    # Folder to store the input files shared by the scratch folders
+    Optional("content_store", default=None): Or(None, str),
+
+    # Folder where the scratch folder is created, e.g. a node-local disk
+    Optional("scratch_root", default=None): Or(None, str),
+
+    # Copy the results from the scratch folder to the workdir in the background
+    Optional("stage_out", default=False): bool,
+
+    # Capacity of the node shared by the xtp calls, e.g. {"cores": 64, "memory": 128000}
+    Optional("node", default={}): {Optional("cores"): int, Optional("memory"): int},
+
+    # Cores, memory (MB) and hard time limit (s) of the calculators,
+    # e.g. {"eqm": {"memory": 2000, "timeout": 3600, "kill_signal": "INT"}}
+    Optional("resources", default={}): {str: {
+        Optional("cores"): int, Optional("memory"): int,
+        Optional("timeout"): Or(int, float),
+        Optional("kill_signal"): Or(str, int), Optional("kill_grace"): Or(int, float)}},
+
     # Change_Options options from template
     Optional("votca_calculators_options", default=CALCULATORS_DEFAULTS): schema_votca_calculators_options
 
@@ -105,6 +127,32 @@ schema_dftgwbse = Schema({
     # path to the VOTCASHARE folder
     Optional("path_votcashare", default="/usr/local/share/votca"): exists,
 
+    # Maximum number of molecules computed concurrently, by default the
+    # available cores divided by the threads of each calculation
+    Optional("max_workers", default=None): Or(None, int),
+
+    # Folder to cache the results of the xtp calls
+    Optional("task_cache", default=None): Or(None, str),
+
+    # Folder to store the input files shared by the scratch folders
+    Optional("content_store", default=None): Or(None, str),
+
+    # Folder where the scratch folder is created, e.g. a node-local disk
+    Optional("scratch_root", default=None): Or(None, str),
+
+    # Copy the results from the scratch folder to the workdir in the background
+    Optional("stage_out", default=False): bool,
+
+    # Capacity of the node shared by the xtp calls, e.g. {"cores": 64, "memory": 128000}
+    Optional("node", default={}): {Optional("cores"): int, Optional("memory"): int},
+
+    # Cores, memory (MB) and hard time limit (s) of the calculators,
+    # e.g. {"eqm": {"memory": 2000, "timeout": 3600, "kill_signal": "INT"}}
+    Optional("resources", default={}): {str: {
+        Optional("cores"): int, Optional("memory"): int,
+        Optional("timeout"): Or(int, float),
+        Optional("kill_signal"): Or(str, int), Optional("kill_grace"): Or(int, float)}},
+
     # Change_Options options from template
     Optional("votca_calculators_options", default=CALCULATORS_DEFAULTS): schema_votca_calculators_options
 })
@@ -0,0 +1,181 @@
+"""Sidecar index of the jobs stored in a job file.
+
+The index maps every job identifier to its status, the byte range of the
+job inside the file and the segments in its input. It is stored next to
+the job file (e.g. `eqm.jobs.idx`) and rebuilt whenever the size or the
+modification time of the job file changes. Changing the status of a job
+patches the file in place, without parsing or rewriting the whole file.
+"""
+
+__all__ = ["FINISHED_STATUSES", "JobIndex"]
+
+import json
+import mmap
+import os
+import re
+import xml.etree.ElementTree as ET
+from collections import namedtuple
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Tuple, Union
+
+JOB_REGEX = re.compile(rb"<job>.*?</job>", re.S)
+ID_REGEX = re.compile(rb"<id>\s*(\d+)\s*</id>")
+STATUS_REGEX = re.compile(rb"<status>([^<]*)</status>(\s*)")
+SEGMENT_REGEX = re.compile(rb"<segment\b([^>]*)>")
+ATTRIBUTE_REGEX = re.compile(rb'(\w+)="([^"]*)"')
+
+#: Status of the jobs that have been run and hold their results
+FINISHED_STATUSES = ("COMPLETE", "FAILED")
+
+#: Location of a job inside the file. The status slot contains the status
+#: element and the whitespace after it, which is used to fit a longer status.
+JobEntry = namedtuple(
+    "JobEntry", ["id", "start", "end", "status", "status_start", "status_end", "segments"])
+
+
+class JobIndex:
+    """Index of the jobs in `path_file`."""
+
+    def __init__(self, path_file: Union[str, Path], entries: Dict[int, JobEntry]):
+        self.path_file = Path(path_file)
+        self.entries = entries
+
+    @property
+    def path_index(self) -> Path:
+        return Path("{}.idx".format(self.path_file.as_posix()))
+
+    @classmethod
+    def load(cls, path_file: Union[str, Path]) -> "JobIndex":
+        """Load the index of `path_file`, building it if it is missing or outdated."""
+        path_file = Path(path_file)
+        path_index = Path("{}.idx".format(path_file.as_posix()))
+        if path_index.exists():
+            with open(path_index, 'r') as f:
+                data = json.load(f)
+            if data['stamp'] == file_stamp(path_file):
+                entries = {x[0]: JobEntry(*x) for x in data['jobs']}
+                return cls(path_file, entries)
+
+        index = cls.build(path_file)
+        index.save()
+        return index
+
+    @classmethod
+    def build(cls, path_file: Union[str, Path]) -> "JobIndex":
+        """Scan `path_file` searching for the jobs."""
+        entries = {}
+        with open(path_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            for match in JOB_REGEX.finditer(buf):
+                entry = scan_job(match.group(), match.start())
+                entries[entry.id] = entry
+
+        return cls(path_file, entries)
+
+    def save(self) -> None:
+        """Write the index next to the job file."""
+        data = {'stamp': file_stamp(self.path_file),
+                'jobs': [list(x) for x in self.entries.values()]}
+        tmp = Path("{}.tmp".format(self.path_index.as_posix()))
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp.as_posix(), self.path_index.as_posix())
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def ids(self, state: str = None) -> List[int]:
+        """Identifiers of the jobs with `state` (all the jobs if `None`), in file order."""
+        return [x.id for x in self.entries.values() if state is None or x.status == state]
+
+    def status(self, job_id: int) -> str:
+        """Status of the job `job_id`."""
+        return self.entries[job_id].status
+
+    def segments(self, job_id: int) -> List[Tuple[int, str]]:
+        """Pairs of (identifier, type) of the segments in the input of `job_id`."""
+        return [tuple(x) for x in self.entries[job_id].segments]
+
+    def read_jobs(self, ids: Iterable[int]) -> Iterator[bytes]:
+        """Read the raw content of the jobs `ids`, without parsing the file."""
+        with open(self.path_file, 'rb') as f:
+            for i in ids:
+                entry = self.entries[i]
+                f.seek(entry.start)
+                yield f.read(entry.end - entry.start)
+
+    def extract(self, job_id: int) -> ET.Element:
+        """Parse the single job `job_id`."""
+        return ET.fromstring(next(self.read_jobs([job_id])))
+
+    def set_status(self, statuses: Dict[int, str]) -> bool:
+        """Patch in place the status of the jobs given in `statuses`.
+
+        Only the jobs whose status changes are written. Returns `False`,
+        without modifying the file, if some new status does not fit in the
+        space available for the status of the job.
+        """
+        patches = []
+        for i, status in statuses.items():
+            entry = self.entries[i]
+            if entry.status == status:
+                continue
+            new = patch_status(self.path_file, entry, status)
+            if new is None:
+                return False
+            patches.append((entry, new, status))
+
+        if not patches:
+            return True
+
+        with open(self.path_file, 'r+b') as f:
+            for entry, new, status in patches:
+                f.seek(entry.status_start)
+                f.write(new)
+                self.entries[entry.id] = entry._replace(status=status)
+
+        self.save()
+        return True
+
+
+def scan_job(content: bytes, offset: int) -> JobEntry:
+    """Search for the identifier, status and segments of a job."""
+    idx = int(ID_REGEX.search(content).group(1))
+    status = STATUS_REGEX.search(content)
+    segments = []
+    for tag in SEGMENT_REGEX.finditer(content):
+        attributes = dict(ATTRIBUTE_REGEX.findall(tag.group(1)))
+        if b'id' in attributes:
+            segments.append([int(attributes[b'id']), attributes.get(b'type', b'').decode()])
+
+    if status is None:
+        return JobEntry(idx, offset, offset + len(content), None, None, None, segments)
+
+    return JobEntry(
+        idx, offset, offset + len(content), status.group(1).decode().strip(),
+        offset + status.start(), offset + status.end(), segments)
+
+
+def patch_status(path_file: Path, entry: JobEntry, status: str) -> Union[bytes, None]:
+    """Create the status slot of `entry` containing the new `status`."""
+    if entry.status_start is None:
+        return None
+
+    with open(path_file, 'rb') as f:
+        f.seek(entry.status_start)
+        slot = f.read(entry.status_end - entry.status_start)
+
+    element = "<status>{}</status>".format(status).encode()
+    whitespace = slot[slot.index(b'</status>') + len(b'</status>'):]
+    extra = len(slot) - len(element)
+    if extra < 0:
+        return None
+    elif extra >= len(whitespace):
+        return element + b' ' * (extra - len(whitespace)) + whitespace
+    else:
+        return element + whitespace[len(whitespace) - extra:]
+
+
+def file_stamp(path_file: Path) -> List[int]:
+    """Size and modification time used to check that an index is up to date."""
+    stat = os.stat(path_file)
+    return [stat.st_size, stat.st_mtime_ns]
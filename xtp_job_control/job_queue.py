@@ -0,0 +1,341 @@
+"""Queue of xtp commands stored in a SQLite file, shared with pilot workers.
+
+In pilot mode the split jobs are not started by the workflow. They are
+appended to a queue in the scratch folder and long-lived worker processes,
+started with ``run_xtp_workflow worker --queue <scratch_dir>/jobs.sqlite``
+on the same or other nodes, claim the jobs atomically, run them and record
+their output. The workflow waits for the output of the jobs that it
+enqueued. No broker is needed besides a filesystem shared by the workers.
+
+The workers renew the lease of their running jobs every `HEARTBEAT_INTERVAL`
+seconds. The running jobs whose lease has not been renewed for `LEASE_TIMEOUT`
+seconds (e.g. the worker was killed or its node failed) are queued again.
+"""
+
+__all__ = ["JobQueue", "open_pilot_queue", "run_worker", "start_local_workers"]
+
+import atexit
+import json
+import logging
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Event, Thread
+from typing import Iterable, Iterator, List, Optional, Tuple, Union
+
+from .journal import journal_key
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT UNIQUE NOT NULL,
+    cmd TEXT NOT NULL,
+    workdir TEXT NOT NULL,
+    expected_output TEXT,
+    resources TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    output TEXT,
+    error TEXT,
+    submitted REAL,
+    started REAL,
+    heartbeat REAL,
+    finished REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT);
+"""
+
+# Seconds to wait for the lock of the database
+LOCK_TIMEOUT = 600
+
+# Seconds between the renewals of the lease of a running job
+HEARTBEAT_INTERVAL = 30
+
+# Seconds without renewal after which a running job is queued again
+LEASE_TIMEOUT = 300
+
+# Equivalent to `run_xtp_workflow worker ...` using the current interpreter
+WORKER_SCRIPT = "from xtp_job_control.workflows.run_workflow import main; main()"
+
+
+class JobQueue:
+    """Jobs waiting to be run by the workers, stored at `path`.
+
+    The running jobs whose lease has not been renewed for `lease` seconds are
+    queued again.
+    """
+
+    def __init__(self, path: Union[str, Path], lease: float = LEASE_TIMEOUT):
+        self.path = Path(path)
+        self.lease = lease
+        with self.connect() as conn:
+            conn.executescript(SCHEMA)
+            columns = [x[1] for x in conn.execute("PRAGMA table_info(jobs)")]
+            if 'heartbeat' not in columns:
+                # Queue created by a previous version
+                conn.execute("ALTER TABLE jobs ADD COLUMN heartbeat REAL")
+
+    @contextmanager
+    def connect(self) -> Iterator[sqlite3.Connection]:
+        """Open a connection, used by a single thread."""
+        conn = sqlite3.connect(self.path.as_posix(), timeout=LOCK_TIMEOUT, isolation_level=None)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def enqueue(self, cmd: str, workdir: Path, expected_output: dict = None,
+                resources: dict = None) -> int:
+        """Add a command to the queue, returning its identifier.
+
+        A command that is already in the queue (e.g. when the workflow is
+        resumed) is not added again, unless it failed.
+        """
+        key = journal_key(cmd, workdir)
+        with self.connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT id, status FROM jobs WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                cursor = conn.execute(
+                    "INSERT INTO jobs (key, cmd, workdir, expected_output, resources, submitted) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, cmd, Path(workdir).as_posix(), json.dumps(expected_output),
+                     json.dumps(resources), time.time()))
+                job_id = cursor.lastrowid
+            else:
+                job_id = row[0]
+                if row[1] == 'failed':
+                    conn.execute(
+                        "UPDATE jobs SET status = 'pending', error = NULL WHERE id = ?", (job_id,))
+            conn.execute("COMMIT")
+
+        return job_id
+
+    def claim(self, worker: str) -> Optional[dict]:
+        """Take the oldest pending job, or `None` if there are no pending jobs.
+
+        The running jobs with an expired lease are queued again before.
+        """
+        with self.connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            self.requeue_expired(conn)
+            row = conn.execute(
+                "SELECT id, cmd, workdir, expected_output, resources FROM jobs "
+                "WHERE status = 'pending' ORDER BY id LIMIT 1").fetchone()
+            if row is not None:
+                now = time.time()
+                conn.execute(
+                    "UPDATE jobs SET status = 'running', worker = ?, started = ?, heartbeat = ? "
+                    "WHERE id = ?", (worker, now, now, row[0]))
+            conn.execute("COMMIT")
+
+        if row is None:
+            return None
+        return {'id': row[0], 'cmd': row[1], 'workdir': Path(row[2]),
+                'expected_output': json.loads(row[3]), 'resources': json.loads(row[4]),
+                'worker': worker}
+
+    def heartbeat(self, job_id: int, worker: str) -> bool:
+        """Renew the lease of a running job, returns `False` if `worker` lost the job."""
+        with self.connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET heartbeat = ? WHERE id = ? AND status = 'running' "
+                "AND worker = ?", (time.time(), job_id, worker))
+        return cursor.rowcount > 0
+
+    def requeue_expired(self, conn: sqlite3.Connection) -> None:
+        """Queue again the running jobs whose lease has expired."""
+        deadline = time.time() - self.lease
+        rows = conn.execute(
+            "SELECT id, worker FROM jobs WHERE status = 'running' "
+            "AND COALESCE(heartbeat, started, 0) < ?", (deadline,)).fetchall()
+        for job_id, worker in rows:
+            logger.warning("PILOT JOB {} OF WORKER {} HAS EXPIRED, QUEUEING IT AGAIN".format(
+                job_id, worker))
+            conn.execute(
+                "UPDATE jobs SET status = 'pending', worker = NULL, heartbeat = NULL "
+                "WHERE id = ?", (job_id,))
+
+    def complete(self, job_id: int, output: Optional[dict]) -> None:
+        """Record the `output` of a finished job."""
+        self.finish(job_id, 'done', output=json.dumps(output))
+
+    def fail(self, job_id: int, error: str) -> None:
+        """Record the `error` of a job that could not be run."""
+        self.finish(job_id, 'failed', error=error)
+
+    def finish(self, job_id: int, status: str, output: str = None, error: str = None) -> None:
+        with self.connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, output = ?, error = ?, finished = ? WHERE id = ?",
+                (status, output, error, time.time(), job_id))
+
+    def wait(self, job_id: int, poll: float = 1) -> Optional[dict]:
+        """Wait until the job `job_id` finishes and return its output."""
+        return next(self.wait_all([job_id], poll))[1]
+
+    def wait_all(self, job_ids: Iterable[int],
+                 poll: float = 1) -> Iterator[Tuple[int, Optional[dict]]]:
+        """Wait for the jobs `job_ids`, yielding their identifier and output as they finish.
+
+        The status of all the jobs is polled with a single query.
+        """
+        pending = set(job_ids)
+        while pending:
+            with self.connect() as conn:
+                finished = [x for x in conn.execute(
+                    "SELECT id FROM jobs WHERE status IN ('done', 'failed')") if x[0] in pending]
+                rows = [conn.execute(
+                    "SELECT id, status, output, error FROM jobs WHERE id = ?", x).fetchone()
+                        for x in finished]
+            for job_id, status, output, error in rows:
+                pending.remove(job_id)
+                if status == 'failed':
+                    raise RuntimeError(
+                        "Job {} failed in the pilot worker:\n{}".format(job_id, error))
+                yield job_id, json.loads(output)
+            if pending:
+                time.sleep(poll)
+
+    def counts(self) -> dict:
+        """Number of jobs with each status."""
+        with self.connect() as conn:
+            return dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"))
+
+    def close(self) -> None:
+        """Tell the workers that no more jobs will be enqueued."""
+        with self.connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('closed', '1')")
+
+    def reopen(self) -> None:
+        """Accept new jobs, e.g. when the workflow is resumed.
+
+        The running jobs with an expired lease are queued again.
+        """
+        with self.connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM meta WHERE name = 'closed'")
+            self.requeue_expired(conn)
+            conn.execute("COMMIT")
+
+    @property
+    def closed(self) -> bool:
+        with self.connect() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE name = 'closed'").fetchone()
+        return row is not None
+
+
+def run_worker(path_queue: Union[str, Path], slots: int = 1, idle_timeout: float = 600,
+               poll: float = 1, parent: int = None) -> int:
+    """Run the jobs of the queue at `path_queue`, using `slots` concurrent jobs.
+
+    The worker stops once the queue is closed and empty, after waiting
+    `idle_timeout` seconds (if not zero) without finding a pending job or
+    when the `parent` process that started the worker has finished.
+    Returns the number of jobs run by the worker.
+    """
+    queue = JobQueue(path_queue)
+    name = "{}:{}".format(socket.gethostname(), os.getpid())
+    logger.info("PILOT WORKER {} READING {}".format(name, path_queue))
+
+    def work(slot: int) -> int:
+        n_jobs = 0
+        idle_since = time.monotonic()
+        while True:
+            job = queue.claim("{}/{}".format(name, slot))
+            if job is None:
+                idle = time.monotonic() - idle_since
+                if queue.closed or (idle_timeout and idle > idle_timeout) or not is_alive(parent):
+                    return n_jobs
+                time.sleep(poll)
+                continue
+            run_queued_job(queue, job)
+            n_jobs += 1
+            idle_since = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=slots) as executor:
+        return sum(executor.map(work, range(slots)))
+
+
+def run_queued_job(queue: JobQueue, job: dict) -> None:
+    """Run a job claimed from the `queue` and record its result.
+
+    The lease of the job is renewed while the command runs.
+    """
+    from .workflows.workflow_components import run_command
+
+    finished = Event()
+    heartbeat = Thread(target=renew_lease, args=(queue, job, finished), daemon=True)
+    heartbeat.start()
+    try:
+        job['workdir'].mkdir(parents=True, exist_ok=True)
+        output = run_command(
+            job['cmd'], job['workdir'], job['expected_output'], job['resources'])
+    except Exception as e:
+        logger.error("PILOT JOB {} FAILED: {}".format(job['id'], e))
+        queue.fail(job['id'], repr(e))
+    else:
+        queue.complete(job['id'], output)
+    finally:
+        finished.set()
+        heartbeat.join()
+
+
+def renew_lease(queue: JobQueue, job: dict, finished: Event) -> None:
+    """Renew the lease of the `job` every `HEARTBEAT_INTERVAL` s until it is `finished`."""
+    while not finished.wait(HEARTBEAT_INTERVAL):
+        try:
+            if not queue.heartbeat(job['id'], job['worker']):
+                logger.warning("PILOT JOB {} WAS QUEUED AGAIN WHILE RUNNING IN {}".format(
+                    job['id'], job['worker']))
+        except sqlite3.Error as e:
+            logger.warning("CANNOT RENEW THE LEASE OF PILOT JOB {}: {}".format(job['id'], e))
+
+
+def is_alive(pid: Optional[int]) -> bool:
+    """Check if the process `pid` is still running (`True` if not given)."""
+    if pid is None:
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def start_local_workers(path_queue: Union[str, Path], n_workers: int) -> List[subprocess.Popen]:
+    """Start `n_workers` worker processes in this machine.
+
+    The workers run until the queue is closed or the current process finishes.
+    """
+    cmd = [sys.executable, '-c', WORKER_SCRIPT, 'worker',
+           '--queue', Path(path_queue).as_posix(), '--idle-timeout', '0',
+           '--parent', str(os.getpid())]
+
+    return [subprocess.Popen(cmd, stdin=subprocess.DEVNULL) for _ in range(n_workers)]
+
+
+def open_pilot_queue(path_queue: Union[str, Path], n_workers: int = 0) -> Path:
+    """Create the queue of the pilot mode and start `n_workers` local workers.
+
+    The queue is closed when the workflow finishes, stopping the workers.
+    """
+    queue = JobQueue(path_queue)
+    queue.reopen()
+    atexit.register(queue.close)
+    if n_workers > 0:
+        start_local_workers(path_queue, n_workers)
+    logger.info("PILOT QUEUE: {} with {} local workers".format(path_queue, n_workers))
+
+    return Path(path_queue)
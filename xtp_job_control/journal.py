@@ -0,0 +1,86 @@
+"""Journal of the commands that have finished inside a scratch folder.
+
+Every command whose expected output has been found is appended to the
+journal as a line in JSON format. When a workflow is resumed the graph is
+rebuilt and the commands already present in the journal, whose output files
+still exist, are not invoked again.
+"""
+
+__all__ = ["Journal", "get_journal"]
+
+import hashlib
+import json
+import os
+from pathlib import Path
+from threading import Lock
+from typing import Dict, Optional, Union
+
+# Journals already loaded, indexed by path
+_JOURNALS: Dict[str, "Journal"] = {}
+_LOCK = Lock()
+
+
+def get_journal(path: Union[str, Path]) -> "Journal":
+    """Return the journal stored at `path`, loading it only once."""
+    path = Path(path)
+    with _LOCK:
+        if path.as_posix() not in _JOURNALS:
+            _JOURNALS[path.as_posix()] = Journal(path)
+        return _JOURNALS[path.as_posix()]
+
+
+class Journal:
+    """Persisted record of the finished commands and their output."""
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self.lock = Lock()
+        self.records = {}
+        if self.path.exists():
+            with open(self.path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Line truncated when the workflow was killed
+                        continue
+                    self.records[record['key']] = record['output']
+
+    def lookup(self, cmd: str, workdir: Path) -> Optional[dict]:
+        """Return the output of `cmd` if it has already finished at `workdir`.
+
+        Returns `None` if the command is not in the journal or if any of
+        its output files is missing.
+        """
+        output = self.records.get(journal_key(cmd, workdir))
+        if output is None or not all_files_exist(output):
+            return None
+        return output
+
+    def record(self, cmd: str, workdir: Path, output: dict) -> None:
+        """Append the `output` of `cmd` to the journal."""
+        key = journal_key(cmd, workdir)
+        line = json.dumps({'key': key, 'cmd': cmd, 'workdir': Path(workdir).as_posix(),
+                           'output': output})
+        with self.lock:
+            self.records[key] = output
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+
+def journal_key(cmd: str, workdir: Path) -> str:
+    """Identify a command by its string and the folder where it runs."""
+    data = "{}\n{}".format(cmd, Path(workdir).as_posix())
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def all_files_exist(output: dict) -> bool:
+    """Check that the files in `output` are still available."""
+    def exists(val):
+        if isinstance(val, list):
+            return all(os.path.exists(x) for x in val)
+        return not isinstance(val, str) or os.path.exists(val)
+
+    return all(exists(val) for val in output.values())
@@ -0,0 +1,142 @@
+"""Pre-screening of the pairs of segments before running iqm.
+
+The pairs and the atoms of the segments are read from the state file and,
+for every pair, the minimum distance between the atoms of the two
+segments is computed (using the minimum image stored in the ``dr`` column
+of the pairs). A cheap proxy of the electronic coupling is estimated as
+the sum of ``exp(-overlap_decay * r)`` over the pairs of atoms.
+
+The `iqm_screening` option accepts:
+
+* ``max_distance``: keep the pairs whose atoms are closer than this distance (nm).
+* ``min_overlap``: keep the pairs whose overlap proxy is at least this value.
+* ``overlap_decay``: decay of the overlap proxy (1/nm, by default 20).
+* ``top_k``: among the pairs passing the thresholds, keep the `top_k` pairs
+  with the largest overlap of every segment.
+* ``frame``: frame of the state whose pairs are screened, required if the
+  state contains several frames.
+
+The segments, atoms and pairs are matched by frame and identifier. The surviving pairs are used as the ``segment_pairs`` selection of the iqm jobs.
+"""
+
+__all__ = ["pair_metrics", "screen_pairs"]
+
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
+
+import numpy as np
+
+from .state_reader import StateReader, Table
+
+# Default decay of the overlap proxy (1/nm)
+OVERLAP_DECAY = 20
+
+# Memory used by the distances computed at once (bytes)
+CHUNK_MEMORY = 2 ** 26
+
+
+def screen_pairs(path_state: Union[str, Path], settings: dict) -> List[Tuple[int, int]]:
+    """Identifiers of the segments of the pairs that pass the `settings` screening."""
+    settings = dict(settings)
+    unknown = set(settings) - {'max_distance', 'min_overlap', 'overlap_decay', 'top_k', 'frame'}
+    if unknown:
+        raise RuntimeError("Unknown iqm_screening keywords: {}".format(unknown))
+
+    frame = settings.get('frame')
+    with StateReader(path_state, frame) as state:
+        segments, pairs, atoms = state.segments(), state.pairs(), state.atoms()
+    if frame is None and len(np.unique(segments['frame'])) > 1:
+        raise RuntimeError(
+            "The state contains several frames, select one with the frame keyword of iqm_screening")
+    metrics = pair_metrics(
+        segments, pairs, atoms, settings.get('overlap_decay', OVERLAP_DECAY))
+
+    keep = np.ones(len(pairs['id']), dtype=bool)
+    if settings.get('max_distance') is not None:
+        keep &= metrics['min_distance'] <= settings['max_distance']
+    if settings.get('min_overlap') is not None:
+        keep &= metrics['overlap'] >= settings['min_overlap']
+    if settings.get('top_k') is not None:
+        keep &= top_k_per_segment(pairs, metrics['overlap'], keep, int(settings['top_k']))
+
+    return [(int(x), int(y)) for x, y in zip(pairs['seg1'][keep], pairs['seg2'][keep])]
+
+
+def pair_metrics(segments: Table, pairs: Table, atoms: Table,
+                 overlap_decay: float = OVERLAP_DECAY) -> Dict[str, np.ndarray]:
+    """Minimum distance between the atoms and overlap proxy of every pair."""
+    coordinates = padded_coordinates(segments, atoms)
+    index1 = segment_index(segments, pairs['frame'], pairs['seg1'])
+    index2 = segment_index(segments, pairs['frame'], pairs['seg2'])
+    # Translate the second segment to the periodic image given by dr
+    shifts = segments['pos'][index1] + pairs['dr'] - segments['pos'][index2]
+
+    n_pairs = len(index1)
+    min_distance = np.empty(n_pairs)
+    overlap = np.empty(n_pairs)
+    n_atoms = coordinates.shape[1]
+    chunk = max(1, CHUNK_MEMORY // (24 * n_atoms * n_atoms))
+    for start in range(0, n_pairs, chunk):
+        sl = slice(start, start + chunk)
+        xs = coordinates[index1[sl]]
+        ys = coordinates[index2[sl]] + shifts[sl, None, :]
+        distances = np.linalg.norm(xs[:, :, None, :] - ys[:, None, :, :], axis=-1)
+        min_distance[sl] = np.nanmin(distances.reshape(len(xs), -1), axis=1)
+        overlap[sl] = np.nansum(np.exp(-overlap_decay * distances), axis=(1, 2))
+
+    return {'min_distance': min_distance, 'overlap': overlap}
+
+
+def segment_keys(frames: np.ndarray, ids: np.ndarray) -> np.ndarray:
+    """Key identifying the segments `ids` of the `frames` (the ids repeat in every frame)."""
+    return (np.asarray(frames, dtype=np.int64) << 32) + np.asarray(ids, dtype=np.int64)
+
+
+def segment_index(segments: Table, frames: np.ndarray, ids: np.ndarray) -> np.ndarray:
+    """Position in `segments` of the segments `ids` of the `frames`."""
+    keys = segment_keys(segments['frame'], segments['id'])
+    order = np.argsort(keys)
+    queries = segment_keys(frames, ids)
+    found = np.minimum(np.searchsorted(keys[order], queries), len(keys) - 1)
+    index = order[found] if len(keys) else found
+    if len(queries) and (not len(keys) or np.any(keys[index] != queries)):
+        raise RuntimeError("There are references to unknown segments in the state")
+
+    return index
+
+
+def padded_coordinates(segments: Table, atoms: Table) -> np.ndarray:
+    """Coordinates of the atoms of every segment, padded with NaN (segments x atoms x 3)."""
+    index = segment_index(segments, atoms['frame'], atoms['seg'])
+    # Group the atoms by segment, keeping their order
+    order = np.argsort(index, kind='stable')
+    index = index[order]
+    counts = np.bincount(index, minlength=len(segments['id']))
+    # Position of each atom within its segment
+    offsets = np.arange(len(index)) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    coordinates = np.full((len(segments['id']), max(1, counts.max(initial=0)), 3), np.nan)
+    coordinates[index, offsets] = atoms['pos'][order]
+
+    return coordinates
+
+
+def top_k_per_segment(pairs: Table, score: np.ndarray, mask: np.ndarray, k: int) -> np.ndarray:
+    """Mask of the pairs that are among the `k` best scored pairs of any of their segments."""
+    candidates = np.flatnonzero(mask)
+    # Every pair belongs to the list of both of its segments, in its frame
+    indices = np.concatenate((candidates, candidates))
+    _, segment = np.unique(np.concatenate((
+        segment_keys(pairs['frame'][candidates], pairs['seg1'][candidates]),
+        segment_keys(pairs['frame'][candidates], pairs['seg2'][candidates]))),
+        return_inverse=True)
+    # Sort by segment, then by decreasing score
+    order = np.lexsort((-score[indices], segment))
+    indices, segment = indices[order], segment[order]
+    starts = np.flatnonzero(np.r_[True, segment[1:] != segment[:-1]])
+    rank = np.arange(len(order)) - np.repeat(starts, np.diff(np.r_[starts, len(order)]))
+
+    selected = np.zeros(len(mask), dtype=bool)
+    selected[indices[rank < k]] = True
+
+    return selected
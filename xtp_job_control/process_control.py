@@ -0,0 +1,121 @@
+"""Run the commands in their own process group, with a wall-clock limit.
+
+Each command runs in a new session, so the shell, the xtp executable and
+any process started by it can be stopped together. A command is stopped
+when it exceeds its `timeout` or when it is cancelled from another thread
+(e.g. the slower copy of a speculatively duplicated job). The processes
+receive `kill_signal` and, if they are still alive after `kill_grace`
+seconds, SIGKILL.
+"""
+
+__all__ = ["cancel_process", "process_limits", "run_process"]
+
+import logging
+import os
+import signal
+import time
+from pathlib import Path
+from subprocess import Popen, TimeoutExpired
+from threading import Event, Lock
+from typing import Dict, Union
+
+logger = logging.getLogger(__name__)
+
+# Seconds between the checks of the running processes
+POLL_INTERVAL = 1
+
+# Default seconds between the kill signal and SIGKILL
+KILL_GRACE = 30
+
+# Cancellation flags of the running processes, indexed by workdir
+_RUNNING: Dict[str, Event] = {}
+_LOCK = Lock()
+
+
+def run_process(cmd: str, workdir: Path, timeout: float = None,
+                kill_signal: Union[str, int] = 'TERM', kill_grace: float = KILL_GRACE,
+                **kwargs) -> int:
+    """Run the shell `cmd` in `workdir` and return its exit code.
+
+    The process group is stopped if the command runs longer than `timeout`
+    seconds or if it is cancelled with :func:`cancel_process`. The other
+    `kwargs` are passed to `Popen`.
+    """
+    key = Path(workdir).as_posix()
+    cancelled = Event()
+    with _LOCK:
+        _RUNNING[key] = cancelled
+
+    try:
+        with Popen(cmd, shell=True, cwd=key, start_new_session=True, **kwargs) as p:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while True:
+                remaining = POLL_INTERVAL if deadline is None else deadline - time.monotonic()
+                try:
+                    return p.wait(max(0, min(POLL_INTERVAL, remaining)))
+                except TimeoutExpired:
+                    pass
+                if cancelled.is_set():
+                    logger.warning("CANCELLING COMMAND: {} in {}".format(cmd, key))
+                    break
+                if deadline is not None and time.monotonic() >= deadline:
+                    logger.error("COMMAND EXCEEDED ITS TIMEOUT OF {} s: {} in {}".format(
+                        timeout, cmd, key))
+                    break
+
+            return stop_process_group(p, kill_signal, kill_grace)
+    finally:
+        with _LOCK:
+            if _RUNNING.get(key) is cancelled:
+                del _RUNNING[key]
+
+
+def stop_process_group(p: Popen, kill_signal: Union[str, int], grace: float) -> int:
+    """Send `kill_signal` to the group of `p`, and SIGKILL to the processes left after `grace` s."""
+    send_signal(p.pid, parse_signal(kill_signal))
+    deadline = time.monotonic() + grace
+    while time.monotonic() < deadline:
+        # Reap the shell, the group is gone once all its processes have finished
+        p.poll()
+        try:
+            os.killpg(p.pid, 0)
+        except ProcessLookupError:
+            break
+        time.sleep(0.1)
+    send_signal(p.pid, signal.SIGKILL)
+
+    return p.wait()
+
+
+def send_signal(pid: int, sig: int) -> None:
+    try:
+        os.killpg(pid, sig)
+    except ProcessLookupError:
+        pass
+
+
+def parse_signal(kill_signal: Union[str, int]) -> int:
+    """Signal given by its number or name, e.g. ``TERM`` or ``SIGINT``."""
+    if isinstance(kill_signal, int):
+        return kill_signal
+    name = str(kill_signal).upper()
+    try:
+        return signal.Signals[name if name.startswith('SIG') else 'SIG' + name]
+    except KeyError:
+        raise RuntimeError("Unknown kill signal: {}".format(kill_signal))
+
+
+def process_limits(resources: dict) -> dict:
+    """Timeout and kill settings given in the `resources` of a command."""
+    return {k: resources[k] for k in ('timeout', 'kill_signal', 'kill_grace')
+            if resources.get(k) is not None}
+
+
+def cancel_process(workdir: Path) -> bool:
+    """Stop the command running in `workdir`, returns `False` if there is none."""
+    with _LOCK:
+        cancelled = _RUNNING.get(Path(workdir).as_posix())
+    if cancelled is None:
+        return False
+    cancelled.set()
+    return True
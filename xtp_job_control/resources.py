@@ -0,0 +1,154 @@
+"""Resources (cores and memory) requested by the xtp calls.
+
+Every command declares the number of cores and the memory (in MB) that it
+needs. A hard wall-clock limit (`timeout`, in seconds) can also be given, see
+:mod:`xtp_job_control.process_control`.
+The commands acquire their resources from a pool with the capacity of the
+node before starting, therefore commands of different sizes are packed
+onto the node without oversubscribing it. Each command is pinned to the
+cores assigned by the pool and `OMP_NUM_THREADS` is set accordingly.
+"""
+
+__all__ = ["ResourcePool", "configure_resource_pool", "get_resource_pool", "task_resources"]
+
+import logging
+import os
+import shlex
+import shutil
+from contextlib import contextmanager
+from threading import Condition, Lock
+from typing import Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Pool shared by all the commands of the process
+_POOL: Optional["ResourcePool"] = None
+_LOCK = Lock()
+
+
+def task_resources(cores: int = 1, memory: int = None, timeout: float = None) -> dict:
+    """Resources requested by a single command."""
+    return {'cores': max(1, int(cores)), 'memory': memory, 'timeout': timeout}
+
+
+def available_cpus() -> List[int]:
+    """Identifiers of the CPUs that the process may use."""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def available_memory() -> Optional[int]:
+    """Physical memory of the node in MB."""
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') // 2 ** 20
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+class ResourcePool:
+    """Cores and memory of the node shared by the running commands.
+
+    Commands that do not fit in the free resources wait until enough
+    resources are released, while smaller commands that fit may start
+    in the meantime. Requests larger than the node are reduced to the
+    capacity of the node.
+    """
+
+    def __init__(self, cores: int = None, memory: int = None):
+        cpus = available_cpus()
+        self.cores = len(cpus) if cores is None else max(1, int(cores))
+        self.memory = available_memory() if memory is None else int(memory)
+        # Pin the commands only if every core has its own CPU
+        self.free_cpus = cpus[:self.cores] if self.cores <= len(cpus) else None
+        self.free_cores = self.cores
+        self.free_memory = self.memory
+        self.condition = Condition()
+
+    def fit(self, resources: dict) -> dict:
+        """Reduce the `resources` to the capacity of the node."""
+        cores = min(self.cores, max(1, resources.get('cores') or 1))
+        memory = resources.get('memory') or 0
+        if self.memory is not None:
+            memory = min(self.memory, memory)
+
+        return {'cores': cores, 'memory': memory}
+
+    def available(self, request: dict) -> bool:
+        """Check if the `request` fits in the free resources."""
+        return request['cores'] <= self.free_cores and (
+            self.free_memory is None or request['memory'] <= self.free_memory)
+
+    @contextmanager
+    def acquire(self, resources: dict = None) -> Iterator[dict]:
+        """Wait for the `resources` and release them when the command finishes.
+
+        Yields the allocated cores, memory and CPUs (`None` if the command
+        should not be pinned).
+        """
+        request = self.fit(resources or task_resources())
+        with self.condition:
+            self.condition.wait_for(lambda: self.available(request))
+            self.free_cores -= request['cores']
+            if self.free_memory is not None:
+                self.free_memory -= request['memory']
+            cpus = None
+            if self.free_cpus is not None:
+                cpus = self.free_cpus[:request['cores']]
+                del self.free_cpus[:request['cores']]
+
+        allocation = dict(request, cpus=cpus)
+        try:
+            yield allocation
+        finally:
+            with self.condition:
+                self.free_cores += request['cores']
+                if self.free_memory is not None:
+                    self.free_memory += request['memory']
+                if cpus is not None:
+                    self.free_cpus.extend(cpus)
+                self.condition.notify_all()
+
+
+def configure_resource_pool(cores: int = None, memory: int = None) -> ResourcePool:
+    """Set the capacity of the node, by default the available cores and memory."""
+    global _POOL
+    with _LOCK:
+        if _POOL is None or (cores is not None and cores != _POOL.cores) or (
+                memory is not None and memory != _POOL.memory):
+            _POOL = ResourcePool(cores, memory)
+            logger.info("NODE RESOURCES: {} cores and {} MB".format(_POOL.cores, _POOL.memory))
+        return _POOL
+
+
+def get_resource_pool() -> ResourcePool:
+    """Return the pool shared by the commands, creating it if necessary."""
+    with _LOCK:
+        pool = _POOL
+    return configure_resource_pool() if pool is None else pool
+
+
+def command_environment(allocation: dict) -> Dict[str, str]:
+    """Environment of a command running with the `allocation`."""
+    env = os.environ.copy()
+    env['OMP_NUM_THREADS'] = str(allocation['cores'])
+
+    return env
+
+
+def pinned_command(cmd: str, allocation: dict) -> str:
+    """Shell `cmd` run with ``taskset`` on the allocated CPUs.
+
+    The CPUs are set when the shell starts, before it creates any process,
+    therefore the whole command is pinned. The command is not pinned if
+    ``taskset`` is not available.
+    """
+    cpus = allocation.get('cpus')
+    if not cpus:
+        return cmd
+    if shutil.which('taskset') is None:
+        logger.warning("TASKSET IS NOT AVAILABLE, THE COMMANDS ARE NOT PINNED TO THEIR CORES")
+        return cmd
+
+    return "exec taskset -c {} /bin/sh -c {}".format(
+        ",".join(str(x) for x in sorted(cpus)), shlex.quote(cmd))
@@ -5,6 +5,7 @@ from noodles.serial import Registry
 from noodles.serial.numpy import arrays_to_hdf5
 from typing import Any
 from .results import Results
+from .stage_out import wait_stage_out
 
 
 def run(wf: object, runner: str = 'parallel', n_processes: int = 1,
@@ -17,14 +18,19 @@ def run(wf: object, runner: str = 'parallel', n_processes: int = 1,
 
     if runner == 'display':
         with NCDisplay() as display:
-            return run_logging(wf, n_processes, display)
+            output = run_logging(wf, n_processes, display)
     elif runner == 'serial':
-        return run_single(wf)
+        output = run_single(wf)
     else:
-        return run_provenance(
+        output = run_provenance(
             wf, n_threads=n_processes, db_file=cache, registry=registry, echo_log=False,
             always_cache=False)
 
+    # Wait for the results that are still being copied to the persistent workdir
+    wait_stage_out()
+
+    return output
+
 
 def registry():
     """
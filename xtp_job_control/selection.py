@@ -0,0 +1,141 @@
+"""Expressions to select the jobs to run from a job file.
+
+The `eqm_jobs`, `iqm_jobs` and `xqmultipole_jobs` options accept:
+
+* A list of identifiers, e.g. ``[1, 2, 5]``.
+* A string with comma separated identifiers and ranges ``start-end:stride``,
+  where the end can be omitted, e.g. ``"1-100,200-:10"``.
+* A dictionary combining the following conditions:
+
+  - ``ids``: identifiers or ranges, as above.
+  - ``every``: take every n-th job in file order (``offset`` sets the first one).
+  - ``segment_type``: type (or list of types) of the segments in the job input.
+  - ``segment_ids``: identifiers or ranges of the segments in the job input.
+  - ``segment_pairs``: list of pairs ``[seg1, seg2]`` of segment identifiers,
+    selecting the jobs whose segments form one of these pairs
+    (see :mod:`xtp_job_control.pair_screening`).
+  - ``input_regex``: regular expression searched in the job, e.g. ``"Methane:s1"``.
+  - ``sample``: random sample of the selected jobs, either a number of jobs
+    or a fraction, reproducible using ``seed``.
+
+All the conditions are evaluated in a single pass over the index of the job file.
+"""
+
+__all__ = ["parse_ranges", "select_jobs"]
+
+import random
+import re
+from typing import Callable, List, Optional, Union
+
+from .job_index import JobIndex
+
+RANGE_REGEX = re.compile(r"^(\d+)(?:-(\d*))?(?::(\d+))?$")
+
+
+class Ranges:
+    """Set of identifiers given as explicit values and ranges."""
+
+    def __init__(self, ids: set, ranges: List[range], open_ranges: List[tuple]):
+        self.ids = ids
+        self.ranges = ranges
+        self.open_ranges = open_ranges
+
+    def __contains__(self, i: int) -> bool:
+        return i in self.ids or any(i in r for r in self.ranges) or any(
+            i >= start and (i - start) % stride == 0 for start, stride in self.open_ranges)
+
+
+def parse_ranges(expression: Union[int, str, list]) -> Ranges:
+    """Parse a list of identifiers or a string of ranges like ``"1-10,20-:5"``."""
+    if isinstance(expression, int):
+        expression = [expression]
+    if isinstance(expression, str):
+        expression = expression.split(',')
+
+    ids, ranges, open_ranges = set(), [], []
+    for x in expression:
+        if isinstance(x, int):
+            ids.add(x)
+            continue
+        match = RANGE_REGEX.match(str(x).strip())
+        if match is None:
+            raise RuntimeError("Invalid job selection: {}".format(x))
+        start, end, stride = match.groups()
+        stride = int(stride) if stride else 1
+        if end is None:
+            ids.add(int(start))
+        elif end == '':
+            open_ranges.append((int(start), stride))
+        else:
+            ranges.append(range(int(start), int(end) + 1, stride))
+
+    return Ranges(ids, ranges, open_ranges)
+
+
+def select_jobs(index: JobIndex, expression: object) -> Optional[set]:
+    """Compute the identifiers of the jobs selected by `expression`.
+
+    Returns `None` if all the jobs are selected.
+    """
+    if expression is None:
+        return None
+    if not isinstance(expression, dict):
+        expression = {'ids': expression}
+
+    unknown = set(expression) - {
+        'ids', 'every', 'offset', 'segment_type', 'segment_ids', 'segment_pairs', 'input_regex',
+        'sample', 'seed'}
+    if unknown:
+        raise RuntimeError("Unknown job selection keywords: {}".format(unknown))
+
+    predicates = create_predicates(expression)
+    selected = [i for position, i in enumerate(index.ids())
+                if all(p(position, i, index) for p in predicates)]
+
+    if 'input_regex' in expression:
+        regex = re.compile(expression['input_regex'].encode())
+        selected = [i for i, raw in zip(selected, index.read_jobs(selected))
+                    if regex.search(raw) is not None]
+
+    if 'sample' in expression:
+        selected = sample_jobs(selected, expression['sample'], expression.get('seed'))
+
+    return set(selected)
+
+
+def create_predicates(expression: dict) -> List[Callable]:
+    """Create the conditions that a job must fulfill."""
+    predicates = []
+    if 'ids' in expression:
+        ids = parse_ranges(expression['ids'])
+        predicates.append(lambda position, i, index: i in ids)
+
+    if 'every' in expression:
+        every = int(expression['every'])
+        offset = int(expression.get('offset', 0))
+        predicates.append(
+            lambda position, i, index: position >= offset and (position - offset) % every == 0)
+
+    if 'segment_type' in expression:
+        types = expression['segment_type']
+        types = {types} if isinstance(types, str) else set(types)
+        predicates.append(
+            lambda position, i, index: any(t in types for _, t in index.segments(i)))
+
+    if 'segment_ids' in expression:
+        segment_ids = parse_ranges(expression['segment_ids'])
+        predicates.append(
+            lambda position, i, index: any(s in segment_ids for s, _ in index.segments(i)))
+
+    if 'segment_pairs' in expression:
+        pairs = {frozenset(pair) for pair in expression['segment_pairs']}
+        predicates.append(
+            lambda position, i, index: frozenset(s for s, _ in index.segments(i)) in pairs)
+
+    return predicates
+
+
+def sample_jobs(ids: List[int], sample: Union[int, float], seed: int = None) -> List[int]:
+    """Take a random `sample` (number of jobs or fraction) of `ids`."""
+    size = int(round(sample * len(ids))) if isinstance(sample, float) else int(sample)
+    return random.Random(seed).sample(ids, min(size, len(ids)))
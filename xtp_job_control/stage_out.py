@@ -0,0 +1,102 @@
+"""Asynchronous copy of the results from the scratch folder to a persistent folder.
+
+When the scratch folder lives in a node-local disk, the output of the
+finished tasks (orbitals, multipoles, job.tab, etc.) is copied to the
+persistent workdir by a background thread, so that the next stages of
+the workflow are not held up and the results survive the loss of the node.
+"""
+
+__all__ = ["get_stage_out", "stage_out_files", "wait_stage_out"]
+
+import logging
+import os
+import shutil
+from pathlib import Path
+from queue import Queue
+from threading import Lock, Thread
+from typing import Dict, Iterable, Union
+
+logger = logging.getLogger(__name__)
+
+# Active stage-out threads, indexed by destination
+_STAGE_OUT: Dict[str, "StageOut"] = {}
+_LOCK = Lock()
+
+
+class StageOut:
+    """Copy the files under `scratch_dir` to the same relative path in `destination`."""
+
+    def __init__(self, scratch_dir: Union[str, Path], destination: Union[str, Path]):
+        self.scratch_dir = Path(scratch_dir).absolute()
+        self.destination = Path(destination)
+        self.queue = Queue()
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, paths: Iterable[Union[str, Path]]) -> None:
+        """Schedule the copy of `paths` without waiting for it."""
+        for path in paths:
+            self.queue.put(Path(path))
+
+    def wait(self) -> None:
+        """Wait until all the submitted files have been copied."""
+        self.queue.join()
+
+    def _run(self) -> None:
+        while True:
+            path = self.queue.get()
+            try:
+                self.copy(path)
+            except OSError as e:
+                logger.error("STAGE OUT FAILED FOR {}: {}".format(path, e))
+            finally:
+                self.queue.task_done()
+
+    def copy(self, path: Path) -> None:
+        """Copy `path` if it is newer than the persistent copy."""
+        try:
+            relative = path.absolute().relative_to(self.scratch_dir)
+        except ValueError:
+            # Not a file in the scratch folder
+            return
+        if not path.is_file():
+            return
+
+        dst = self.destination / relative
+        if dst.exists() and dst.stat().st_mtime_ns >= path.stat().st_mtime_ns:
+            return
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        tmp = dst.with_name(".{}.part".format(dst.name))
+        shutil.copy2(path.as_posix(), tmp.as_posix())
+        os.replace(tmp.as_posix(), dst.as_posix())
+
+
+def get_stage_out(stage_out: dict) -> StageOut:
+    """Return the stage-out thread for the `scratch_dir` and `destination` in `stage_out`."""
+    destination = Path(stage_out['destination']).absolute().as_posix()
+    with _LOCK:
+        if destination not in _STAGE_OUT:
+            _STAGE_OUT[destination] = StageOut(stage_out['scratch_dir'], destination)
+        return _STAGE_OUT[destination]
+
+
+def stage_out_files(stage_out: dict, output: dict) -> None:
+    """Submit the files in the `output` of a task to the stage-out thread."""
+    if stage_out is None or not output:
+        return
+
+    paths = []
+    for val in output.values():
+        if isinstance(val, list):
+            paths.extend(val)
+        elif isinstance(val, (str, Path)):
+            paths.append(val)
+    get_stage_out(stage_out).submit(paths)
+
+
+def wait_stage_out() -> None:
+    """Wait for all the pending copies."""
+    with _LOCK:
+        stagers = list(_STAGE_OUT.values())
+    for stager in stagers:
+        stager.wait()
@@ -0,0 +1,148 @@
+"""Read-only access to the tables of a VOTCA state file (state.sql).
+
+The tables are loaded into NumPy arrays with a single query each, using a
+read-only connection, so that the jobs can be counted, filtered and
+planned without calling ``xtp_parallel -j write``::
+
+    with StateReader("state.sql") as state:
+        segments = state.segments()
+        print(len(segments['id']), segments['pos'].shape)
+        print(state.count_jobs('iqm'))
+
+The number of jobs can also be printed before requesting an allocation with
+``run_xtp_workflow plan --state state.sql``.
+"""
+
+__all__ = ["StateReader", "plan_jobs"]
+
+import sqlite3
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
+from urllib.parse import quote
+
+import numpy as np
+
+#: Arrays of the columns of a table
+Table = Dict[str, np.ndarray]
+
+
+class StateReader:
+    """Read the frames, segments, pairs and atoms stored in a state file.
+
+    If `frame` is given only the rows of that frame are read.
+    """
+
+    def __init__(self, path: Union[str, Path], frame: int = None):
+        self.path = Path(path)
+        if not self.path.is_file():
+            raise RuntimeError("There is no state file: {}".format(self.path))
+        uri = "file:{}?mode=ro".format(quote(self.path.absolute().as_posix()))
+        self.conn = sqlite3.connect(uri, uri=True)
+        self.frame = frame
+
+    def __enter__(self) -> "StateReader":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def query(self, table: str, columns: List[Tuple[str, str]], order: str = "id",
+              frame_column: str = "frame") -> Table:
+        """Read the `columns` (name, NumPy type) of `table` into arrays.
+
+        The rows are filtered by the `frame_column` of the table, if a frame is selected.
+        """
+        names = ", ".join(name for name, _ in columns)
+        sql = "SELECT {} FROM {}".format(names, table)
+        params = ()
+        if self.frame is not None:
+            sql += " WHERE {} = ?".format(frame_column)
+            params = (self.frame,)
+        sql += " ORDER BY {}".format(order)
+
+        rows = self.conn.execute(sql, params).fetchall()
+        data = np.array(rows, dtype=[(name, dtype) for name, dtype in columns])
+
+        return {name: data[name] for name, _ in columns}
+
+    def frames(self) -> Table:
+        """Identifier, time, step and box (n x 3 x 3) of the frames."""
+        boxes = ["box{}{}".format(i, j) for i in range(1, 4) for j in range(1, 4)]
+        data = self.query(
+            "frames", [("id", "i8"), ("time", "f8"), ("step", "i8")] + [(x, "f8") for x in boxes],
+            frame_column="id")
+        data['box'] = np.stack([data.pop(x) for x in boxes], axis=1).reshape(-1, 3, 3)
+
+        return data
+
+    def segments(self) -> Table:
+        """Identifier, name, type, molecule and position (n x 3) of the segments."""
+        data = self.query("segments", [
+            ("frame", "i8"), ("id", "i8"), ("name", "O"), ("type", "O"), ("mol", "i8"),
+            ("posX", "f8"), ("posY", "f8"), ("posZ", "f8")])
+
+        return with_positions(data)
+
+    def segment_types(self) -> Table:
+        """Identifier, name, basis and coordinates file of the segment types."""
+        return self.query("segmentTypes", [
+            ("id", "i8"), ("name", "O"), ("basis", "O"), ("coordfile", "O")])
+
+    def pairs(self) -> Table:
+        """Identifier, segments, type, distance vector (n x 3) and distance of the pairs."""
+        data = self.query("pairs", [
+            ("frame", "i8"), ("id", "i8"), ("seg1", "i8"), ("seg2", "i8"), ("type", "i8"),
+            ("drX", "f8"), ("drY", "f8"), ("drZ", "f8")])
+        data['dr'] = np.stack([data.pop(x) for x in ("drX", "drY", "drZ")], axis=1)
+        data['distance'] = np.linalg.norm(data['dr'], axis=1)
+
+        return data
+
+    def atoms(self) -> Table:
+        """Identifier, segment, element and position (n x 3) of the atoms, sorted by segment."""
+        data = self.query("atoms", [
+            ("frame", "i8"), ("id", "i8"), ("seg", "i8"), ("element", "O"),
+            ("posX", "f8"), ("posY", "f8"), ("posZ", "f8")], order="seg, id")
+
+        return with_positions(data)
+
+    def atoms_per_segment(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Identifiers of the segments and their number of atoms."""
+        sql = "SELECT seg, COUNT(*) FROM atoms"
+        params = ()
+        if self.frame is not None:
+            sql += " WHERE frame = ?"
+            params = (self.frame,)
+        rows = self.conn.execute(sql + " GROUP BY seg ORDER BY seg", params).fetchall()
+        data = np.array(rows, dtype=np.int64).reshape(-1, 2)
+
+        return data[:, 0], data[:, 1]
+
+    def count_jobs(self, calculator: str) -> int:
+        """Number of jobs written by `calculator` (one per segment or one per pair)."""
+        table = {'eqm': 'segments', 'iqm': 'pairs'}.get(calculator)
+        if table is None:
+            raise RuntimeError("Cannot count the jobs of {}".format(calculator))
+        sql = "SELECT COUNT(*) FROM {}".format(table)
+        if self.frame is not None:
+            return self.conn.execute(sql + " WHERE frame = ?", (self.frame,)).fetchone()[0]
+
+        return self.conn.execute(sql).fetchone()[0]
+
+
+def with_positions(data: Table) -> Table:
+    """Replace the posX, posY and posZ columns with an n x 3 `pos` array."""
+    data['pos'] = np.stack([data.pop(x) for x in ("posX", "posY", "posZ")], axis=1)
+
+    return data
+
+
+def plan_jobs(path_state: Union[str, Path], frame: int = None) -> Dict[str, int]:
+    """Number of eqm jobs (segments), iqm jobs (pairs) and atoms in the state file."""
+    with StateReader(path_state, frame) as state:
+        _, atoms = state.atoms_per_segment()
+        return {'eqm': state.count_jobs('eqm'), 'iqm': state.count_jobs('iqm'),
+                'atoms': int(atoms.sum())}
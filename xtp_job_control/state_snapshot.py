@@ -0,0 +1,69 @@
+"""Private copies of the state file used by the concurrent jobs.
+
+All the split jobs read the same `state.sql` file, which on a shared
+filesystem (NFS, Lustre) serialises them on the locks of SQLite. When a
+snapshot folder is given (e.g. `/dev/shm` or `$TMPDIR`), each node copies
+the state once to that folder and the jobs read the copy. The copy is
+named after the path, size and modification time of the state, so a
+modified state is copied again. The results of the jobs are written back
+to the original state by a single read stage (see `read_jobs_into_state`).
+
+The snapshots take as much memory (or disk) as the state, so creating a
+snapshot removes the older snapshots of the same state in that node, and
+the snapshots of this node are removed once the jobs reading them finish.
+"""
+
+__all__ = ["remove_snapshots", "snapshot_command", "snapshot_path"]
+
+import hashlib
+import os
+import shlex
+from pathlib import Path
+from typing import Union
+
+
+def snapshot_path(state: Union[str, Path], root: Union[str, Path]) -> Path:
+    """Path of the snapshot of `state` inside the `root` folder."""
+    state = Path(state).absolute()
+    info = os.stat(state)
+    data = "{}\n{}".format(info.st_size, info.st_mtime_ns)
+    version = hashlib.sha256(data.encode()).hexdigest()[:16]
+
+    return snapshot_folder(root) / "{}{}.sql".format(snapshot_prefix(state), version)
+
+
+def snapshot_prefix(state: Union[str, Path]) -> str:
+    """Beginning of the name of all the snapshots of `state`."""
+    digest = hashlib.sha256(Path(state).absolute().as_posix().encode()).hexdigest()[:16]
+
+    return "xtp_state_{}_".format(digest)
+
+
+def snapshot_folder(root: Union[str, Path]) -> Path:
+    return Path(os.path.expandvars(str(root)))
+
+
+def snapshot_command(state: Union[str, Path], snapshot: Path) -> str:
+    """Shell command creating the `snapshot` of `state` if it does not exist yet.
+
+    The command runs in the node of the job, the copy is renamed atomically
+    so that concurrent jobs never see a partial snapshot. The snapshots of
+    older versions of the state are removed.
+    """
+    src = shlex.quote(Path(state).absolute().as_posix())
+    dst = shlex.quote(snapshot.as_posix())
+    folder = shlex.quote(snapshot.parent.as_posix())
+    stale = "{}/{}*.sql".format(folder, snapshot_prefix(state))
+
+    return ("{{ test -f {1} || {{ mkdir -p {2} && cp {0} {1}.$$ && mv -f {1}.$$ {1} && "
+            "for x in {3}; do [ \"$x\" = {1} ] || rm -f \"$x\"; done; }}; }}").format(
+                src, dst, folder, stale)
+
+
+def remove_snapshots(state: Union[str, Path], root: Union[str, Path]) -> None:
+    """Remove the snapshots of `state` in the `root` folder of this node."""
+    for path in snapshot_folder(root).glob("{}*.sql".format(snapshot_prefix(state))):
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,216 @@
+"""Content addressed cache for the results of the xtp commands.
+
+The key of a task is a hash computed from the command template, the content
+of every input file referenced by the command (recursively following the
+files referenced inside the XML option files) and the expected output.
+The scratch folders are named using a timestamp, therefore their paths are
+replaced by a placeholder before hashing.
+"""
+
+__all__ = ["TaskCache", "normalize_paths"]
+
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+from pathlib import Path
+from threading import Lock
+from typing import Dict, Iterator, Optional, Sequence, Union
+
+logger = logging.getLogger(__name__)
+
+# Path to a scratch folder created by `initial_config`
+SCRATCH_REGEX = re.compile(r"[^\s'\"<>=]*xtp_\d{4}-\d{2}-\d{2}T[\d:.]+")
+
+# Name of a copy of the state (see `state_snapshot`), which depends on its path and version
+SNAPSHOT_REGEX = re.compile(r"xtp_state_[0-9a-f]{16}_[0-9a-f]{16}\.sql")
+
+# Candidate paths inside a command or a text file
+PATH_REGEX = re.compile(r"[^\s'\"<>=;|]+")
+
+# Redirection of the standard output/error of a command
+REDIRECTION_REGEX = re.compile(r"\d?>+\s*\S+")
+
+# Files that are hashed as text after normalizing the scratch paths
+TEXT_SUFFIXES = {'.xml', '.jobs', '.xyz', '.tab', '.mps'}
+
+# Hash of the files already read, indexed by (path, size, modification time)
+_FILE_HASHES: Dict[tuple, str] = {}
+_LOCK = Lock()
+
+
+def normalize_paths(text: str) -> str:
+    """Replace the paths to the scratch folders and the copies of the state by placeholders."""
+    return SNAPSHOT_REGEX.sub("<snapshot>", SCRATCH_REGEX.sub("<scratch>", text))
+
+
+class TaskCache:
+    """Store the output of the xtp commands indexed by the hash of their input.
+
+    Besides the expected output, the `files` modified by a command (e.g. the
+    job file where the results of the split jobs are written) can be stored.
+    """
+
+    def __init__(self, root: Union[str, Path]):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def key(self, cmd: str, workdir: Path, expected_output: dict,
+            files: Sequence[str] = ()) -> str:
+        """Compute the hash of the `cmd` running at `workdir`."""
+        digest = hashlib.sha256()
+        digest.update(normalize_paths(cmd).encode())
+        digest.update(normalize_paths(Path(workdir).as_posix()).encode())
+        digest.update(json.dumps(expected_output, sort_keys=True).encode())
+        digest.update(json.dumps(sorted(files)).encode())
+
+        visited = set()
+        for path in referenced_files(REDIRECTION_REGEX.sub('', cmd), Path(workdir)):
+            hash_path(path, digest, visited)
+
+        return digest.hexdigest()
+
+    def restore(self, key: str, workdir: Path) -> Optional[dict]:
+        """Copy the outputs and files stored under `key` to `workdir`.
+
+        Returns `None` if `key` is not in the cache.
+        """
+        entry = self._entry(key)
+        manifest = entry / 'manifest.json'
+        if not manifest.exists():
+            return None
+
+        with open(manifest, 'r') as f:
+            outputs = json.load(f)
+
+        logger.info("RESTORING CACHED OUTPUT: {}".format(key))
+        workdir = Path(workdir)
+
+        def copy_back(relative: str) -> str:
+            dst = workdir / relative
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copy2((entry / 'files' / relative).as_posix(), dst.as_posix())
+            return dst.as_posix()
+
+        if (entry / 'files.json').exists():
+            with open(entry / 'files.json', 'r') as f:
+                for relative in json.load(f):
+                    copy_back(relative)
+
+        return {name: copy_back(rel) if isinstance(rel, str) else [copy_back(x) for x in rel]
+                for name, rel in outputs.items()}
+
+    def store(self, key: str, workdir: Path, outputs: dict, files: Sequence[str] = ()) -> None:
+        """Store the `outputs` and the other `files` produced at `workdir` under `key`.
+
+        Incomplete outputs, files that were not found, are not stored.
+        """
+        if not is_complete(outputs):
+            return
+
+        entry = self._entry(key)
+        if entry.exists():
+            return
+
+        workdir = Path(workdir)
+        tmp = Path(tempfile.mkdtemp(dir=self.root.as_posix()))
+
+        def copy_to_cache(path: str) -> str:
+            relative = Path(path).relative_to(workdir)
+            dst = tmp / 'files' / relative
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copy2(path, dst.as_posix())
+            return relative.as_posix()
+
+        try:
+            manifest = {name: copy_to_cache(val) if isinstance(val, str) else [copy_to_cache(x) for x in val]
+                        for name, val in outputs.items()}
+            stored = [copy_to_cache((workdir / x).as_posix()) for x in files]
+        except (ValueError, OSError) as e:
+            logger.error("CANNOT CACHE OUTPUT {}: {}".format(key, e))
+            shutil.rmtree(tmp.as_posix())
+            return
+
+        with open(tmp / 'files.json', 'w') as f:
+            json.dump(stored, f)
+        with open(tmp / 'manifest.json', 'w') as f:
+            json.dump(manifest, f)
+
+        entry.parent.mkdir(exist_ok=True)
+        try:
+            os.rename(tmp.as_posix(), entry.as_posix())
+        except OSError:
+            # Another task stored the same entry
+            shutil.rmtree(tmp.as_posix())
+
+    def _entry(self, key: str) -> Path:
+        return self.root / key[:2] / key
+
+
+def is_complete(outputs: dict) -> bool:
+    """Check that all the expected outputs were found."""
+    if not outputs:
+        return False
+    return all(
+        (isinstance(val, str) and os.path.isfile(val)) or
+        (isinstance(val, list) and len(val) > 0) for val in outputs.values())
+
+
+def referenced_files(text: str, workdir: Path) -> Iterator[Path]:
+    """Search for the existing files or folders referenced in `text`."""
+    for token in PATH_REGEX.findall(text):
+        path = Path(token)
+        if not path.is_absolute():
+            path = workdir / path
+        if ('/' in token or '.' in token) and path.exists():
+            yield path
+
+
+def hash_path(path: Path, digest: object, visited: set) -> None:
+    """Update `digest` with the content of `path`.
+
+    XML files are scanned for references to other files, which are
+    also included in the hash.
+    """
+    path = path.resolve()
+    if path in visited:
+        return
+    visited.add(path)
+
+    if path.is_dir():
+        for x in sorted(p for p in path.rglob('*') if p.is_file()):
+            hash_path(x, digest, visited)
+        return
+
+    digest.update(normalize_paths(path.name).encode())
+    digest.update(hash_file(path).encode())
+
+    if path.suffix in ('.xml', '.jobs'):
+        text = path.read_text(errors='replace')
+        for x in referenced_files(text, path.parent):
+            hash_path(x, digest, visited)
+
+
+def hash_file(path: Path) -> str:
+    """Compute the hash of the content of `path`, reusing the previous results."""
+    stat = path.stat()
+    index = (path.as_posix(), stat.st_size, stat.st_mtime_ns)
+    with _LOCK:
+        if index in _FILE_HASHES:
+            return _FILE_HASHES[index]
+
+    digest = hashlib.sha256()
+    if path.suffix in TEXT_SUFFIXES:
+        digest.update(normalize_paths(path.read_text(errors='replace')).encode())
+    else:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+
+    rs = digest.hexdigest()
+    with _LOCK:
+        _FILE_HASHES[index] = rs
+    return rs
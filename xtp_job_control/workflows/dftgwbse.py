@@ -1,16 +1,27 @@
 """Workflow to perform a DFT GWBSE calculation."""
 
+import hashlib
+import json
 import logging
 import os
 import shutil
 from pathlib import Path
+from typing import List
 
-from ..results import Results
+from ..results import Options, Results
 from ..runner import run
+from ..task_cache import is_complete
+from .workflow_components import compute_max_workers
 from .xtp_workflow import run_dftgwbse
 
 logger = logging.getLogger(__name__)
 
+# File stored next to the results of a molecule identifying its input
+FINGERPRINT_FILE = "dftgwbse.fingerprint"
+
+# Options that change the results of the calculation
+FINGERPRINT_OPTIONS = ("functional", "basisset", "auxbasisset", "mode", "package")
+
 
 def dftgwbse_workflow(options: dict):
     """Call the DFT GW-BSE workflows."""
@@ -18,9 +29,7 @@ def dftgwbse_workflow(options: dict):
     results = Results({})
 
     # create a new folder to store the results
-    mol_name = options.molecule.stem
-    workdir = Path(options.workdir) / mol_name
-    os.makedirs(workdir.as_posix(), exist_ok=True)
+    workdir = create_molecule_workdir(options)
 
     # Run DFT + GWBSE
     results['dftgwbse'] = run_dftgwbse(results, options)
@@ -30,3 +39,81 @@ def dftgwbse_workflow(options: dict):
         shutil.copy(output['dftgwbse'][x], workdir)
 
     print("DFT GWBSE finished!!")
+
+
+def dftgwbse_batch_workflow(molecules_options: List[Options]):
+    """Run the DFT GW-BSE workflow for several molecules in a single graph.
+
+    The molecules are run concurrently, using the available cores
+    divided by the `threads` of each calculation (or `max_workers`). The
+    molecules whose calculation fails are reported without stopping the
+    others, and they are computed again in the next run.
+    """
+    if not molecules_options:
+        return
+
+    # create results object
+    results = Results({})
+    for options in molecules_options:
+        results[options.molecule.stem] = run_dftgwbse(results, options)
+
+    options = molecules_options[0]
+    n_processes = compute_max_workers(
+        options.max_workers, options.votca_calculators_options["threads"])
+    output = run(results, n_processes=n_processes)
+
+    failed = []
+    for options in molecules_options:
+        name = options.molecule.stem
+        workdir = create_molecule_workdir(options)
+        # Keep the log of the failed calculations
+        for x in ("log", "out"):
+            if isinstance(output[name][x], str):
+                shutil.copy(output[name][x], workdir)
+        if not is_complete(output[name]):
+            logger.error("DFT GWBSE FAILED FOR MOLECULE {}, SEE {}".format(
+                options.molecule, workdir / "dftgwbse.log"))
+            failed.append(name)
+        elif options.fingerprint is not None:
+            write_fingerprint(workdir, options.fingerprint)
+
+    print("DFT GWBSE finished for {} molecules!!".format(len(molecules_options) - len(failed)))
+    if failed:
+        print("DFT GWBSE failed for the molecules: {}".format(", ".join(failed)))
+
+
+def create_molecule_workdir(options: Options) -> Path:
+    """Create a new folder to store the results of a molecule."""
+    workdir = Path(options.workdir) / options.molecule.stem
+    os.makedirs(workdir.as_posix(), exist_ok=True)
+
+    return workdir
+
+
+def molecule_fingerprint(options: dict, molecule: Path) -> str:
+    """Hash the geometry of `molecule` together with the options of the calculation."""
+    dftgwbse = options.get('votca_calculators_options', {}).get('dftgwbse', {})
+    data = {key: options.get(key) for key in FINGERPRINT_OPTIONS}
+    data['dftgwbse'] = {key: val for key, val in dftgwbse.items() if key != 'molecule'}
+
+    digest = hashlib.sha256(Path(molecule).read_bytes())
+    digest.update(json.dumps(data, sort_keys=True, default=str).encode())
+
+    return digest.hexdigest()
+
+
+def is_computed(options: dict, molecule: Path, fingerprint: str) -> bool:
+    """Check if the results of `molecule` were computed with the same input."""
+    workdir = Path(options['workdir']) / Path(molecule).stem
+    path = workdir / FINGERPRINT_FILE
+    if not path.exists() or not (workdir / "dftgwbse.out.xml").exists():
+        return False
+
+    return path.read_text().strip() == fingerprint
+
+
+def write_fingerprint(workdir: Path, fingerprint: str) -> None:
+    """Store the `fingerprint` of the input next to the results."""
+    tmp = workdir / ".{}.tmp".format(FINGERPRINT_FILE)
+    tmp.write_text(fingerprint + "\n")
+    os.replace(tmp.as_posix(), (workdir / FINGERPRINT_FILE).as_posix())
@@ -1,16 +1,27 @@
 """Module containing the command line interface."""
 
 import argparse
+import copy
+import logging
+import sys
+from pathlib import Path
+from typing import List
 
 from ..input import validate_input
+from ..job_queue import run_worker
 from ..results import Options
-from .dftgwbse import dftgwbse_workflow
+from ..state_reader import plan_jobs
+from .dftgwbse import (dftgwbse_batch_workflow, dftgwbse_workflow, is_computed,
+                       molecule_fingerprint)
 from .kmc import kmc_workflow
 from .xtp_workflow import initial_config, recursively_create_path
 
 available_workflows = {
     'kmc': kmc_workflow, 'dftgwbse': dftgwbse_workflow}
 
+# Workflows running all the molecules of a folder in a single graph
+batch_workflows = {'dftgwbse': dftgwbse_batch_workflow}
+
 
 def cli():
     """Create command line options."""
@@ -23,14 +34,67 @@ def cli():
     parser.add_argument(
         "--workdir", help="Working directory", default='.')
 
+    parser.add_argument(
+        "--resume", help="Scratch folder of a previous run to resume", default=None)
+
     # read command line args
     args = parser.parse_args()
 
-    return {'input_file': args.input, 'workdir': args.workdir}
+    return {'input_file': args.input, 'workdir': args.workdir, 'resume': args.resume}
+
+
+def worker_cli(args: List[str]) -> dict:
+    """Create the command line options of a pilot worker."""
+    parser = argparse.ArgumentParser(
+        prog="run_xtp_workflow worker", description="Run the jobs of a pilot queue")
+
+    parser.add_argument(
+        "--queue", help="Path to the job queue (<scratch_dir>/jobs.sqlite)", required=True)
+
+    parser.add_argument(
+        "--slots", help="Number of jobs run concurrently", type=int, default=1)
+
+    parser.add_argument(
+        "--idle-timeout", help="Seconds without jobs before stopping (0 to wait forever)",
+        type=float, default=600)
+
+    parser.add_argument(
+        "--parent", help="Stop when the process with this pid finishes", type=int,
+        default=None)
+
+    args = parser.parse_args(args)
+
+    return {'path_queue': args.queue, 'slots': args.slots,
+            'idle_timeout': args.idle_timeout, 'parent': args.parent}
+
+
+def plan_cli(args: List[str]) -> dict:
+    """Create the command line options to count the jobs of a state file."""
+    parser = argparse.ArgumentParser(
+        prog="run_xtp_workflow plan", description="Count the jobs stored in a state file")
+
+    parser.add_argument(
+        "--state", help="Path to the state file (state.sql)", required=True)
+
+    parser.add_argument(
+        "--frame", help="Count only the jobs of this frame", type=int, default=None)
+
+    args = parser.parse_args(args)
+
+    return {'path_state': args.state, 'frame': args.frame}
 
 
 def main():
-    """Run the workflow."""
+    """Run the workflow, a pilot worker (`worker`) or count the jobs (`plan`)."""
+    if sys.argv[1:2] == ['worker']:
+        logging.basicConfig(level=logging.INFO)
+        run_worker(**worker_cli(sys.argv[2:]))
+        return
+    elif sys.argv[1:2] == ['plan']:
+        for name, count in plan_jobs(**plan_cli(sys.argv[2:])).items():
+            print("{}: {}".format(name, count))
+        return
+
     options = cli()
     run_workflow(options)
 
@@ -47,6 +111,8 @@ def run_workflow(options: dict):
     molecule = options["molecule"]
     if molecule.is_file():
         run_single_molecule(options)
+    elif options['workflow'] in batch_workflows:
+        run_molecules_batch(options, sorted(molecule.glob("*xyz")))
     else:
         for mol in molecule.glob("*xyz"):
             options["molecule"] = mol
@@ -62,3 +128,38 @@ def run_single_molecule(options: dict):
     print("running workflow: ", options.workflow)
     fun = available_workflows[options.workflow]
     fun(options)
+
+
+def run_molecules_batch(options: dict, molecules: List[Path]):
+    """Run the workflow for all the `molecules` in a single graph.
+
+    The molecules whose results were computed with the same input are
+    skipped before creating any scratch folder. A single scratch folder
+    cannot be resumed by all the molecules, therefore `resume` is ignored
+    and the fingerprints decide which molecules are computed again.
+    """
+    if options.get('resume') is not None:
+        print("ignoring --resume for a folder of molecules, the computed ones are skipped")
+    options = dict(options, resume=None)
+    molecules_options = []
+    for mol in molecules:
+        fingerprint = molecule_fingerprint(options, mol)
+        if is_computed(options, mol, fingerprint):
+            print("skipping already computed molecule: ", mol)
+            continue
+
+        # Each molecule has its own scratch folder and calculator options
+        mol_options = copy.deepcopy(dict(options))
+        mol_options["molecule"] = mol
+        mol_options["fingerprint"] = fingerprint
+        molecules_options.append(Options(initial_config(mol_options)))
+
+    # Run the given workflow
+    print("running workflow: ", options['workflow'], " for ", len(molecules_options),
+          " molecules")
+    fun = batch_workflows[options['workflow']]
+    fun(molecules_options)
+
+
+if __name__ == "__main__":
+    main()
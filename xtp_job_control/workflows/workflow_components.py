@@ -3,45 +3,190 @@ import logging
 import os
 import re
 import shutil
+import time
 from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 from functools import wraps
 from pathlib import Path
-from subprocess import PIPE, Popen
-from typing import Callable, Dict, List
+from statistics import median
+from subprocess import DEVNULL
+from itertools import islice
+from typing import AnyStr, Callable, Dict, Iterator, List, Optional, Tuple, Union
 
-from noodles import schedule
+from noodles import gather, gather_dict, schedule
 from noodles.interface import PromisedObject
 
+from ..batch import BatchScheduler
+from ..cost_model import create_cost_model, order_chunks, runtime_recorder
+from ..job_index import FINISHED_STATUSES, JobIndex
+from ..job_queue import JobQueue
+from ..journal import get_journal
+from ..pair_screening import screen_pairs
+from ..process_control import cancel_process, process_limits, run_process
+from ..resources import (command_environment, get_resource_pool, pinned_command,
+                         task_resources)
+from ..stage_out import stage_out_files
+from ..state_snapshot import remove_snapshots, snapshot_command, snapshot_path
+from ..task_cache import TaskCache, is_complete
 from ..xml_editor import (add_absolute_path_to_options, create_job_file,
                           edit_xml_file, edit_xml_job_file, edit_xml_options,
-                          read_available_jobs)
+                          merge_job_files, raw_job_file_content)
 
 # Starting logger
 logger = logging.getLogger(__name__)
 
+# Maximum number of bytes of the standard error reported in the log
+TAIL_SIZE = 4096
+
+# Number of job folders written together while splitting a job file
+SPLIT_BATCH_SIZE = 256
+
+# Threads used to write the job folders
+IO_WORKERS = 8
+
+# Seconds between the searches of stragglers to duplicate
+SPECULATION_INTERVAL = 5
+
+# Finished chunks needed to estimate the typical runtime of a stage
+SPECULATION_MIN_FINISHED = 3
+
 
 @schedule
 def call_xtp_cmd(
-        cmd: str, workdir: str, expected_output: dict = None):
+        cmd: str, workdir: str, expected_output: dict = None, cache_dir: Path = None,
+        journal: Path = None, stage_out: dict = None, resources: dict = None):
     """Run a bash `cmd` in the `workdir` folder.
 
-    It searches for a list of `expected_output` files.
+    It searches for a list of `expected_output` files. If `cache_dir` is given
+    the output is retrieved from the cache when the same command has already
+    been run with identical input files. If the command is already recorded as
+    finished in the `journal`, it is not run again. If `stage_out` is given the
+    output is copied in the background to its persistent destination. The
+    command waits until the `resources` (cores and memory) are available.
     """
     print("running: ", cmd)
     if not workdir.exists():
         workdir.mkdir()
-    return run_command(cmd, workdir, expected_output)
+    return run_cached_command(
+        cmd, workdir, expected_output, cache_dir, journal, stage_out, resources)
+
+
+def run_cached_command(
+        cmd: str, workdir: Path, expected_output: dict = None, cache_dir: Path = None,
+        journal: Path = None, stage_out: dict = None, resources: dict = None,
+        queue: Path = None, cached_files: List[str] = ()):
+    """Run a bash command unless its output is already stored in `cache_dir`.
+
+    Besides the expected output, the `cached_files` (relative to `workdir`)
+    are stored in and restored from the cache.
+
+    Commands already finished according to the `journal` are skipped. If
+    the path to a job `queue` is given the command is run by a pilot worker.
+    The commands writing the state (``*.sql``) are never cached.
+    """
+    output, key = lookup_command(
+        cmd, workdir, expected_output, cache_dir, journal, stage_out, cached_files)
+    if output is None:
+        output = dispatch_command(cmd, workdir, expected_output, resources, queue)
+        record_command(output, key, cmd, workdir, cache_dir, journal, stage_out, cached_files)
+
+    return output
+
+
+def lookup_command(
+        cmd: str, workdir: Path, expected_output: dict = None, cache_dir: Path = None,
+        journal: Path = None, stage_out: dict = None,
+        cached_files: List[str] = ()) -> Tuple[Optional[dict], Optional[str]]:
+    """Output of a command finished according to the `journal` or stored in the cache.
+
+    The output is `None` if the command must be run. The cache key of the
+    command (`None` if it is not cached) is also returned.
+    """
+    if journal is not None:
+        output = get_journal(journal).lookup(cmd, workdir)
+        if output is not None:
+            logger.info("SKIPPING FINISHED COMMAND: {}".format(cmd))
+            stage_out_files(stage_out, output)
+            return output, None
+
+    if cache_dir is None or not expected_output or writes_state(expected_output):
+        return None, None
+
+    cache = TaskCache(cache_dir)
+    key = cache.key(cmd, workdir, expected_output, cached_files)
+    output = cache.restore(key, workdir)
+    if output is not None:
+        record_command(output, None, cmd, workdir, cache_dir, journal, stage_out)
+        return output, key
+
+    return None, key
+
+
+def record_command(
+        output: dict, key: Optional[str], cmd: str, workdir: Path, cache_dir: Path = None,
+        journal: Path = None, stage_out: dict = None, cached_files: List[str] = ()) -> None:
+    """Store the `output` of a command in the cache (if `key` is given) and the `journal`."""
+    if key is not None:
+        TaskCache(cache_dir).store(key, workdir, output, cached_files)
+
+    if journal is not None and is_complete(output):
+        get_journal(journal).record(cmd, workdir, output)
 
+    stage_out_files(stage_out, output)
 
-def run_command(cmd: str, workdir: str, expected_output: dict = None):
-    """Run a bash command using subprocess."""
-    with Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE, shell=True, cwd=workdir.as_posix()) as p:
-        rs = p.communicate()
 
-    logger.info("RUNNING COMMAND: {}".format(cmd))
-    logger.info("COMMAND OUTPUT: {}".format(rs[0].decode()))
-    logger.error("COMMAND ERROR: {}".format(rs[1].decode()))
+def writes_state(expected_output: dict) -> bool:
+    """Check if the state (an SQLite file) is among the `expected_output` of a command."""
+    return any(Path(x).suffix == '.sql' for x in expected_output.values()
+               if isinstance(x, (str, Path)))
 
+
+def dispatch_command(
+        cmd: str, workdir: Path, expected_output: dict = None, resources: dict = None,
+        queue: Path = None):
+    """Run the command in this process or, in pilot mode, through the job `queue`."""
+    if queue is None:
+        return run_command(cmd, workdir, expected_output, resources)
+
+    job_queue = JobQueue(queue)
+    return job_queue.wait(job_queue.enqueue(cmd, workdir, expected_output, resources))
+
+
+def run_command(cmd: str, workdir: str, expected_output: dict = None, resources: dict = None):
+    """Run a bash command using subprocess.
+
+    The standard output and error are streamed to the `<name>.stdout` and
+    `<name>.stderr` files in the `workdir`, where `name` is derived from the
+    command. Only the tail of the error is kept in memory for the log.
+    The command starts once its `resources` are free in the node, it is
+    pinned to the allocated cores and `OMP_NUM_THREADS` is set to their number.
+    The command is stopped if it runs longer than the `timeout` of its
+    `resources`, or if it is cancelled.
+    """
+    name = command_log_name(cmd)
+    path_out = workdir / '{}.stdout'.format(name)
+    path_err = workdir / '{}.stderr'.format(name)
+    resources = resources or task_resources()
+
+    with get_resource_pool().acquire(resources) as allocation:
+        logger.info("RUNNING COMMAND: {} (cores: {}, memory: {} MB)".format(
+            cmd, allocation['cores'], allocation['memory']))
+        with open(path_out, 'ab') as out, open(path_err, 'ab') as err:
+            offset = err.tell()
+            returncode = run_process(
+                pinned_command(cmd, allocation), workdir, stdin=DEVNULL, stdout=out,
+                stderr=err, env=command_environment(allocation), **process_limits(resources))
+
+    logger.info("COMMAND OUTPUT: {}".format(path_out))
+    error = read_tail(path_err, offset)
+    if returncode != 0 or error:
+        logger.error("COMMAND ERROR (exit code {}) in {}:\n{}".format(returncode, path_err, error))
+
+    return collect_output(workdir, expected_output)
+
+
+def collect_output(workdir: Path, expected_output: dict = None) -> dict:
+    """Search for the `expected_output` files of a command in `workdir`."""
     if expected_output is None:
         return None
     else:
@@ -49,6 +194,28 @@ def run_command(cmd: str, workdir: str, expected_output: dict = None):
                 in expected_output.items()}
 
 
+def command_log_name(cmd: str) -> str:
+    """Name of the log files of `cmd` using the program and calculator names.
+
+    If several commands are chained with `&&` the last one is used.
+    """
+    tokens = cmd.split('&&')[-1].split()
+    names = [Path(tokens[0]).name] if tokens else ['command']
+    if '-e' in tokens[:-1]:
+        names.append(tokens[tokens.index('-e') + 1])
+
+    return re.sub(r'[^\w.-]', '_', '_'.join(names))
+
+
+def read_tail(path: Path, offset: int = 0, size: int = TAIL_SIZE) -> str:
+    """Read at most the last `size` bytes written to `path` after `offset`."""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        f.seek(max(offset, end - size))
+        return f.read().decode(errors='replace')
+
+
 def retrieve_ouput(workdir: str, expected_file: str) -> str:
     """
     Search for `expected_file` files in the `workdir`.
@@ -105,47 +272,563 @@ def create_promise_command(
 
 
 @schedule
-def edit_jobs_file(path: str, jobs_to_run: List):
+def edit_jobs_file(path: str, jobs_to_run: object):
     """
-    Run only the jobs listed in jobs_to_run
+    Run only the jobs selected by the `jobs_to_run` expression
     """
     return {path: edit_xml_job_file(path, jobs_to_run)}
 
 
+@schedule
+def screen_iqm_jobs(jobs_to_run: object, state: Path, settings: dict) -> dict:
+    """
+    Add to the `jobs_to_run` expression the pairs passing the pre-screening of the state
+    """
+    pairs = [list(x) for x in screen_pairs(state, settings)]
+    logger.info("PAIRS KEPT BY THE SCREENING: {}".format(len(pairs)))
+
+    if jobs_to_run is None:
+        expression = {}
+    elif isinstance(jobs_to_run, dict):
+        expression = dict(jobs_to_run)
+    else:
+        expression = {'ids': jobs_to_run}
+    if 'segment_pairs' in expression:
+        selected = {frozenset(x) for x in expression['segment_pairs']}
+        pairs = [x for x in pairs if frozenset(x) in selected]
+    expression['segment_pairs'] = pairs
+
+    return expression
+
+
 @schedule
 def run_parallel_jobs(dict_jobs: dict, dict_input: dict) -> dict:
     """
     Run a set of jobs defined in `dict_jobs` using the options specified
     in dict_input.
-    """
-    state = dict_input['state']
-    # Name of the job to run
-    name = dict_input['name']
 
-    cmd_options = dict_input['cmd_options']
+    The jobs are run concurrently using a pool of at most `max_workers`
+    workers, by default the number of available cores divided by the
+    `threads` used by each job. Jobs sharing a workdir form a chunk that
+    is run with a single xtp_parallel call. If `batch` settings are given
+    the chunks are submitted to a batch scheduler instead. The chunks are
+    started in order of decreasing cost, estimated by the `cost_model`.
+    """
     # Add command to run
     results = dict_jobs.copy()
-    for key, job_info in dict_jobs.items():
-        input_xml = job_info[name]
-        cmd_parallel = "xtp_parallel -e {} -f {} -o {} ".format(
-            name, state, input_xml)
-        # Call subprocess
-        output = run_command(
-            cmd_parallel + cmd_options, job_info['workdir'],
-            expected_output=dict_input['expected_output'])
+    model = create_cost_model(dict_input)
+    chunks = order_chunks(
+        list(jobs_per_workdir(dict_jobs).values()), dict_jobs, dict_input, model)
+    if dict_input.get('batch') is not None:
+        finished = run_batch_chunks(chunks, dict_jobs, dict_input)
+    else:
+        finished = run_local_chunks(chunks, dict_jobs, dict_input, model)
+
+    for ids, chunk_output in finished:
+        output = split_chunk_output(chunk_output, ids, dict_jobs)
 
-        # Also store the path to the workdir
-        results[key]['job_workdir'] = job_info['workdir']
+        for key in ids:
+            # Also store the path to the workdir
+            results[key]['job_workdir'] = dict_jobs[key]['workdir']
 
-        for k, val in output.items():
-            results[key][k] = val
+            for k, val in output[key].items():
+                results[key][k] = val
 
     # Pack the state in the ouput
     results.update({'state': dict_input['scratch_dir'] / 'state.sql'})
+    release_snapshots(dict_input)
 
     return results
 
 
+def release_snapshots(dict_input: dict) -> None:
+    """Remove the copies of the state read by the jobs in this node."""
+    if dict_input.get('state_snapshot') is not None:
+        remove_snapshots(dict_input['state'], dict_input['state_snapshot'])
+
+
+def run_local_chunks(
+        chunks: List[List[str]], dict_jobs: dict, dict_input: dict,
+        model: object = None) -> Iterator[Tuple]:
+    """Run the `chunks` of jobs in a pool of threads, yielding their output as they finish.
+
+    The chunks are started in the given order. If a `runtime_history` file
+    is given the runtime of the chunks run in this node is recorded there.
+    If `speculation` is given the stragglers are duplicated. In pilot mode
+    the chunks are run by the workers of the `queue` instead.
+    """
+    if dict_input.get('queue') is not None:
+        yield from run_queued_chunks(chunks, dict_jobs, dict_input)
+        return
+
+    max_workers = compute_max_workers(
+        dict_input.get('max_workers'), dict_input.get('threads', 1))
+    history = runtime_recorder(dict_input, model)
+
+    def run_chunk_jobs(ids: List[str]) -> dict:
+        start = time.monotonic()
+        output = run_single_job(dict_jobs[ids[0]], dict_input, len(ids))
+        if history is not None and is_complete(output):
+            history.record(dict_input['name'],
+                           [dict_jobs[key].get('segments', []) for key in ids],
+                           time.monotonic() - start)
+        return output
+
+    if dict_input.get('speculation'):
+        yield from run_speculative_chunks(
+            run_chunk_jobs, chunks, dict_jobs, dict_input, max_workers)
+        return
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(run_chunk_jobs, ids): ids for ids in chunks}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+def run_queued_chunks(
+        chunks: List[List[str]], dict_jobs: dict, dict_input: dict) -> Iterator[Tuple]:
+    """Add all the `chunks` of jobs to the pilot queue, yielding their output as they finish.
+
+    The chunks found in the journal or the cache are not queued. The queued
+    chunks are waited for from the current thread.
+    """
+    job_queue = JobQueue(dict_input['queue'])
+    expected_output = dict_input['expected_output']
+    queued = {}
+    for ids in chunks:
+        job_info = dict_jobs[ids[0]]
+        cmd = job_command(job_info, dict_input, len(ids))
+        settings = cache_settings(job_info, dict_input)
+        output, key = lookup_command(cmd, job_info['workdir'], expected_output, **settings)
+        if output is not None:
+            yield ids, output
+            continue
+        job_id = job_queue.enqueue(
+            cmd, job_info['workdir'], expected_output, job_resources(dict_input))
+        queued[job_id] = (ids, cmd, key, settings)
+
+    for job_id, output in job_queue.wait_all(queued):
+        ids, cmd, key, settings = queued[job_id]
+        record_command(output, key, cmd, dict_jobs[ids[0]]['workdir'], **settings)
+        yield ids, output
+
+
+def run_speculative_chunks(
+        run_chunk_jobs: Callable, chunks: List[List[str]], dict_jobs: dict, dict_input: dict,
+        max_workers: int) -> Iterator[Tuple]:
+    """Run the `chunks`, starting a second copy of the chunks that take too long.
+
+    Once all the chunks have started, if a chunk runs longer than
+    `speculation` times the median runtime of the finished chunks while
+    some worker is idle, a copy of the chunk is started in a fresh workdir.
+    The first copy finishing with all its expected output is kept in the
+    workdir of the chunk and the other one is cancelled.
+    """
+    factor = float(dict_input['speculation'])
+    copy_input = dict(dict_input, stage_out=None)
+    starts, inputs, runtimes = {}, {}, []
+
+    def run_original(ids: List[str]) -> dict:
+        workdir = dict_jobs[ids[0]]['workdir']
+        inputs[ids[0]] = chunk_inputs(workdir)
+        starts[ids[0]] = time.monotonic()
+        return run_chunk_jobs(ids)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        attempts = {executor.submit(run_original, ids): (ids, dict_jobs[ids[0]])
+                    for ids in chunks}
+        speculated = set()
+        while attempts:
+            finished, _ = wait(attempts, SPECULATION_INTERVAL, FIRST_COMPLETED)
+            for future in finished:
+                if future not in attempts:
+                    continue
+                ids, job_info = attempts.pop(future)
+                output = future.result()
+                others = {f: x for f, x in attempts.items() if x[0][0] == ids[0]}
+                if others and not is_complete(output):
+                    # Wait for the other copy of the chunk
+                    discard_attempt(job_info, dict_jobs[ids[0]])
+                    continue
+                for other, (_, info) in others.items():
+                    del attempts[other]
+                    cancel_attempt(other, info)
+                    discard_attempt(info, dict_jobs[ids[0]])
+                runtimes.append(time.monotonic() - starts[ids[0]])
+                yield ids, keep_attempt(output, job_info, ids, dict_jobs, dict_input)
+
+            if len(runtimes) < SPECULATION_MIN_FINISHED or any(
+                    not f.running() for f in attempts):
+                continue
+            limit = factor * median(runtimes)
+            now = time.monotonic()
+            stragglers = sorted(
+                (x for x in attempts.values() if x[0][0] not in speculated and
+                 now - starts.get(x[0][0], now) > limit),
+                key=lambda x: starts[x[0][0]])
+            for ids, job_info in stragglers[:max_workers - len(attempts)]:
+                logger.warning("STARTING A COPY OF THE SLOW JOBS IN {}".format(
+                    job_info['workdir']))
+                speculated.add(ids[0])
+                info = speculative_copy(job_info, dict_input['name'], inputs[ids[0]])
+                attempts[executor.submit(run_single_job, info, copy_input, len(ids))] = (ids, info)
+
+
+def chunk_inputs(workdir: Path) -> Dict[str, Union[bytes, str]]:
+    """Content of the files and target of the symlinks in the `workdir` of a chunk."""
+    inputs = {}
+    for x in workdir.iterdir():
+        if x.is_symlink():
+            inputs[x.name] = os.readlink(x)
+        elif x.is_file() and x.suffix not in ('.stdout', '.stderr'):
+            inputs[x.name] = x.read_bytes()
+
+    return inputs
+
+
+def speculative_copy(job_info: dict, name: str, inputs: Dict[str, Union[bytes, str]]) -> dict:
+    """Create a fresh workdir with the input files and symlinks of a chunk of jobs.
+
+    The paths to the workdir of the chunk (e.g. the `job_file` of the eqm
+    options) are replaced by the paths to the new workdir.
+    """
+    workdir = Path(job_info['workdir'])
+    copy_dir = workdir.with_name(workdir.name + '_speculative')
+    shutil.rmtree(copy_dir, ignore_errors=True)
+    copy_dir.mkdir()
+    for file_name, content in inputs.items():
+        if isinstance(content, str):
+            os.symlink(replace_workdir(content, workdir, copy_dir), copy_dir / file_name)
+        else:
+            (copy_dir / file_name).write_bytes(replace_workdir(content, workdir, copy_dir))
+
+    info = dict(job_info, workdir=copy_dir, job=copy_dir / 'job.xml')
+    info[name] = copy_dir / Path(job_info[name]).name
+
+    return info
+
+
+def replace_workdir(content: AnyStr, old: Path, new: Path) -> AnyStr:
+    """Replace the path `old` (but not e.g. `old_speculative`) in `content` by `new`."""
+    pattern = re.escape(old.absolute().as_posix()) + r'(?![\w.-])'
+    new = new.absolute().as_posix()
+    if isinstance(content, bytes):
+        pattern, new = os.fsencode(pattern), os.fsencode(new)
+
+    return re.sub(pattern, lambda _: new, content)
+
+
+def cancel_attempt(future, job_info: dict) -> None:
+    """Stop the command of a copy of a chunk and wait for its thread."""
+    while not future.done():
+        cancel_process(job_info['workdir'])
+        wait([future], 1)
+
+
+def discard_attempt(job_info: dict, original: dict) -> None:
+    """Remove the workdir of a speculative copy of a chunk."""
+    if job_info['workdir'] != original['workdir']:
+        shutil.rmtree(job_info['workdir'], ignore_errors=True)
+
+
+def keep_attempt(output: dict, job_info: dict, ids: List[str], dict_jobs: dict,
+                 dict_input: dict) -> dict:
+    """Move the results of the copy that finished first to the workdir of the chunk."""
+    workdir = dict_jobs[ids[0]]['workdir']
+    if job_info['workdir'] == workdir:
+        return output
+
+    copy_dir = Path(job_info['workdir'])
+    shutil.rmtree(workdir)
+    copy_dir.rename(workdir)
+    # Point the options of the chunk back to its workdir
+    for x in Path(workdir).iterdir():
+        if x.is_file() and not x.is_symlink() and x.suffix == '.xml':
+            x.write_bytes(replace_workdir(x.read_bytes(), copy_dir, Path(workdir)))
+    output = collect_output(workdir, dict_input['expected_output'])
+    if dict_input.get('journal') is not None and is_complete(output):
+        cmd = job_command(dict_jobs[ids[0]], dict_input, len(ids))
+        get_journal(dict_input['journal']).record(cmd, workdir, output)
+    stage_out_files(dict_input.get('stage_out'), output)
+
+    return output
+
+
+def run_batch_chunks(
+        chunks: List[List[str]], dict_jobs: dict, dict_input: dict) -> Iterator[Tuple]:
+    """Submit the `chunks` of jobs to the batch scheduler and yield their output.
+
+    The chunks already recorded in the journal are not submitted again.
+    """
+    journal = None if dict_input.get('journal') is None else get_journal(dict_input['journal'])
+
+    tasks, pending = [], []
+    for ids in chunks:
+        job_info = dict_jobs[ids[0]]
+        cmd = job_command(job_info, dict_input, len(ids))
+        output = None if journal is None else journal.lookup(cmd, job_info['workdir'])
+        if output is not None:
+            logger.info("SKIPPING FINISHED COMMAND: {}".format(cmd))
+            yield ids, output
+        else:
+            tasks.append((cmd, job_info['workdir']))
+            pending.append(ids)
+
+    scheduler = BatchScheduler(dict_input['batch'], dict_input['scratch_dir'] / 'batch')
+    exit_codes = scheduler.run(tasks, dict_input['name'])
+
+    for (cmd, workdir), ids, code in zip(tasks, pending, exit_codes):
+        if code != 0:
+            logger.error("BATCH COMMAND ERROR (exit code {}) in {}: {}".format(code, workdir, cmd))
+        output = collect_output(workdir, dict_input['expected_output'])
+        if journal is not None and code == 0 and is_complete(output):
+            journal.record(cmd, workdir, output)
+        stage_out_files(dict_input.get('stage_out'), output)
+        yield ids, output
+
+
+@schedule
+def pipeline_jobs(
+        eqm_jobs: dict, dict_eqm: dict, iqm_jobs: dict, dict_iqm: dict, names: list) -> dict:
+    """Run every chunk of eqm and iqm jobs as its own node of the workflow.
+
+    Each iqm chunk only waits for the eqm chunks computing its segments,
+    instead of waiting for all the eqm jobs. The `names` files of the eqm
+    jobs are moved to the scratch folder as soon as their chunk finishes.
+    Returns the results of the jobs in the same format as `run_parallel_jobs`
+    under the `eqm` and `iqm` keys.
+
+    The chunks are run directly by their nodes, therefore the cost ordering,
+    the speculative copies and the `batch` submission of `run_parallel_jobs`
+    are not available in this mode.
+    """
+    ignored = [x for x in ('batch', 'speculation', 'cost_model')
+               if dict_eqm.get(x) is not None or dict_iqm.get(x) is not None]
+    if ignored:
+        logger.warning("THE PIPELINED JOBS IGNORE THE OPTIONS: {}".format(", ".join(ignored)))
+
+    eqm_nodes = []
+    segment_nodes = {}
+    for ids in jobs_per_workdir(eqm_jobs).values():
+        node = run_chunk({key: eqm_jobs[key] for key in ids}, dict_eqm, names)
+        eqm_nodes.append(node)
+        for key in ids:
+            for segment in eqm_jobs[key].get('segments', []):
+                segment_nodes[segment] = node
+
+    iqm_nodes = []
+    for ids in jobs_per_workdir(iqm_jobs).values():
+        # Segments without eqm job in this run have already been computed
+        dependencies = {}
+        for key in ids:
+            for segment in iqm_jobs[key].get('segments', []):
+                if segment in segment_nodes:
+                    node = segment_nodes[segment]
+                    dependencies[id(node)] = node
+        iqm_nodes.append(run_chunk(
+            {key: iqm_jobs[key] for key in ids}, dict_iqm, [],
+            gather(*dependencies.values())))
+
+    return gather_dict(
+        eqm=collect_jobs(eqm_jobs, gather(*eqm_nodes), dict_eqm['scratch_dir']),
+        iqm=collect_jobs(iqm_jobs, gather(*iqm_nodes), dict_iqm['scratch_dir']))
+
+
+@schedule
+def run_chunk(jobs: dict, dict_input: dict, names: list, dependencies: list = None) -> dict:
+    """Run the `jobs` sharing a workdir, after the `dependencies` have finished.
+
+    The `names` files of every job are moved to the scratch folder.
+    """
+    ids = list(jobs)
+    output = split_chunk_output(
+        run_single_job(jobs[ids[0]], dict_input, len(ids)), ids, jobs)
+
+    results = {}
+    for key in ids:
+        job = jobs[key].copy()
+        job['job_workdir'] = job['workdir']
+        job.update(output[key] or {})
+        for name in names:
+            job[name] = move_job_files(job, name, dict_input['scratch_dir'])
+        results[key] = job
+
+    return results
+
+
+@schedule
+def collect_jobs(dict_jobs: dict, outputs: list, scratch_dir: Path) -> dict:
+    """Merge the `outputs` of the chunks of jobs."""
+    results = dict_jobs.copy()
+    for output in outputs:
+        results.update(output)
+
+    # Pack the state in the ouput
+    results['state'] = scratch_dir / 'state.sql'
+
+    return results
+
+
+def run_single_job(job_info: dict, dict_input: dict, n_jobs: int = 1) -> dict:
+    """Run the xtp_parallel command of the `n_jobs` in the `job_info` workdir.
+
+    The job file, where the results of the jobs are written, is cached
+    together with the output.
+    """
+    # Call subprocess
+    return run_cached_command(
+        job_command(job_info, dict_input, n_jobs), job_info['workdir'],
+        expected_output=dict_input['expected_output'], resources=job_resources(dict_input),
+        queue=dict_input.get('queue'), **cache_settings(job_info, dict_input))
+
+
+def job_resources(dict_input: dict) -> dict:
+    """Resources of a job, by default as many cores as threads."""
+    return dict_input.get('resources') or task_resources(dict_input.get('threads', 1))
+
+
+def cache_settings(job_info: dict, dict_input: dict) -> dict:
+    """Cache, journal and stage-out arguments of `run_cached_command` for a chunk of jobs."""
+    return {'cache_dir': dict_input.get('cache_dir'), 'journal': dict_input.get('journal'),
+            'stage_out': dict_input.get('stage_out'), 'cached_files': job_files(job_info)}
+
+
+def job_files(job_info: dict) -> List[str]:
+    """Job file of a chunk, relative to its workdir."""
+    if job_info.get('job') is None:
+        return []
+    path = Path(job_info['job'])
+    if not path.is_absolute():
+        return [path.as_posix()]
+    try:
+        return [path.relative_to(job_info['workdir']).as_posix()]
+    except ValueError:
+        return []
+
+
+def job_command(job_info: dict, dict_input: dict, n_jobs: int = 1) -> str:
+    """Create the xtp_parallel command running the `n_jobs` in the `job_info` workdir.
+
+    If a `state_snapshot` folder is given the job reads a copy of the state
+    in that folder, which is created by the first job running in each node.
+    """
+    state = dict_input['state']
+    prefix = ''
+    if dict_input.get('state_snapshot') is not None:
+        snapshot = snapshot_path(state, dict_input['state_snapshot'])
+        prefix = snapshot_command(state, snapshot) + ' && '
+        state = snapshot
+
+    # Name of the job to run
+    name = dict_input['name']
+
+    input_xml = job_info[name]
+    cmd_parallel = "xtp_parallel -e {} -f {} -o {} -t {} -c {} ".format(
+        name, state, input_xml, dict_input.get('threads', 1), n_jobs)
+
+    return prefix + cmd_parallel + dict_input['cmd_options']
+
+
+@schedule
+def read_jobs_into_state(jobs: dict, dict_read: dict) -> dict:
+    """Write the results of the split `jobs` into the state in a single step.
+
+    The job files of the chunks, containing the results, are merged into
+    the job file of the calculator, which is read into the state with a
+    single `xtp_parallel -j read` call.
+    """
+    name = dict_read['name']
+    path_jobs = Path(dict_read['{}_jobs'.format(name)])
+    job_files = sorted({Path(job['job']).as_posix() for job in jobs.values()
+                        if isinstance(job, dict) and 'job' in job})
+    merge_job_files(path_jobs.as_posix(), job_files)
+    release_snapshots(dict_read)
+
+    cmd = "xtp_parallel -e {} -f {} -o {} {}".format(
+        name, dict_read['state'], dict_read[name], dict_read['cmd_options'])
+    run_cached_command(
+        cmd, path_jobs.parent, expected_output=dict_read['expected_output'],
+        journal=dict_read.get('journal'))
+
+    results = jobs.copy()
+    results['state'] = Path(dict_read['state'])
+
+    return results
+
+
+def compute_max_workers(max_workers: int = None, threads: int = 1) -> int:
+    """Compute the number of jobs that can run concurrently.
+
+    If `max_workers` is not given, use the available cores divided by
+    the number of `threads` used by each job.
+    """
+    if max_workers is not None:
+        return max(1, int(max_workers))
+
+    cores = len(os.sched_getaffinity(0)) if hasattr(
+        os, 'sched_getaffinity') else os.cpu_count()
+    return max(1, (cores or 1) // max(1, threads))
+
+
+def compute_chunk_size(n_jobs: int, chunk_size: object = None, workers: int = 1) -> int:
+    """Compute the number of jobs grouped in a single xtp_parallel call.
+
+    If `chunk_size` is "auto" the jobs are distributed in (about) four
+    chunks per worker, to keep the workers busy until the end of the stage.
+    """
+    if chunk_size is None:
+        return 1
+    elif isinstance(chunk_size, str) and chunk_size.lower() == 'auto':
+        return max(1, -(-n_jobs // (4 * workers)))
+    return max(1, int(chunk_size))
+
+
+def jobs_per_workdir(dict_jobs: dict) -> Dict[Path, List[str]]:
+    """Group the job identifiers by the workdir where they run."""
+    chunks = defaultdict(list)
+    for key, job_info in dict_jobs.items():
+        if isinstance(job_info, dict) and 'workdir' in job_info:
+            chunks[job_info['workdir']].append(key)
+
+    return chunks
+
+
+def split_chunk_output(output: dict, ids: List[str], dict_jobs: dict) -> dict:
+    """Assign the files produced by a chunk of jobs to each one of the jobs.
+
+    A single file (e.g. job.tab) is shared by all the jobs in the chunk,
+    while the files of a list are assigned to the job with the segment
+    whose identifier is found in the file path.
+    """
+    if len(ids) == 1:
+        return {ids[0]: output}
+
+    owners = {seg: key for key in ids for seg in dict_jobs[key].get('segments', [])}
+    workdir = dict_jobs[ids[0]]['workdir']
+
+    rs = {key: {} for key in ids}
+    for name, val in output.items():
+        if not isinstance(val, list):
+            for key in ids:
+                rs[key][name] = val
+            continue
+        for key in ids:
+            rs[key][name] = []
+        for path in val:
+            candidates = (owners[x] for x in path_identifiers(path, workdir) if x in owners)
+            owner = next(candidates, ids[0])
+            rs[owner][name].append(path)
+
+    return rs
+
+
+def path_identifiers(path: str, workdir: Path) -> List[int]:
+    """Search for the integer identifiers in the path of a file, ignoring the frame."""
+    relative = Path(path).relative_to(workdir)
+    return [int(x) for part in relative.parts if not part.startswith('frame_')
+            for x in re.findall(r'_(\d+)', part)]
+
+
 @schedule
 def split_xqmultipole_calculations(input_dict: dict) -> dict:
     """
@@ -153,8 +836,8 @@ def split_xqmultipole_calculations(input_dict: dict) -> dict:
     """
     results = split_calculations(input_dict, 'xqmultipole_jobs')
 
-    for idx, config in results.items():
-        workdir = config['workdir']
+    for workdir, ids in jobs_per_workdir(results).items():
+        config = results[ids[0]]
 
         # Replace path to MP_FILES
         mp_files = input_dict['mp_files'].absolute().as_posix()
@@ -165,12 +848,13 @@ def split_xqmultipole_calculations(input_dict: dict) -> dict:
             {'multipoles': input_dict['system'],
              'control': {'job_file': config['job'].name,
                          'emp_file': input_dict['mps_tab']}},
-            'job': {'input': {
-                'replace_regex': ('MP_FILES', mp_files)}}
+            'job': {'': {
+                'replace_regex_recursively': ('MP_FILES', mp_files)}}
         }
         edited_files = edit_xml_options(options, workdir)
-        results[idx]['xqmultipole'] = edited_files['xqmultipole']
-        results[idx]['job'] = edited_files['job']
+        for idx in ids:
+            results[idx]['xqmultipole'] = edited_files['xqmultipole']
+            results[idx]['job'] = edited_files['job']
 
     return {k: v for k, v in results.items()}
 
@@ -181,15 +865,15 @@ def split_eqm_calculations(input_dict: dict) -> dict:
     Split the jobs specified in eqm.jobs into independent jobs.
     """
     results = split_calculations(input_dict, 'eqm_jobs')
-    # path_optionfiles = input_dict['path_optionfiles']
 
-    for idx, config in results.items():
-        workdir = config['workdir']
-        sections = {'job_file': config['job'].as_posix()}
+    for workdir, ids in jobs_per_workdir(results).items():
+        sections = {'job_file': results[ids[0]]['job'].as_posix()}
 
         path_file = workdir / 'eqm.xml'
-        results[idx]['eqm'] = edit_xml_file(
-            path_file.as_posix(), 'eqm', sections)
+        edited_file = edit_xml_file(path_file.as_posix(), 'eqm', sections)
+        for idx in ids:
+            results[idx]['eqm'] = edited_file
+
     return {k: v for k, v in results.items()}
 
 
@@ -200,19 +884,20 @@ def split_iqm_calculations(input_dict: dict) -> dict:
     """
     results = split_calculations(input_dict, 'iqm_jobs')
 
-    for idx, config in results.items():
-        workdir = config['workdir']
+    for workdir, ids in jobs_per_workdir(results).items():
         options = {
             'iqm': {
-                'job_file': config['job'].name,
+                'job_file': results[ids[0]]['job'].name,
             }
         }
         # Make a symbolic link to the or_files
-        os.symlink(input_dict['scratch_dir'] /
-                   "OR_FILES", workdir / "OR_FILES")
+        link = workdir / "OR_FILES"
+        if not link.is_symlink():
+            os.symlink(input_dict['scratch_dir'] / "OR_FILES", link)
 
         edited_files = edit_xml_options(options, workdir)
-        results[idx]['iqm'] = edited_files['iqm']
+        for idx in ids:
+            results[idx]['iqm'] = edited_files['iqm']
 
     return {k: v for k, v in results.items()}
 
@@ -227,43 +912,102 @@ def split_calculations(input_dict: dict, jobs_name: str) -> dict:
     """
     Split the jobs specified in a xml file in independent jobs that
     run independently.
+
+    The jobs are grouped in chunks of `chunk_size` jobs, every chunk
+    has its own workdir and job file. Only the available jobs are read
+    from the job file using its index, writing the folders of the chunks
+    in batches while reading.
     """
     tmp_dir = create_workdir(input_dict['scratch_dir'], jobs_name)
+    index = JobIndex.load(input_dict[jobs_name])
+    available = index.ids("AVAILABLE")
+
+    workers = compute_max_workers(
+        input_dict.get('max_workers'), input_dict.get('threads', 1))
+    size = compute_chunk_size(len(available), input_dict.get('chunk_size'), workers)
+
+    # Input option file copied to each workdir
+    path_option = Path(input_dict[input_dict['name']])
+    option_content = path_option.read_bytes()
 
-    # Copy job dependencies to a new folder
     results = defaultdict(dict)
-    for job in read_available_jobs(input_dict[jobs_name]):
-        # identifier
-        idx = job.find('id').text
+    batch = []
+    with ThreadPoolExecutor(max_workers=IO_WORKERS) as executor:
+        for chunk in iter_chunks(zip(available, index.read_jobs(available)), size):
+            # identifiers
+            ids = [str(i) for i, _ in chunk]
+
+            if len(ids) == 1:
+                name = "{}_{}".format('job', ids[0])
+            else:
+                name = "{}_{}_{}".format('chunk', ids[0], ids[-1])
+            workdir = tmp_dir / name
 
-        name = "{}_{}".format('job', idx)
-        workdir = create_workdir(tmp_dir, name)
-        results[idx]['workdir'] = workdir
+            files = {'job.xml': raw_job_file_content([job for _, job in chunk]),
+                     path_option.name: option_content}
+            batch.append((workdir, files))
 
-        # Job files
-        results[idx]['job'] = create_xml_job_file(job, workdir)
+            for idx, (i, _) in zip(ids, chunk):
+                results[idx]['workdir'] = workdir
+                results[idx]['job'] = workdir / 'job.xml'
+                results[idx]['segments'] = [x for x, _ in index.segments(i)]
 
-        # Move input option file to workdir
-        name = input_dict['name']
-        shutil.copy(input_dict[name], workdir.as_posix())
+            if len(batch) == SPLIT_BATCH_SIZE:
+                list(executor.map(write_job_folder, batch))
+                batch = []
+
+        list(executor.map(write_job_folder, batch))
 
     return results
 
 
+def iter_chunks(jobs: Iterator, size: int) -> Iterator[List]:
+    """Group the `jobs` in lists of at most `size` elements."""
+    jobs = iter(jobs)
+    chunk = list(islice(jobs, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(jobs, size))
+
+
+def write_job_folder(folder: Tuple[Path, Dict[str, bytes]]) -> None:
+    """Create the workdir of a job and write its `files`.
+
+    When the workflow is resumed, the job file of a chunk whose jobs have
+    all finished is kept, since it holds the results of the jobs.
+    """
+    workdir, files = folder
+    workdir.mkdir(exist_ok=True)
+    for name, content in files.items():
+        if name == 'job.xml' and has_finished_jobs(workdir / name):
+            continue
+        with open(workdir / name, 'wb') as f:
+            f.write(content)
+
+
+def has_finished_jobs(path_job: Path) -> bool:
+    """Check if all the jobs in the job file `path_job` have finished."""
+    if not path_job.is_file() or path_job.stat().st_size == 0:
+        return False
+    index = JobIndex.build(path_job)
+
+    return len(index) > 0 and all(index.status(i) in FINISHED_STATUSES for i in index.ids())
+
+
 def create_workdir(tmp_dir: Path, name: str):
     """
     Create temporal workdir
     """
-    # create workdir for each job
+    # create workdir for each job, reusing it if the workflow is resumed
     workdir = tmp_dir / name
-    workdir.mkdir()
+    workdir.mkdir(exist_ok=True)
 
     return workdir
 
 
 def create_xml_job_file(job: object, workdir: Path) -> Path:
     """
-    Create an xml file containing a single job
+    Create an xml file containing a single job or a list of jobs
     """
     job_file = workdir / 'job.xml'
     create_job_file(job, job_file.as_posix())
@@ -291,23 +1035,40 @@ def rename_map_file(path_file: Path, expression: str, new_val: str):
 @schedule
 def move_results_to_workdir(jobs: dict, names: list,  workdir: Path) -> dict:
     """
-    Move all the resulting or_files to the same central location
-    """
-    def collect_new_files(job, name):
-        new_files = []
-        for path in (Path(x) for x in job[name]):
-            relative = path.relative_to(job['job_workdir'])
-            folder_dest = workdir / relative.parent
-            os.makedirs(folder_dest.as_posix(), exist_ok=True)
-            dst = folder_dest / path.name
-            shutil.move(path.as_posix(), dst.as_posix())
-            new_files.append(dst / path.name)
-
-        return new_files
+    Move all the resulting or_files to the same central location.
 
+    The files are hard linked (or copied if the link fails) so that the
+    output of the finished jobs stays available if the workflow is resumed.
+    """
     for k, job in jobs.items():
         for name in names:
             if isinstance(job, dict):
-                jobs[k][name] = collect_new_files(job, name)
+                jobs[k][name] = move_job_files(job, name, workdir)
 
     return jobs
+
+
+def move_job_files(job: dict, name: str, workdir: Path) -> List[Path]:
+    """Move the `name` files of a single `job` to the same relative path in `workdir`."""
+    new_files = []
+    for path in (Path(x) for x in job[name]):
+        relative = path.relative_to(job['job_workdir'])
+        folder_dest = workdir / relative.parent
+        os.makedirs(folder_dest.as_posix(), exist_ok=True)
+        dst = folder_dest / path.name
+        link_or_copy(path, dst)
+        new_files.append(dst)
+
+    return new_files
+
+
+def link_or_copy(src: Path, dst: Path) -> None:
+    """Hard link `src` to `dst`, falling back to a copy."""
+    if dst.exists():
+        if dst.samefile(src):
+            return
+        dst.unlink()
+    try:
+        os.link(src.as_posix(), dst.as_posix())
+    except OSError:
+        shutil.copy2(src.as_posix(), dst.as_posix())
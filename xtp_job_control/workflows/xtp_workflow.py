@@ -1,23 +1,30 @@
 """Functions defining the xtp_votca workflows."""
+import atexit
 import datetime
 import logging
 import os
 import shutil
 import tempfile
-from distutils.dir_util import copy_tree
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
+from queue import Queue
 from typing import Callable, Dict
 
 import yaml
-from noodles import lift, schedule
+from noodles import gather_dict, lift, schedule
 from noodles.interface import PromisedObject
 
+from ..content_store import ContentStore
+from ..job_queue import open_pilot_queue
+from ..resources import configure_resource_pool, task_resources
 from ..results import Options, Results
-from ..xml_editor import edit_xml_file
+from ..xml_editor import detach_file, edit_xml_file, link_tree
 from .workflow_components import (call_xtp_cmd, create_promise_command,
                                   edit_jobs_file, edit_options,
-                                  move_results_to_workdir, rename_map_file,
-                                  run_parallel_jobs, split_eqm_calculations,
+                                  move_results_to_workdir, pipeline_jobs,
+                                  read_jobs_into_state, rename_map_file,
+                                  run_parallel_jobs, screen_iqm_jobs,
+                                  split_eqm_calculations,
                                   split_iqm_calculations,
                                   split_qmmm_calculations,
                                   split_xqmultipole_calculations)
@@ -25,6 +32,15 @@ from .workflow_components import (call_xtp_cmd, create_promise_command,
 # Starting logger
 logger = logging.getLogger(__name__)
 
+# User options containing paths that are not copied to the scratch folder
+NOT_STAGED_OPTIONS = {'task_cache', 'content_store', 'scratch_root', 'runtime_history'}
+
+# User inputs modified in place by the calculators
+MUTABLE_INPUTS = {'state'}
+
+# Output of the eqm jobs collected in the scratch folder
+EQM_RESULTS = ('molecule_orb', 'dft_orb', 'mps_file')
+
 
 def recursively_create_path(dict_input: dict) -> dict:
     """Convert all the entries of the dict_input that are file into Path objects."""
@@ -38,6 +54,38 @@ def recursively_create_path(dict_input: dict) -> dict:
     return dict_input
 
 
+def task_settings(options: Options, cached: bool = True) -> dict:
+    """Settings shared by all the xtp calls of a workflow.
+
+    The calls that modify the state must not be `cached`, restoring their
+    output files from the cache would skip the changes to the state.
+    """
+    return {'cache_dir': options.task_cache if cached else None, 'journal': options.journal,
+            'stage_out': options.stage_out_dirs}
+
+
+def calculator_resources(
+        options: Options, name: str, threads: int = 1, sections: tuple = ()) -> dict:
+    """Resources of the xtp call running the calculator `name`.
+
+    The cores are the `threads` of the call or the `openmp`/`threads` given
+    in the options of the calculators in `sections`, whichever is larger.
+    The `resources` option of the user may override the cores, the memory
+    (MB) and the `timeout` (seconds, together with the `kill_signal` and
+    `kill_grace`) of every calculator.
+    """
+    calculators = options.votca_calculators_options
+    cores = [threads]
+    for section in sections:
+        opts = calculators.get(section) or {}
+        cores.extend(x for x in (opts.get('openmp'), opts.get('threads'))
+                     if isinstance(x, int) and x > 0)
+    resources = task_resources(max(cores))
+    resources.update((options.resources or {}).get(name, {}))
+
+    return resources
+
+
 def edit_calculator_options(options: Options, sections: list) -> dict:
     """Edit the options of a calculator using the values provided by the user."""
     return edit_options(
@@ -75,6 +123,7 @@ def create_user_input(options: Options):
 </package>
 """
     path = options.path_optionfiles / "user_input.xml"
+    detach_file(path)
     with open(path, 'w') as f:
         f.write(user_input)
 
@@ -89,7 +138,8 @@ def run_eanalyze(results: Results, options: Options, state: PromisedObject) -> D
         "xtp_run -e eanalyze -o {} -f {}", path_analyze, state)
 
     return call_xtp_cmd(
-        cmd_eanalyze, options.scratch_dir / 'eanalyze', expected_output=expected_output)
+        cmd_eanalyze, options.scratch_dir / 'eanalyze', expected_output=expected_output,
+        **task_settings(options))
 
 
 def run_ianalyze(results: Results, options: Options, state: PromisedObject) -> Dict:
@@ -101,7 +151,8 @@ def run_ianalyze(results: Results, options: Options, state: PromisedObject) -> D
         "xtp_run -e ianalyze -o {} -f {}", path_analyze, state)
 
     return call_xtp_cmd(
-        cmd_eanalyze, options.scratch_dir / 'ianalyze', expected_output=expected_output)
+        cmd_eanalyze, options.scratch_dir / 'ianalyze', expected_output=expected_output,
+        **task_settings(options))
 
 
 def run_dftgwbse(results: Results, options: Options) -> dict:
@@ -123,7 +174,9 @@ def run_dftgwbse(results: Results, options: Options) -> dict:
     return call_xtp_cmd(
         cmd_dftgwbse, options.scratch_dir / "dft_gwbse", expected_output={
             "log": "dftgwbse.log", "out": "dftgwbse.out.xml",
-            "system_dft": "system_dft.orb", "system": "system.orb"})
+            "system_dft": "system_dft.orb", "system": "system.orb"},
+        resources=calculator_resources(options, 'dftgwbse', threads, ('xtpdft', 'mbgft')),
+        **task_settings(options))
 
 
 def run_dump(results: Results, options: Options, state: PromisedObject) -> dict:
@@ -136,7 +189,7 @@ def run_dump(results: Results, options: Options, state: PromisedObject) -> dict:
 
     return call_xtp_cmd(cmd_dump, options.scratch_dir / "dump", expected_output={
         'md_trajectory': 'extract.trajectory_md.pdb',
-        'qm_trajectory': 'extract.trajectory_qm.pdb'})
+        'qm_trajectory': 'extract.trajectory_qm.pdb'}, **task_settings(options))
 
 
 def run_einternal(results: Results, options: Options, state: PromisedObject) -> dict:
@@ -146,11 +199,46 @@ def run_einternal(results: Results, options: Options, state: PromisedObject) ->
         "xtp_run -e einternal -o {} -f {}", einternal_file, state)
     return call_xtp_cmd(
         cmd_einternal, options.scratch_dir,
-        expected_output={'einternal': einternal_file})
+        expected_output={'einternal': einternal_file}, journal=options.journal)
 
 
 def run_eqm(results: Results, options: Options, state: PromisedObject) -> dict:
     """Run the eqm jobs."""
+    setup_eqm(results, options, state)
+
+    jobs_eqm = distribute_eqm_jobs(results, options, state)
+
+    # Finally move all the OR_FILES to the same folder in the scratch_dir
+    return move_results_to_workdir(jobs_eqm, EQM_RESULTS, options.scratch_dir)
+
+
+def run_eqm_iqm(results: Results, options: Options, state: PromisedObject) -> dict:
+    """Run the eqm and iqm jobs as a pipeline.
+
+    Every chunk of jobs is a node of the workflow and each iqm job starts
+    as soon as the eqm jobs of its two segments have finished. Returns the
+    results of the eqm and iqm jobs under the `eqm` and `iqm` keys, once the
+    results of the iqm jobs are read into the state. The workflow must be
+    run with several threads to overlap the jobs.
+    """
+    setup_eqm(results, options, state)
+    setup_iqm(results, options, state)
+
+    dict_eqm = lift(eqm_jobs_input(results, options, state))
+    dict_iqm = iqm_jobs_input(results, options, state)
+
+    jobs = pipeline_jobs(
+        split_eqm_calculations(dict_eqm), dict_eqm,
+        split_iqm_calculations(lift(dict_iqm)), lift(dict_iqm), EQM_RESULTS)
+
+    # Write the results of all the iqm jobs into the state at once, the
+    # item of the pipeline is only available once all its jobs have finished
+    return gather_dict(
+        eqm=jobs['eqm'], iqm=read_jobs_into_state(jobs['iqm'], lift(read_input(dict_iqm))))
+
+
+def setup_eqm(results: Results, options: Options, state: PromisedObject) -> None:
+    """Write and select the eqm jobs."""
     # set user-defined valuess
     results['job_opts_eqm'] = edit_calculator_options(
         options, ['eqm', 'xtpdft', 'esp2multipole'])
@@ -160,20 +248,13 @@ def run_eqm(results: Results, options: Options, state: PromisedObject) -> dict:
         state)
     results['job_setup_eqm'] = call_xtp_cmd(
         cmd_eqm_write, options.scratch_dir,
-        expected_output={"eqm_jobs": "eqm.jobs"})
+        expected_output={"eqm_jobs": "eqm.jobs"}, **task_settings(options, cached=False))
 
     # Select the number of jobs to run based on the input provided by the user
     results['job_select_eqm_jobs'] = edit_jobs_file(
         results['job_setup_eqm']['eqm_jobs'],
         options.eqm_jobs)
 
-    jobs_eqm = distribute_eqm_jobs(results, options, state)
-
-    # Finally move all the OR_FILES to the same folder in the scratch_dir
-    names = ('molecule_orb', 'dft_orb', 'mps_file')
-
-    return move_results_to_workdir(jobs_eqm, names, options.scratch_dir)
-
 
 def run_gencube(results: Results, options: Options) -> dict:
     """
@@ -188,41 +269,46 @@ def run_gencube(results: Results, options: Options) -> dict:
 
 
 def run_iqm(results: Results, options: Options, state: PromisedObject) -> dict:
-    """Run the eqm jobs."""
+    """Run the iqm jobs."""
+    setup_iqm(results, options, state)
+
+    return distribute_iqm_jobs(results, options, state)
+
+
+def setup_iqm(results: Results, options: Options, state: PromisedObject) -> None:
+    """Write and select the iqm jobs."""
     # Copy option files
     src = ["mbgft.xml", "xtpdft.xml"]
     dst = ["mbgft_pair.xml", "xtpdft_pair.xml"]
     copy_option_files(options.path_optionfiles, src, dst)
 
-    results['job_opts_iqm'] = edit_calculator_options(
-        options, ['iqm', 'xtpdft_pair', 'mbgft_pair'])
+    # replace optionfiles with its absolute path, together with the user edits,
+    # without modifying the options of the user
+    calculators_options = options.votca_calculators_options.copy()
+    calculators_options['iqm'] = dict(calculators_options['iqm'], **{'': {
+        'replace_regex_recursively': ('OPTIONFILES', to_posix(options.path_optionfiles))}})
 
-    # replace optionfiles with its absolute path
-    sections_to_edit = {
-        '': {
-            'replace_regex_recursively':
-                ('OPTIONFILES', to_posix(options.path_optionfiles))}
-    }
-
-    edited_iqm_file = schedule(edit_xml_file)(
-        results['job_opts_iqm']['iqm'], 'iqm', sections_to_edit)
+    results['job_opts_iqm'] = edit_options(
+        calculators_options, ['iqm', 'xtpdft_pair', 'mbgft_pair'], options.path_optionfiles)
 
     # write into state
     cmd_iqm_write = create_promise_command(
-        "xtp_parallel -e iqm -o {} -f {} -s 0 -j write", edited_iqm_file,
+        "xtp_parallel -e iqm -o {} -f {} -s 0 -j write", results['job_opts_iqm']['iqm'],
         state)
 
     results['job_setup_iqm'] = call_xtp_cmd(
         cmd_iqm_write, options.scratch_dir / 'iqm', expected_output={
-            'iqm_jobs': "iqm.jobs"}
-    )
+            'iqm_jobs': "iqm.jobs"}, **task_settings(options, cached=False))
+
+    # Keep only the pairs passing the pre-screening of their geometry
+    iqm_selection = options.iqm_jobs
+    if options.iqm_screening is not None:
+        iqm_selection = screen_iqm_jobs(options.iqm_jobs, state, options.iqm_screening)
 
     # Select the number of jobs to run based on the input provided by the user
     results['job_select_iqm_jobs'] = edit_jobs_file(
         results['job_setup_iqm']['iqm_jobs'],
-        options.iqm_jobs)
-
-    return distribute_iqm_jobs(results, options, state)
+        iqm_selection)
 
 
 def run_kmcmultiple(results: Results, options: Options, state) -> dict:
@@ -240,7 +326,7 @@ def run_kmcmultiple(results: Results, options: Options, state) -> dict:
     return call_xtp_cmd(args, options.scratch_dir / "kmcmultiple", expected_output={
         "timedependence": "timedependence.csv",
         "trajectory": "trajectory.csv"
-    })
+    }, **task_settings(options))
 
 
 def run_kmclifetime(results: Results, options: Options, state) -> dict:
@@ -259,7 +345,7 @@ def run_kmclifetime(results: Results, options: Options, state) -> dict:
         state)
 
     return call_xtp_cmd(args, options.scratch_dir / "kmclifetime", expected_output={
-        "lifetimes": "*csv"})
+        "lifetimes": "*csv"}, **task_settings(options))
 
 
 def run_neighborlist(results: Results, options: Options, state: PromisedObject) -> dict:
@@ -277,7 +363,7 @@ def run_neighborlist(results: Results, options: Options, state: PromisedObject)
     return call_xtp_cmd(
         cmd_neighborlist, options.scratch_dir, expected_output={
             'neighborlist': "OPTIONFILES/neighborlist.xml",
-            'state': 'state.sql'})
+            'state': 'state.sql'}, **task_settings(options, cached=False))
 
 
 def run_partialcharges(results: Results, options: Options, promise: PromisedObject = None) -> dict:
@@ -330,7 +416,8 @@ def run_xqmultipole(results: Results, options: Options, state: PromisedObject) -
     results['job_setup_xqmultipole'] = call_xtp_cmd(
         cmd_setup_xqmultipole, options.scratch_dir / "xqmultipole", expected_output={
             'mps_tab': 'jobwriter.mps.background.tab',
-            'xqmultipole_jobs': 'jobwriter.mps.monomer.xml'})
+            'xqmultipole_jobs': 'jobwriter.mps.monomer.xml'},
+        **task_settings(options))
 
     # change path of the MP_FILES
     mp_files = to_posix(options.mp_files.absolute())
@@ -365,7 +452,18 @@ def distribute_xqmultipole_jobs(results: Results, options: Options, state: Promi
         'system': results['job_system']['system'],
         'state': state,
         'mps_tab': results['job_setup_xqmultipole']['mps_tab'],
-        'cmd_options': "-s 0 -t 1 -c 1000 -j run > xqmultipole.log",
+        'max_workers': options.max_workers,
+        'chunk_size': options.chunk_size,
+        **task_settings(options),
+        'threads': 1,
+        'queue': options.job_queue,
+        'batch': options.batch,
+        'state_snapshot': options.state_snapshot,
+        'cost_model': options.cost_model,
+        'runtime_history': options.runtime_history,
+        'speculation': options.speculation,
+        'resources': calculator_resources(options, 'xqmultipole', 1, ('xqmultipole',)),
+        'cmd_options': "-s 0 -j run > xqmultipole.log",
         'expected_output': {'tab': 'job.tab'}
 
     }
@@ -374,45 +472,90 @@ def distribute_xqmultipole_jobs(results: Results, options: Options, state: Promi
 
 def distribute_eqm_jobs(results: Results, options: Options, state: PromisedObject) -> dict:
     """Run the eqm job in separated folders."""
-    dict_input = {
+    return distribute_job(eqm_jobs_input(results, options, state), split_eqm_calculations)
+
+
+def distribute_iqm_jobs(results: Results, options: Options, state: PromisedObject) -> dict:
+    """Run the iqm jobs independently."""
+    dict_input = iqm_jobs_input(results, options, state)
+    dict_input['jobs_eqm'] = results['jobs_eqm']
+
+    jobs = distribute_job(dict_input, split_iqm_calculations)
+
+    # Write the results of all the jobs into the state at once
+    return read_jobs_into_state(jobs, lift(read_input(dict_input)))
+
+
+def read_input(dict_input: dict) -> dict:
+    """Parameters to read the results of the split jobs into the state."""
+    dict_read = dict_input.copy()
+    dict_read['cmd_options'] = "-j read"
+    dict_read['expected_output'] = None
+
+    return dict_read
+
+
+def eqm_jobs_input(results: Results, options: Options, state: PromisedObject) -> dict:
+    """Parameters to split and run the eqm jobs."""
+    return {
         'name': 'eqm',
         'scratch_dir': options.scratch_dir,
         'eqm_jobs': results['job_setup_eqm']['eqm_jobs'],
+        # The jobs are split once they have been selected
+        'job_select': results['job_select_eqm_jobs'],
         'state': state,
         'eqm': results['job_opts_eqm']['eqm'],
         'path_optionfiles': options.path_optionfiles,
-        'cmd_options': "-s 0 -j run -c 1 -t 1",
+        'max_workers': options.max_workers,
+        'chunk_size': options.chunk_size,
+        **task_settings(options),
+        'threads': 1,
+        'queue': options.job_queue,
+        'batch': options.batch,
+        'state_snapshot': options.state_snapshot,
+        'cost_model': options.cost_model,
+        'runtime_history': options.runtime_history,
+        'speculation': options.speculation,
+        'resources': calculator_resources(
+            options, 'eqm', 1, ('eqm', 'xtpdft', 'mbgft', 'esp2multipole')),
+        'cmd_options': "-s 0 -j run",
         'expected_output': {
             'tab': 'job.tab',
             'dft_orb': "OR_FILES/xtp_eqm/frame_0/molecule_*/*.orb",
             'molecule_orb': 'OR_FILES/molecules/frame_0/*.orb',
             'mps_file': 'MP_FILES/frame_0/*/*.mps'}
     }
-    return distribute_job(dict_input, split_eqm_calculations)
 
 
-def distribute_iqm_jobs(results: Results, options: Options, state: PromisedObject) -> dict:
-    """Run the iqm jobs independently."""
-    dict_input = {
+def iqm_jobs_input(results: Results, options: Options, state: PromisedObject) -> dict:
+    """Parameters to split and run the iqm jobs."""
+    return {
         'name': 'iqm',
         'scratch_dir': options.scratch_dir,
         'iqm_jobs': results['job_setup_iqm']['iqm_jobs'],
+        # The jobs are split once they have been selected
+        'job_select': results['job_select_iqm_jobs'],
         'state': state,
         'iqm': results['job_opts_iqm']['iqm'],
-        'jobs_eqm': results['jobs_eqm'],
         'path_optionfiles': options.path_optionfiles,
-        'cmd_options': "-s 0 -j run -c 1 -t 1",
+        'max_workers': options.max_workers,
+        'chunk_size': options.chunk_size,
+        **task_settings(options),
+        'threads': 1,
+        'queue': options.job_queue,
+        'batch': options.batch,
+        'state_snapshot': options.state_snapshot,
+        'cost_model': options.cost_model,
+        'runtime_history': options.runtime_history,
+        'speculation': options.speculation,
+        'resources': calculator_resources(
+            options, 'iqm', 1, ('iqm', 'xtpdft_pair', 'mbgft_pair', 'bsecoupling')),
+        'cmd_options': "-s 0 -j run",
         'expected_output': {
             'tab': 'job.tab'
         }
     }
 
-    dict_read = dict_input.copy()
-    dict_read['cmd_options'] = " -j read"
-    dict_read['expected_output'] = None
-
-    return distribute_job(dict_input, split_iqm_calculations)
-
 
 def distribute_qmmm_jobs(results: Results, options: Options, state: PromisedObject) -> dict:
     """
@@ -443,6 +586,9 @@ def write_output(output: dict, options: Options, file_name: str = "results") ->
 
 def copy_option_files(optionfiles, src, dst):
     for s, d in zip(src, dst):
+        # do not write through a link to the templates
+        if (optionfiles / d).is_symlink():
+            (optionfiles / d).unlink()
         shutil.copyfile(
             to_posix(optionfiles / s),
             to_posix(optionfiles / d))
@@ -463,47 +609,110 @@ def to_posix(d):
 
 
 def initial_config(options: Options) -> Dict:
-    """Setup to call xtp tools."""
+    """Setup to call xtp tools.
+
+    The scratch folder is created in `scratch_root` (by default the system
+    temporary folder), which may contain environmental variables, e.g.
+    `$TMPDIR`. If `resume` contains the path to the scratch folder of a
+    previous run, such folder is reused and the input files are not copied
+    again. If `stage_out` is true the output of the tasks is copied in the
+    background to a folder with the same name inside `workdir`. If
+    `pilot_workers` is given, the split jobs are run by pilot workers reading
+    the queue `jobs.sqlite` in the scratch folder, starting `pilot_workers`
+    of them in this machine. The split jobs submitted to a `batch` scheduler
+    run in other nodes, therefore `scratch_root` must be given explicitly
+    (in a shared filesystem) instead of using the local temporary folder.
+    """
     config_logger(options['workdir'])
-    ts = datetime.datetime.now().isoformat()
-    scratch_dir = tempfile.gettempdir() / Path('xtp_' + str(ts))
-    scratch_dir.mkdir()
-
-    # Option files
-    optionfiles = scratch_dir / 'OPTIONFILES'
-    optionfiles.mkdir()
-    posix_optionfiles = to_posix(optionfiles)
-
-    # Copy option files to temp file
-    path_votcashare = options['path_votcashare']
-    copy_tree(path_votcashare / 'xtp/xml', posix_optionfiles)
-    copy_tree(path_votcashare / 'xtp/packages', posix_optionfiles)
+    if options.get('batch') and options.get('scratch_root') is None and \
+            options.get('resume') is None:
+        raise RuntimeError(
+            "The batch option needs a scratch_root in a filesystem shared with the compute nodes")
+    node = options.get('node') or {}
+    configure_resource_pool(node.get('cores'), node.get('memory'))
+    resume = options.get('resume')
+    if resume is not None:
+        scratch_dir = Path(resume).absolute()
+        optionfiles = scratch_dir / 'OPTIONFILES'
+    else:
+        ts = datetime.datetime.now().isoformat()
+        scratch_dir = scratch_root(options.get('scratch_root')) / Path('xtp_' + str(ts))
+        scratch_dir.mkdir(parents=True)
+
+        # Option files
+        optionfiles = scratch_dir / 'OPTIONFILES'
+        optionfiles.mkdir()
+
+        # Link the option files, which are only copied before being edited
+        path_votcashare = options['path_votcashare']
+        link_tree(path_votcashare / 'xtp/xml', optionfiles)
+        link_tree(path_votcashare / 'xtp/packages', optionfiles)
 
     # Copy input provided by the user to tempfolder
+    store = None if options.get('content_store') is None else ContentStore(
+        options['content_store'])
     d = options.copy()
     for key, path in d.items():
+        if key in NOT_STAGED_OPTIONS:
+            continue
         if isinstance(path, Path) and 'votca' not in path.name.lower():
             abs_path = scratch_dir / path.name
-            if path.is_file():
+            if resume is not None and abs_path.exists():
+                options[key] = abs_path
+            elif store is not None and (path.is_file() or not abs_path.exists()):
+                options[key] = store.stage(path, abs_path, mutable=key in MUTABLE_INPUTS)
+            elif path.is_file():
                 shutil.copy(to_posix(path), scratch_dir)
                 options[key] = abs_path
             elif path.is_dir() and not abs_path.exists():
                 shutil.copytree(to_posix(path), to_posix(abs_path))
                 options[key] = abs_path
 
+    # Queue of the split jobs run by the pilot workers
+    job_queue = None
+    if options.get('pilot_workers') is not None:
+        job_queue = open_pilot_queue(scratch_dir / 'jobs.sqlite', options['pilot_workers'])
+
+    stage_out_dirs = None
+    if options.get('stage_out'):
+        stage_out_dirs = {'scratch_dir': scratch_dir,
+                          'destination': Path(options['workdir']).absolute() / scratch_dir.name}
+
     dict_config = {
-        'scratch_dir': scratch_dir, 'path_optionfiles': optionfiles}
+        'scratch_dir': scratch_dir, 'path_optionfiles': optionfiles,
+        'journal': scratch_dir / 'journal.jsonl', 'stage_out_dirs': stage_out_dirs,
+        'job_queue': job_queue}
     options.update(dict_config)
 
     return options
 
 
+def scratch_root(root: str = None) -> Path:
+    """Folder where the scratch folders are created, expanding the environmental variables."""
+    if root is None:
+        return Path(tempfile.gettempdir())
+    return Path(os.path.expandvars(str(root))).expanduser()
+
+
 def config_logger(workdir: str):
-    """Setup the logging infrasctucture."""
+    """Setup the logging infrasctucture.
+
+    The records are sent through a queue to a listener thread that writes
+    them to the log file, without blocking the caller.
+    """
     file_log = os.path.join(workdir, 'xtp.log')
-    logging.basicConfig(filename=file_log, level=logging.DEBUG,
-                        format='%(asctime)s---%(levelname)s\n%(message)s\n',
-                        datefmt='[%I:%M:%S]')
+    root = logging.getLogger()
+    if any(isinstance(h, QueueHandler) for h in root.handlers):
+        return
+
+    file_handler = logging.FileHandler(file_log)
+    file_handler.setFormatter(logging.Formatter(
+        '%(asctime)s---%(levelname)s\n%(message)s\n', datefmt='[%I:%M:%S]'))
+    log_queue = Queue(-1)
+    listener = QueueListener(log_queue, file_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root.addHandler(QueueHandler(log_queue))
+    root.setLevel(logging.DEBUG)
     logging.getLogger("noodles").setLevel(logging.WARNING)
-    handler = logging.StreamHandler()
-    handler.terminator = ""
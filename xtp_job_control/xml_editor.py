@@ -2,25 +2,83 @@
 
 from os.path import join
 from pathlib import Path
-from typing import (Any, Dict, List)
+from typing import (Any, Dict, FrozenSet, Iterator, List, Union)
+import os
 import re
+import shutil
+import tempfile
 import xml.etree.ElementTree as ET
 
+from .job_index import FINISHED_STATUSES, JobIndex
+from .selection import select_jobs
+
+
+class OptionSet:
+    """Set of XML option files edited in memory.
+
+    Each file is parsed the first time that it is edited and it is written
+    only once when the set is flushed, no matter how many edits have been
+    applied to it. It can be used as a context manager that flushes
+    the edited files on exit. The names of the option files are listed
+    once per set.
+    """
+
+    def __init__(self, path_optionfiles: Path):
+        self.path_optionfiles = Path(path_optionfiles)
+        self.trees = {}
+        self.names = None
+
+    def __enter__(self) -> "OptionSet":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.flush()
+
+    def path(self, xml_file: str) -> Path:
+        """Path to the `xml_file` option file."""
+        return self.path_optionfiles / '{}.xml'.format(xml_file)
+
+    def root(self, xml_file: str) -> ET.Element:
+        """Root of the `xml_file` tree, parsing the file only once."""
+        path = self.path(xml_file)
+        if path not in self.trees:
+            self.trees[path] = ET.parse(path.as_posix())
+        return self.trees[path].getroot()
+
+    def edit(self, xml_file: str, sections: Dict) -> str:
+        """Replace the nodes given in `sections` in the `xml_file` tree."""
+        update_sections(self.root(xml_file), xml_file, sections)
+        return self.path(xml_file).as_posix()
+
+    def add_absolute_paths(self, xml_file: str) -> str:
+        """Replace the relative paths to the optionfiles inside `xml_file`."""
+        if self.names is None:
+            self.names = option_file_names(self.path_optionfiles)
+        rewrite_option_paths(self.root(xml_file), self.path_optionfiles, self.names)
+        return self.path(xml_file).as_posix()
+
+    def flush(self) -> None:
+        """Write the edited files."""
+        for path, tree in self.trees.items():
+            write_tree(tree, path.as_posix())
+        self.trees = {}
+
 
 def edit_xml_options(sections: dict, path_optionfiles: Path) -> Dict:
     """Edit section in the xml files give by `sections`.
 
     Go through the `options` file: sections dictionary
     and  edit the corresponding XML file by replacing
-    `sections` in the XML file.
+    `sections` in the XML file. Every file is parsed
+    and written only once.
     """
-    def call_xml_editor(xml_file, sections):
-        path_file = path_optionfiles / '{}.xml'.format(xml_file)
-        edited_file = edit_xml_file(path_file.as_posix(), xml_file, sections)
-        return add_absolute_path_to_options(edited_file, path_optionfiles)
+    with OptionSet(path_optionfiles) as option_set:
+        for xml_file, section in sections.items():
+            option_set.edit(xml_file, section)
+            option_set.add_absolute_paths(xml_file)
 
-    return {xml_file: call_xml_editor(xml_file, section)
-            for xml_file, section in sections.items()}
+    return {xml_file: option_set.path(xml_file).as_posix() for xml_file in sections}
 
 
 def edit_xml_file(path: str, xml_file: str, sections: Dict) -> str:
@@ -31,7 +89,49 @@ def edit_xml_file(path: str, xml_file: str, sections: Dict) -> str:
     """
     # Parse XML Tree
     tree = ET.parse(path)
-    root = tree.getroot()
+    update_sections(tree.getroot(), xml_file, sections)
+
+    # write to the path_file the updated xml
+    write_tree(tree, path)
+
+    return path
+
+
+def write_tree(tree: ET.ElementTree, path: str) -> None:
+    """Write `tree` to `path`, detaching the file from the shared templates first."""
+    detach_file(path)
+    tree.write(path, short_empty_elements=False)
+
+
+def detach_file(path: Union[str, Path]) -> None:
+    """Replace a link to a template file by a private copy before modifying it.
+
+    The option files are staged as symbolic links to the pristine templates,
+    the copy is only done when a file is about to be modified.
+    """
+    path = Path(path)
+    if path.is_symlink() or (path.exists() and path.stat().st_nlink > 1):
+        fd, tmp = tempfile.mkstemp(dir=path.parent.as_posix(), prefix=path.name)
+        os.close(fd)
+        shutil.copyfile(path.as_posix(), tmp)
+        os.replace(tmp, path.as_posix())
+
+
+def link_tree(src: Path, dst: Path) -> None:
+    """Stage all the files in `src` into `dst` as symbolic links to the originals."""
+    src = Path(src).absolute()
+    for path in src.rglob('*'):
+        if path.is_dir():
+            continue
+        link = Path(dst) / path.relative_to(src)
+        link.parent.mkdir(parents=True, exist_ok=True)
+        if link.is_symlink() or link.exists():
+            link.unlink()
+        os.symlink(path.as_posix(), link.as_posix())
+
+
+def update_sections(root: ET.Element, xml_file: str, sections: Dict) -> None:
+    """Replace the nodes given in `sections` in the `root` tree."""
     # Iterate over the sections to change
     for key, val in sections.items():
         try:
@@ -39,11 +139,6 @@ def edit_xml_file(path: str, xml_file: str, sections: Dict) -> str:
         except AttributeError:
             update_node(key, root, val)
 
-    # write to the path_file the updated xml
-    tree.write(path, short_empty_elements=False)
-
-    return path
-
 
 def update_node(path: str, root: object, val: Any):
     """Update node recursively"""
@@ -54,8 +149,10 @@ def update_node(path: str, root: object, val: Any):
         for key, x in val.items():
             # Remove or update Leave
             if key.lower() == 'delete_entry':
+                # The entry may have been removed already in a resumed workflow
                 leave = root.find(join(path, x))
-                node.remove(leave)
+                if leave is not None:
+                    node.remove(leave)
             elif key.lower() == 'replace_regex':
                 regex, new_val = x
                 node.text = re.sub(regex, new_val, node.text)
@@ -74,64 +171,153 @@ def replace_regex_recursively(tree: object, regex: object, path_file: str) -> No
             elem.text = re.sub(regex, path_file, elem.text)
 
 
-def edit_xml_job_file(path_file: str, jobs_to_run: List):
-    """Read XML Containing a set of job and change status."""
-    # Parse XML Tree
-    tree = ET.parse(path_file)
-    root = tree.getroot()
-
-    for job in root.findall('job'):
-        ids = job.find('id')
-        i = int(ids.text)
-        status = job.find('status')
-        if jobs_to_run is None:
-            status.text = "AVAILABLE"
-        elif i not in jobs_to_run:
-            status.text = "COMPLETE"
-        else:
-            status.text = "AVAILABLE"
-
-    tree.write(path_file)
+def edit_xml_job_file(path_file: str, jobs_to_run: Any):
+    """Read XML Containing a set of job and change status.
+
+    `jobs_to_run` is a selection expression (see :mod:`xtp_job_control.selection`).
+    The status of the jobs is patched in place using the sidecar index of
+    the file, only the jobs whose status changes are written.
+    """
+    index = JobIndex.load(path_file)
+    selected = select_jobs(index, jobs_to_run)
+    statuses = {i: "AVAILABLE" if selected is None or i in selected else "COMPLETE"
+                for i in index.ids()}
+
+    if not index.set_status(statuses):
+        rewrite_xml_job_file(path_file, selected)
+
+    return path_file
+
+
+def rewrite_xml_job_file(path_file: str, selected: set = None) -> str:
+    """Rewrite the status of the jobs in `path_file`, keeping only the `selected` ones available.
+
+    The file is rewritten one job at a time, therefore the memory
+    does not depend on the number of jobs.
+    """
+    tmp_file = "{}.tmp".format(path_file)
+
+    with open(tmp_file, 'wb') as f:
+        f.write(b'<jobs>\n\t')
+        for job in iter_jobs(path_file):
+            i = int(job.find('id').text)
+            status = job.find('status')
+            if selected is None or i in selected:
+                status.text = "AVAILABLE"
+            else:
+                status.text = "COMPLETE"
+            f.write(ET.tostring(job))
+        f.write(b'</jobs>')
+
+    os.replace(tmp_file, path_file)
+
+    return path_file
+
+
+def merge_job_files(path_file: str, job_files: List[str]) -> str:
+    """Replace the jobs of `path_file` with the jobs (and results) found in `job_files`.
+
+    The jobs are copied as raw bytes and the file is rewritten once,
+    keeping the order of the jobs and the jobs that were not run. Only the
+    finished jobs are copied, so merging again never replaces results.
+    """
+    results = {}
+    for job_file in job_files:
+        index = JobIndex.build(job_file)
+        finished = [i for i in index.ids() if index.status(i) in FINISHED_STATUSES]
+        results.update(zip(finished, index.read_jobs(finished)))
+
+    index = JobIndex.load(path_file)
+    tmp_file = "{}.tmp".format(path_file)
+    with open(path_file, 'rb') as src, open(tmp_file, 'wb') as dst:
+        position = 0
+        for entry in index.entries.values():
+            if entry.id not in results:
+                continue
+            dst.write(src.read(entry.start - position))
+            dst.write(results[entry.id])
+            src.seek(entry.end)
+            position = entry.end
+        shutil.copyfileobj(src, dst)
+
+    os.replace(tmp_file, path_file)
 
     return path_file
 
 
 def read_available_jobs(path_file: str, state: str = "AVAILABLE") -> List:
     """Search for jobs with `state`."""
-    tree = ET.parse(path_file)
-    root = tree.getroot()
+    return list(iter_jobs(path_file, state))
 
-    rs = []
-    for j in root.findall('job'):
-        status = j.find('status')
-        if status.text == state:
-            rs.append(j)
-    return rs
+
+def iter_jobs(path_file: str, state: str = None) -> Iterator[ET.Element]:
+    """Yield the jobs in `path_file` with `state` (all the jobs if `None`).
+
+    The file is parsed incrementally and every job is detached from the
+    tree once it has been yielded.
+    """
+    root = None
+    for event, elem in ET.iterparse(path_file, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+        elif elem.tag == 'job':
+            if state is None or elem.findtext('status') == state:
+                yield elem
+            root.clear()
+
+
+def count_jobs(path_file: str, state: str = "AVAILABLE") -> int:
+    """Count the jobs with `state` using the index of the file."""
+    return len(JobIndex.load(path_file).ids(state))
 
 
 def create_job_file(job: object, job_file: str):
-    """Create a xml file containing the information necessary to run a job."""
-    root = ET.Element("jobs")
-    root.text = '\n\t'
-    root.insert(0, job)
+    """Create a xml file containing the information necessary to run a job or a list of jobs."""
+    jobs = job if isinstance(job, list) else [job]
+    with open(job_file, 'wb') as f:
+        f.write(job_file_content(jobs))
+
 
-    tree = ET.ElementTree(root)
-    tree.write(job_file)
+def job_file_content(jobs: List) -> bytes:
+    """Serialize a list of `jobs` as the content of a job file."""
+    return b''.join([b'<jobs>\n\t'] + [ET.tostring(job) for job in jobs] + [b'</jobs>'])
 
 
-def add_absolute_path_to_options(path_xml: str, path_optionfiles: Path) -> None:
-    """Replace the relative paths to the optionfiles inside a `path_xml` file."""
-    names = [x.name for x in path_optionfiles.glob("*xml")]
-    tree = ET.parse(path_xml)
-    root = tree.getroot()
+def raw_job_file_content(jobs: List[bytes]) -> bytes:
+    """Create the content of a job file from the raw content of the `jobs`."""
+    return b'<jobs>\n\t' + b'\n\t'.join(jobs) + b'\n</jobs>'
 
-    for section in root.iter():
-        for elem in section.iter():
-            val = elem.text
-            if (val is not None) and (".xml" in val) and (val in names):
-                path = path_optionfiles / Path(elem.text).name
-                elem.text = path.as_posix()
 
-    tree.write(path_xml, short_empty_elements=False)
+def add_absolute_path_to_options(
+        path_xml: Union[str, List[str]], path_optionfiles: Path) -> Union[str, List[str]]:
+    """Replace the relative paths to the optionfiles inside a `path_xml` file.
+
+    `path_xml` can also be a list of files that are rewritten in a single call.
+    """
+    names = option_file_names(path_optionfiles)
+    for path in ([path_xml] if isinstance(path_xml, (str, Path)) else path_xml):
+        tree = ET.parse(path)
+        rewrite_option_paths(tree.getroot(), path_optionfiles, names)
+        write_tree(tree, path)
 
     return path_xml
+
+
+def option_file_names(path_optionfiles: Path) -> FrozenSet[str]:
+    """Names of the option files in `path_optionfiles`, read in a single listing.
+
+    The names are not cached between calls: the folder is modified every
+    time a file is detached from its template, so its modification time
+    cannot tell whether files were added.
+    """
+    with os.scandir(Path(path_optionfiles).as_posix()) as entries:
+        return frozenset(x.name for x in entries if x.name.endswith("xml"))
+
+
+def rewrite_option_paths(root: ET.Element, path_optionfiles: Path, names: FrozenSet[str]) -> None:
+    """Replace the option file `names` in the `root` tree by their absolute path."""
+    for elem in root.iter():
+        val = elem.text
+        if val is not None and val in names and ".xml" in val:
+            elem.text = (path_optionfiles / val).as_posix()